@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for sending one string to many L{minerva.mserver.ServerStream}s.
+
+This compares calling C{sendString} on every stream with
+L{minerva.mserver.broadcast}, including the time taken by every
+L{ServerTransport} to encode and write the string.  Every stream has an
+Int32 (Flash Socket) primary transport.
+
+Run with: python benchmarks/bench_broadcast.py
+"""
+
+import time
+
+from twisted.internet import task
+
+from webmagic.fakes import DummyTCPTransport
+
+from minerva.mserver import StreamTracker, ServerTransportFactory, broadcast
+from minerva.decoders import Int32StringDecoder
+from minerva.frames import HelloFrame
+from minerva.window import SACK
+from minerva.mocks import MockStringsFactory
+
+
+class _DiscardingTcpTransport(DummyTCPTransport):
+
+	def write(self, data):
+		pass
+
+
+	def writeSequence(self, seq):
+		pass
+
+
+
+def _helloFrameFor(streamId):
+	return HelloFrame(dict(
+		transportNumber=0,
+		succeedsTransport=None,
+		requestNewStream=1,
+		protocolVersion=2,
+		streamId=streamId,
+		streamingResponse=1,
+		maxReceiveBytes=2**30,
+		maxOpenTime=2**30,
+		maxInactivity=0,
+		lastSackSeenByClient=SACK(-1, ())))
+
+
+def _makeStreams(n):
+	clock = task.Clock()
+	tracker = StreamTracker(clock, MockStringsFactory(), inactiveCheckInterval=None)
+	factory = ServerTransportFactory(clock, tracker)
+	streams = []
+	for i in xrange(n):
+		streamId = 'stream%020d' % (i,)
+		transport = factory.buildProtocol(addr=None)
+		transport.makeConnection(_DiscardingTcpTransport())
+		transport.dataReceived('<int32/>\n' + Int32StringDecoder.encode(
+			_helloFrameFor(streamId).encode()))
+		streams.append(tracker.getStream(streamId))
+	return clock, streams
+
+
+def benchFanOut(n, rounds=5):
+	"""
+	Return a list of (method name, milliseconds per string) for sending a
+	string to C{n} streams, including the flush.
+	"""
+	string = 'TEXT|1|' + 'hello there ' * 8
+
+	def loop(streams):
+		for s in streams:
+			s.sendString(string)
+
+	def bcast(streams):
+		broadcast(string, streams)
+
+	results = []
+	for name, func in (('sendString loop', loop), ('broadcast', bcast)):
+		clock, streams = _makeStreams(n)
+		best = None
+		for _ in xrange(rounds):
+			start = time.time()
+			func(streams)
+			clock.advance(1)
+			elapsed = time.time() - start
+			best = elapsed if best is None else min(best, elapsed)
+		results.append((name, best * 1e3))
+	return results
+
+
+def main():
+	print "%10s  %-20s %12s" % ("streams", "method", "msec/string")
+	for n in (100, 10000):
+		for name, msec in benchFanOut(n):
+			print "%10d  %-20s %12.3f" % (n, name, msec)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the decoders in L{minerva.decoders}.
+
+For each decoder, this measures how fast it turns a stream of bytes into
+frames when the bytes arrive as:
+
+	small: many short frames in one large read
+	large: one frame near ServerTransport.maxLength (1 MiB) in 64 KiB reads
+	dribbled: one 256 KiB frame that arrives 64 bytes at a time
+
+Run with: python benchmarks/bench_decoders.py
+"""
+
+import time
+
+from minerva.decoders import DelimitedStringDecoder, Int32StringDecoder
+
+
+def _dice(data, size):
+	return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def _workloads(encode):
+	small = ''.join(encode('x' * 50) for _ in xrange(20000))
+	large = encode('x' * (1024 * 1024 - 100))
+	dribbled = encode('x' * (256 * 1024))
+	return [
+		('small', [small]),
+		('large', _dice(large, 64 * 1024)),
+		('dribbled', _dice(dribbled, 64)),
+	]
+
+
+def benchDecoder(decoderClass, repeat=5):
+	"""
+	Return a list of (workload name, MB/s) for C{decoderClass}.
+	"""
+	results = []
+	for name, chunks in _workloads(decoderClass.encode):
+		total = sum(len(c) for c in chunks)
+		best = None
+		for _ in xrange(repeat):
+			decoder = decoderClass(maxLength=1024 * 1024)
+			start = time.time()
+			for chunk in chunks:
+				decoder.getNewFrames(chunk)
+			elapsed = time.time() - start
+			best = elapsed if best is None else min(best, elapsed)
+		results.append((name, total / best / 1e6))
+	return results
+
+
+def main():
+	print "%-24s %-10s %10s" % ("decoder", "input", "MB/s")
+	for decoderClass in (DelimitedStringDecoder, Int32StringDecoder):
+		for name, mbps in benchDecoder(decoderClass):
+			print "%-24s %-10s %10.1f" % (decoderClass.__name__, name, mbps)
+
+
+if __name__ == '__main__':
+	main()
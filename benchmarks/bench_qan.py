@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+End-to-end benchmark of QAN questions/sec, with and without
+L{minerva.qan.Batch} frames.
+
+A client sends a burst of small questions to an echo L{IQANProtocol}
+behind L{minerva.mserver.QANProtocolWrapper}, over an Int32 (Flash Socket)
+L{ServerTransport}, and waits for the answers before sending the next
+burst.  Without batching, every question and answer is its own Minerva
+string; with batching, each burst is one L{Batch} string in each
+direction.  Everything runs in one process with a fake TCP transport.
+
+Run with: python benchmarks/bench_qan.py
+"""
+
+import time
+
+from twisted.internet import task
+
+from webmagic.fakes import DummyTCPTransport
+
+from minerva.mserver import (
+	StreamTracker, ServerTransportFactory, QANProtocolWrapper)
+from minerva.decoders import Int32StringDecoder
+from minerva.frames import HelloFrame, StringFrame, SackFrame
+from minerva.qan import Question, Batch, qanFrameToString
+from minerva.window import SACK
+
+
+class _EchoQANProtocol(object):
+
+	def streamStarted(self, stream, qanHelper):
+		pass
+
+
+	def bodyReceived(self, body, isQuestion):
+		return body
+
+
+	def streamReset(self, reasonString, applicationLevel):
+		pass
+
+
+
+class _EchoQANFactory(object):
+
+	def __init__(self, clock, batchFrames):
+		self._clock = clock
+		self._batchFrames = batchFrames
+
+
+	def buildProtocol(self):
+		return QANProtocolWrapper(_EchoQANProtocol(), validateBodies=True,
+			clock=self._clock, batchFrames=self._batchFrames)
+
+
+
+class _CountingTcpTransport(DummyTCPTransport):
+	writeCount = 0
+
+	def write(self, data):
+		self.writeCount += 1
+
+
+	def writeSequence(self, seq):
+		self.writeCount += 1
+
+
+
+def _helloFrame():
+	return HelloFrame(dict(
+		transportNumber=0,
+		requestNewStream=1,
+		protocolVersion=2,
+		streamId='q' * 26,
+		streamingResponse=1,
+		maxReceiveBytes=2**30,
+		maxOpenTime=2**30,
+		maxInactivity=0,
+		lastSackSeenByClient=SACK(-1, ())))
+
+
+def benchQAN(burst, rounds, batchFrames):
+	clock = task.Clock()
+	tracker = StreamTracker(
+		clock, _EchoQANFactory(clock, batchFrames), inactiveCheckInterval=None)
+	factory = ServerTransportFactory(clock, tracker)
+	transport = factory.buildProtocol(addr=None)
+	tcpTransport = _CountingTcpTransport()
+	transport.makeConnection(tcpTransport)
+	transport.dataReceived('<int32/>\n' + Int32StringDecoder.encode(
+		_helloFrame().encode()))
+
+	encode = Int32StringDecoder.encode
+	qid = 0
+	serverSeqNum = -1
+	start = time.time()
+	for _ in xrange(rounds):
+		questions = []
+		for n in xrange(burst):
+			qid += 1
+			questions.append(Question('{"get": %d}' % (n,), qid))
+		if batchFrames:
+			strings = [qanFrameToString(Batch(questions))]
+			serverSeqNum += 1
+		else:
+			strings = [qanFrameToString(q) for q in questions]
+			serverSeqNum += burst
+		data = ''.join(encode(StringFrame(s).encode()) for s in strings)
+		# Acknowledge the answers to the previous burst
+		data += encode(SackFrame(SACK(serverSeqNum - len(strings), ())).encode())
+		before = tcpTransport.writeCount
+		transport.dataReceived(data)
+		# Flush the QAN Batch, then the stream's send queue.
+		clock.advance(0)
+		clock.advance(0.001)
+		assert tcpTransport.writeCount > before
+	return time.time() - start
+
+
+def main():
+	print "%-10s %8s %16s" % ("frames", "burst", "questions/s")
+	for name, batchFrames in (('single', False), ('batched', True)):
+		for burst in (1, 10, 50):
+			rounds = 20000 // burst
+			elapsed = min(benchQAN(burst, rounds, batchFrames) for _ in xrange(3))
+			print "%-10s %8d %16.0f" % (name, burst, burst * rounds / elapsed)
+
+
+if __name__ == '__main__':
+	main()
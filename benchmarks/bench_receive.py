@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for receiving strings through
+L{minerva.mserver.ServerTransport.dataReceived}.
+
+For an Int32 (Flash Socket) transport, batches of StringFrames are fed to
+one transport.  For HTTP, every batch is the body of a new POST request
+that also carries a HelloFrame, like a client's C2S XHR request.
+
+Run with: python benchmarks/bench_receive.py
+"""
+
+import time
+from cStringIO import StringIO
+
+from twisted.internet import task
+
+from webmagic.fakes import DummyTCPTransport, DummyRequest
+
+from minerva.mserver import StreamTracker, ServerTransportFactory, _HttpIo
+from minerva.decoders import Int32StringDecoder
+from minerva.frames import HelloFrame, StringFrame, SeqNumFrame, FORMAT_XHR
+from minerva.window import SACK
+
+
+class _NullProtocol(object):
+
+	def streamStarted(self, stream):
+		self.count = 0
+
+
+	def stringsReceived(self, strings):
+		self.count += len(strings)
+
+
+	def streamReset(self, reasonString, applicationLevel):
+		pass
+
+
+
+class _NullFactory(object):
+
+	def buildProtocol(self):
+		return _NullProtocol()
+
+
+
+class _DiscardingTcpTransport(DummyTCPTransport):
+
+	def write(self, data):
+		pass
+
+
+	def writeSequence(self, seq):
+		pass
+
+
+
+class _DiscardingRequest(DummyRequest):
+
+	def write(self, data):
+		self.startedWriting = True
+
+
+
+def _helloFrame(streamId, transportNumber, http):
+	data = dict(
+		transportNumber=transportNumber,
+		requestNewStream=int(not transportNumber),
+		protocolVersion=2,
+		streamId=streamId,
+		streamingResponse=int(not http),
+		maxReceiveBytes=2**30,
+		maxOpenTime=2**30,
+		maxInactivity=0,
+		lastSackSeenByClient=SACK(-1, ()))
+	if http:
+		data['httpFormat'] = FORMAT_XHR
+	return HelloFrame(data)
+
+
+def _strings(batch, size):
+	return [StringFrame('%0*d' % (size, n)).encode() for n in xrange(batch)]
+
+
+def benchInt32(batch, size, rounds):
+	clock = task.Clock()
+	tracker = StreamTracker(clock, _NullFactory(), inactiveCheckInterval=None)
+	factory = ServerTransportFactory(clock, tracker)
+	transport = factory.buildProtocol(addr=None)
+	transport.makeConnection(_DiscardingTcpTransport())
+	transport.dataReceived('<int32/>\n' + Int32StringDecoder.encode(
+		_helloFrame('i' * 26, 0, False).encode()))
+	data = ''.join(Int32StringDecoder.encode(s) for s in _strings(batch, size))
+
+	start = time.time()
+	for _ in xrange(rounds):
+		transport.dataReceived(data)
+	return time.time() - start
+
+
+def benchHttp(batch, size, rounds):
+	clock = task.Clock()
+	tracker = StreamTracker(clock, _NullFactory(), inactiveCheckInterval=None)
+	resource = _HttpIo(clock, tracker)
+	strings = _strings(batch, size)
+
+	start = time.time()
+	for n in xrange(rounds):
+		frames = [
+			_helloFrame('h' * 26, n, True).encode(),
+			SeqNumFrame(n * batch).encode()] + strings
+		request = _DiscardingRequest(postpath=[])
+		request.method = 'POST'
+		request.content = StringIO('\n'.join(frames) + '\n')
+		resource.render(request)
+	return time.time() - start
+
+
+def main():
+	print "%-8s %8s %14s" % ("mode", "batch", "strings/s")
+	for name, bench in (
+		('int32', benchInt32),
+		('http', benchHttp),
+	):
+		for batch in (1, 10, 100, 1000):
+			rounds = 20000 // batch
+			elapsed = min(bench(batch, 40, rounds) for _ in xrange(3))
+			print "%-8s %8d %14.0f" % (name, batch, batch * rounds / elapsed)
+
+
+if __name__ == '__main__':
+	main()
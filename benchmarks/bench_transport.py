@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for L{minerva.mserver.ServerTransport.writeStrings}.
+
+For an Int32 (Flash Socket) transport and a streaming HTTP transport, this
+measures how fast a batch of strings is encoded and handed to the
+underlying TCP transport or HTTP request.
+
+Run with: python benchmarks/bench_transport.py
+"""
+
+import time
+from cStringIO import StringIO
+
+from twisted.internet import task
+
+from webmagic.fakes import DummyTCPTransport, DummyRequest
+
+from minerva.mserver import StreamTracker, ServerTransportFactory, _HttpIo
+from minerva.decoders import Int32StringDecoder
+from minerva.frames import HelloFrame, FORMAT_XHR
+from minerva.window import SACK, Queue
+from minerva.mocks import MockStringsFactory
+
+
+class _CountingTcpTransport(DummyTCPTransport):
+	byteCount = 0
+
+	def write(self, data):
+		self.byteCount += len(data)
+
+
+	def writeSequence(self, seq):
+		for data in seq:
+			self.byteCount += len(data)
+
+
+
+class _CountingRequest(DummyRequest):
+	byteCount = 0
+
+	def write(self, data):
+		self.startedWriting = True
+		self.byteCount += len(data)
+
+
+
+def _helloData(streamId, http):
+	data = dict(
+		transportNumber=0,
+		succeedsTransport=None,
+		requestNewStream=1,
+		protocolVersion=2,
+		streamId=streamId,
+		streamingResponse=1,
+		maxReceiveBytes=2**30,
+		maxOpenTime=2**30,
+		maxInactivity=0,
+		lastSackSeenByClient=SACK(-1, ()))
+	if http:
+		data['httpFormat'] = FORMAT_XHR
+	return HelloFrame(data)
+
+
+def _makeInt32Transport(clock, tracker):
+	factory = ServerTransportFactory(clock, tracker)
+	transport = factory.buildProtocol(addr=None)
+	writable = _CountingTcpTransport()
+	transport.makeConnection(writable)
+	transport.dataReceived('<int32/>\n' + Int32StringDecoder.encode(
+		_helloData('i' * 26, False).encode()))
+	return transport, writable
+
+
+def _makeHttpTransport(clock, tracker):
+	request = _CountingRequest(postpath=[])
+	request.method = 'POST'
+	request.content = StringIO(_helloData('h' * 26, True).encode() + '\n')
+	resource = _HttpIo(clock, tracker)
+	resource.render(request)
+	transport = tracker.getStream('h' * 26)._primaryTransport
+	return transport, request
+
+
+def benchWriteStrings(makeTransport, batch=500, size=100, rounds=50):
+	"""
+	Return (MB/s of encoded output, microseconds per string) for writing
+	C{rounds} batches of C{batch} strings of C{size} bytes.
+	"""
+	clock = task.Clock()
+	tracker = StreamTracker(clock, MockStringsFactory(), inactiveCheckInterval=None)
+	transport, writable = makeTransport(clock, tracker)
+	q = Queue()
+	strings = ['%0*d' % (size, n) for n in xrange(batch)]
+	best = None
+	for _ in xrange(rounds):
+		q.extend(strings)
+		before = writable.byteCount
+		start = time.time()
+		transport.writeStrings(q, None)
+		elapsed = time.time() - start
+		written = writable.byteCount - before
+		q.handleSACK(SACK(q._counter, ()))
+		if best is None or elapsed < best[0]:
+			best = (elapsed, written)
+	elapsed, written = best
+	return written / elapsed / 1e6, elapsed / batch * 1e6
+
+
+def main():
+	print "%-8s %8s %12s %12s" % ("mode", "batch", "MB/s", "usec/string")
+	for name, makeTransport in (
+		('int32', _makeInt32Transport),
+		('http', _makeHttpTransport),
+	):
+		for batch in (10, 500, 5000):
+			mbps, usec = benchWriteStrings(makeTransport, batch)
+			print "%-8s %8d %12.1f %12.3f" % (name, batch, mbps, usec)
+
+
+if __name__ == '__main__':
+	main()
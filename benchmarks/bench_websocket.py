@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Loopback benchmark comparing a WebSocket transport with XHR long-polling.
+
+A client sends one string at a time to an echo protocol and waits for the
+echo before sending the next.  For WebSocket, every round trip goes over
+the same L{ServerTransport}.  For XHR long-polling, every round trip is a
+new POST to L{minerva.mserver._HttpIo} that carries a HelloFrame, the
+string, and a SACK, and is finished by the echoed string.  The client and
+server run in the same process, with fake TCP transports and requests, so
+this measures the server's CPU cost per round trip rather than network
+latency.
+
+Run with: python benchmarks/bench_websocket.py
+"""
+
+import time
+import struct
+from cStringIO import StringIO
+
+from twisted.internet import task
+
+from webmagic.fakes import DummyTCPTransport, DummyRequest
+
+from minerva.mserver import StreamTracker, _HttpIo, _WebSocketIo
+from minerva.decoders import _unmask
+from minerva.frames import (
+	HelloFrame, StringFrame, SeqNumFrame, SackFrame, FORMAT_XHR)
+from minerva.window import SACK
+
+
+class _EchoProtocol(object):
+
+	def streamStarted(self, stream):
+		self.stream = stream
+
+
+	def stringsReceived(self, strings):
+		for s in strings:
+			self.stream.sendString(str(s))
+
+
+	def streamReset(self, reasonString, applicationLevel):
+		pass
+
+
+
+class _EchoFactory(object):
+
+	def buildProtocol(self):
+		return _EchoProtocol()
+
+
+
+class _CountingTcpTransport(DummyTCPTransport):
+	writeCount = 0
+
+	def write(self, data):
+		self.writeCount += 1
+
+
+	def writeSequence(self, seq):
+		self.writeCount += 1
+
+
+
+class _CountingRequest(DummyRequest):
+	writeCount = 0
+
+	def write(self, data):
+		self.startedWriting = True
+		self.writeCount += 1
+
+
+
+def _helloFrame(streamId, transportNumber, http):
+	data = dict(
+		transportNumber=transportNumber,
+		succeedsTransport=transportNumber - 1 if transportNumber else None,
+		requestNewStream=int(not transportNumber),
+		protocolVersion=2,
+		streamId=streamId,
+		streamingResponse=int(not http),
+		maxReceiveBytes=2**30,
+		maxOpenTime=2**30,
+		maxInactivity=0,
+		lastSackSeenByClient=SACK(transportNumber - 1, ()))
+	if http:
+		data['httpFormat'] = FORMAT_XHR
+	return HelloFrame(data)
+
+
+def _maskedFrame(s, mask='\x37\xfa\x21\x3d'):
+	lenS = len(s)
+	if lenS < 126:
+		header = '\x81' + chr(0x80 | lenS)
+	else:
+		header = '\x81\xfe' + struct.pack('!H', lenS)
+	return header + mask + _unmask(s, mask)
+
+
+def benchWebSocket(roundTrips, string):
+	clock = task.Clock()
+	tracker = StreamTracker(clock, _EchoFactory(), inactiveCheckInterval=None)
+	resource = _WebSocketIo(clock, tracker)
+	request = DummyRequest(postpath=[])
+	request.method = 'GET'
+	for k, v in [
+		('upgrade', 'websocket'),
+		('connection', 'Upgrade'),
+		('sec-websocket-version', '13'),
+		('sec-websocket-key', 'dGhlIHNhbXBsZSBub25jZQ==')]:
+		request.requestHeaders.setRawHeaders(k, [v])
+	tcpTransport = request.channel.transport = _CountingTcpTransport()
+	resource.render_GET(request)
+	transport = tcpTransport.protocol
+	transport.dataReceived(_maskedFrame(_helloFrame('w' * 26, 0, False).encode()))
+
+	encodedString = StringFrame(string).encode()
+	start = time.time()
+	for n in xrange(roundTrips):
+		before = tcpTransport.writeCount
+		data = _maskedFrame(encodedString)
+		if n:
+			data += _maskedFrame(SackFrame(SACK(n - 1, ())).encode())
+		transport.dataReceived(data)
+		# The stream flushes its send queue after FlushScheduler's delay
+		clock.advance(0.001)
+		assert tcpTransport.writeCount > before
+	return time.time() - start
+
+
+def benchLongPoll(roundTrips, string):
+	clock = task.Clock()
+	tracker = StreamTracker(clock, _EchoFactory(), inactiveCheckInterval=None)
+	resource = _HttpIo(clock, tracker)
+
+	encodedString = StringFrame(string).encode()
+	start = time.time()
+	for n in xrange(roundTrips):
+		frames = [
+			_helloFrame('h' * 26, n, True).encode(),
+			SeqNumFrame(n).encode(),
+			encodedString]
+		if n:
+			frames.append(SackFrame(SACK(n - 1, ())).encode())
+		request = _CountingRequest(postpath=[])
+		request.method = 'POST'
+		request.content = StringIO('\n'.join(frames) + '\n')
+		resource.render(request)
+		clock.advance(0.001)
+		assert request.finished
+	return time.time() - start
+
+
+def main():
+	roundTrips = 5000
+	string = '{"type": "update", "value": 1}'
+	print "%-12s %12s %14s" % ("mode", "usec/trip", "round trips/s")
+	for name, bench in (
+		('websocket', benchWebSocket),
+		('xhr-poll', benchLongPoll),
+	):
+		elapsed = min(bench(roundTrips, string) for _ in xrange(3))
+		print "%-12s %12.1f %14.0f" % (
+			name, elapsed / roundTrips * 1e6, roundTrips / elapsed)
+
+
+if __name__ == '__main__':
+	main()
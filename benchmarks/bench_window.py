@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark for L{minerva.window.Queue}.
+
+For each queue size, this measures the per-operation cost of the things
+ServerStream and ServerTransport do to a Queue with that many unacked items:
+appending a string (and ACKing the oldest), writing out the newest item with
+C{iterItems(start)}, and handling a SACK that ACKs one item and SACKs another.
+
+Run with: python benchmarks/bench_window.py
+"""
+
+import timeit
+
+from minerva.window import SACK, Queue
+
+
+def _makeQueue(n):
+	q = Queue()
+	q.extend('x' * 20 for _ in xrange(n))
+	return q
+
+
+def benchQueue(n, number=2000):
+	"""
+	Return a list of (operation name, microseconds per operation) for a
+	Queue that holds C{n} unacked items.  Every operation leaves the queue
+	at (roughly) C{n} items, so the numbers reflect a queue of that size.
+	"""
+	q = _makeQueue(n)
+	state = dict(acked=-1)
+
+	def appendOne():
+		q.append('y' * 20)
+		state['acked'] += 1
+		q.handleSACK(SACK(state['acked'], ()))
+
+	def iterNewest():
+		for _ in q.iterItems(q._counter):
+			pass
+
+	def sackOne():
+		# ACK the oldest item and SACK one from the middle, then append
+		# two items to keep the queue at the same size.
+		state['acked'] += 1
+		acked = state['acked']
+		q.handleSACK(SACK(acked, (acked + 1 + n // 2,)))
+		q.extend(('z' * 20, 'z' * 20))
+		state['acked'] += 1
+
+	results = []
+	for name, func in (
+		('append+ACK', appendOne),
+		('iterItems(newest)', iterNewest),
+		('handleSACK', sackOne),
+	):
+		best = min(timeit.repeat(func, number=number, repeat=3))
+		results.append((name, best / number * 1e6))
+	return results
+
+
+def main():
+	print "%10s  %-20s %12s" % ("queued", "operation", "usec/op")
+	for n in (10, 1000, 100000):
+		for name, usec in benchQueue(n):
+			print "%10d  %-20s %12.3f" % (n, name, usec)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+Benchmark comparing the C{<int32/>} and C{<int32-zlib/>} Flash Socket modes
+of L{minerva.mserver.ServerTransport}.
+
+For repetitive JSON strings (typical of our clients), this measures the
+bytes on the wire and the CPU time per string, server-to-client (strings
+written in batches) and client-to-server (strings decoded in batches).
+
+Run with: python benchmarks/bench_zlib.py
+"""
+
+import time
+import zlib
+
+from twisted.internet import task
+
+from webmagic.fakes import DummyTCPTransport
+
+from minerva.mserver import StreamTracker, ServerTransportFactory
+from minerva.decoders import Int32StringDecoder
+from minerva.frames import HelloFrame, StringFrame, SeqNumFrame
+from minerva.window import SACK, Queue
+from minerva.mocks import MockStringsFactory
+
+
+class _CountingTcpTransport(DummyTCPTransport):
+	byteCount = 0
+
+	def write(self, data):
+		self.byteCount += len(data)
+
+
+	def writeSequence(self, seq):
+		for data in seq:
+			self.byteCount += len(data)
+
+
+
+class _Encoder(object):
+	"""
+	Encodes C2S frames the way a client in the given mode would.
+	"""
+	def __init__(self, compress):
+		self._compressor = zlib.compressobj() if compress else None
+
+
+	def encode(self, frames):
+		data = ''.join(Int32StringDecoder.encode(f.encode()) for f in frames)
+		if self._compressor is not None:
+			data = (self._compressor.compress(data) +
+				self._compressor.flush(zlib.Z_SYNC_FLUSH))
+		return data
+
+
+
+def _makeTransport(compress):
+	clock = task.Clock()
+	tracker = StreamTracker(clock, MockStringsFactory(), inactiveCheckInterval=None)
+	factory = ServerTransportFactory(clock, tracker)
+	transport = factory.buildProtocol(addr=None)
+	writable = _CountingTcpTransport()
+	transport.makeConnection(writable)
+	encoder = _Encoder(compress)
+	hello = HelloFrame(dict(
+		transportNumber=0,
+		succeedsTransport=None,
+		requestNewStream=1,
+		protocolVersion=2,
+		streamId='z' * 26,
+		streamingResponse=1,
+		maxReceiveBytes=2**30,
+		maxOpenTime=2**30,
+		maxInactivity=0,
+		lastSackSeenByClient=SACK(-1, ())))
+	mode = '<int32-zlib/>\n' if compress else '<int32/>\n'
+	transport.dataReceived(mode + encoder.encode([hello]))
+	return transport, writable, encoder
+
+
+def _jsonString(n):
+	return '{"type":"update","room":"lobby","user":%d,"online":true}' % (n % 50,)
+
+
+def benchS2C(compress, batch, rounds=200):
+	"""
+	Return (bytes on the wire per string, microseconds per string).
+	"""
+	transport, writable, _ = _makeTransport(compress)
+	q = Queue()
+	strings = [_jsonString(n) for n in xrange(batch)]
+	before = writable.byteCount
+	elapsed = 0
+	for _ in xrange(rounds):
+		q.extend(strings)
+		start = time.time()
+		transport.writeStrings(q, None)
+		elapsed += time.time() - start
+		q.handleSACK(SACK(q._counter, ()))
+	count = batch * rounds
+	return (writable.byteCount - before) / float(count), elapsed / count * 1e6
+
+
+def benchC2S(compress, batch, rounds=200):
+	"""
+	Return (bytes on the wire per string, microseconds per string).
+	"""
+	transport, writable, encoder = _makeTransport(compress)
+	seqNum = 0
+	wire = 0
+	elapsed = 0
+	for _ in xrange(rounds):
+		frames = [SeqNumFrame(seqNum)] + [
+			StringFrame(_jsonString(n)) for n in xrange(batch)]
+		seqNum += batch
+		data = encoder.encode(frames)
+		wire += len(data)
+		start = time.time()
+		transport.dataReceived(data)
+		elapsed += time.time() - start
+	count = batch * rounds
+	return wire / float(count), elapsed / count * 1e6
+
+
+def main():
+	print "%-4s %-12s %6s %14s %12s" % (
+		"dir", "mode", "batch", "bytes/string", "usec/string")
+	for direction, bench in (('S2C', benchS2C), ('C2S', benchC2S)):
+		for batch in (1, 50):
+			for mode, compress in (('int32', False), ('int32-zlib', True)):
+				size, usec = bench(compress, batch)
+				print "%-4s %-12s %6d %14.1f %12.2f" % (
+					direction, mode, batch, size, usec)
+
+
+if __name__ == '__main__':
+	main()
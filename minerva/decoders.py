@@ -7,6 +7,9 @@ a bug.
 
 import sys
 import struct
+from binascii import hexlify, unhexlify
+
+import simplejson
 from strfrag import StringFragment
 
 _postImportVars = vars().keys()
@@ -20,8 +23,9 @@ class StringTooLongError(Exception):
 
 
 
-# possible result codes for the (frames, result_code) return values
-OK, TOO_LONG = range(2)
+# possible result codes for the (frames, result_code) return values.
+# INVALID and CLOSED are returned only by L{WebSocketDecoder}.
+OK, TOO_LONG, INVALID, CLOSED = range(4)
 
 
 class DelimitedStringDecoder(object):
@@ -29,17 +33,23 @@ class DelimitedStringDecoder(object):
 	Decodes a stream of (1-byte-delimiter)-terminated bytestrings.
 
 	Returns L{strfrag.StringFragment} objects instead of C{str} objects to
-	reduce copying.
+	reduce copying.  Strings that arrive entirely within one C{data} are
+	L{StringFragment}s of that C{data}.  Only a string that spans more
+	than one C{getNewFrames} call is copied (once, when its delimiter
+	arrives); until then, its pieces are kept in a list.
 	"""
 	# delimiter *must* be 1 byte.  Do not change it after any data has been
 	# received.
 	delimiter = '\n'
 
-	__slots__ = ('maxLength', '_buffer')
+	__slots__ = ('maxLength', '_chunks', '_pendingLength', '_tooLong')
 
 	def __init__(self, maxLength):
 		self.maxLength = maxLength
-		self._buffer = ''
+		# Pieces of a string whose delimiter has not yet arrived
+		self._chunks = []
+		self._pendingLength = 0
+		self._tooLong = False
 
 
 	@classmethod
@@ -48,42 +58,106 @@ class DelimitedStringDecoder(object):
 		return s
 
 
+	@classmethod
+	def encodeStringFrame(cls, s):
+		"""
+		Equivalent to C{cls.encode(s + ' ')}, the encoding of a StringFrame
+		for C{str} C{s}, but without the intermediate string.
+		"""
+		return ''.join((s, ' ', cls.delimiter))
+
+
+	def _fail(self, completeStrings):
+		self._tooLong = True
+		self._chunks = []
+		return completeStrings, TOO_LONG
+
+
 	def getNewFrames(self, data):
 		# This should re-return the correct error code when more data is
 		# fed into it, even after the error code was already returned.
 		de = self.delimiter
 		m = self.maxLength
 
-		self._buffer += data
 		completeStrings = []
-		# Stop the "dribble in bytes slowly" attack (where entire buffer is
-		# repeatedly scanned for \n).  This trick works here because our
-		# delimiter is 1 byte.
-		if de not in data:
-			if len(self._buffer) > m:
-				return completeStrings, TOO_LONG
+		if self._tooLong:
+			return completeStrings, TOO_LONG
+
+		# Only the new data is scanned for the delimiter, and the new data
+		# is not copied until the delimiter arrives.  This stops the
+		# "dribble in bytes slowly" attack.
+		endsAt = data.find(de)
+		if endsAt == -1:
+			if data:
+				self._chunks.append(data)
+				self._pendingLength += len(data)
+			if self._pendingLength > m:
+				return self._fail(completeStrings)
 			return completeStrings, OK
-		at = 0
+
+		if self._chunks:
+			if self._pendingLength + endsAt > m:
+				return self._fail(completeStrings)
+			self._chunks.append(data[:endsAt])
+			first = ''.join(self._chunks)
+			self._chunks = []
+			self._pendingLength = 0
+			completeStrings.append(StringFragment(first, 0, len(first)))
+		else:
+			if endsAt > m:
+				return self._fail(completeStrings)
+			completeStrings.append(StringFragment(data, 0, endsAt))
+
+		at = endsAt + 1
 		while True:
-			# Find the delimiter that ends the string we're about to extract
-			endsAt = self._buffer.index(de, at)
+			endsAt = data.find(de, at)
+			if endsAt == -1:
+				break
 			if endsAt - at > m:
-				return completeStrings, TOO_LONG
-			# Note that if the user keeps the StringFragment around, the next
-			# `self._buffer += data` will not be optimized (in CPython).
-			completeStrings.append(
-				StringFragment(self._buffer, at, endsAt - at))
+				return self._fail(completeStrings)
+			completeStrings.append(StringFragment(data, at, endsAt - at))
 			at = endsAt + 1
-			# If there's no delimiter after that delimiter, break.
-			if self._buffer.find(de, at) == -1:
-				break
-		self._buffer = self._buffer[at:]
-		if len(self._buffer) > m:
-			return completeStrings, TOO_LONG
+
+		rest = len(data) - at
+		if rest:
+			if rest > m:
+				return self._fail(completeStrings)
+			self._chunks.append(data[at:])
+			self._pendingLength = rest
 		return completeStrings, OK
 
 
 
+class ScriptWrappedStringDecoder(DelimitedStringDecoder):
+	"""
+	Decodes like L{DelimitedStringDecoder}, but encodes each string as a
+	C{<script>} tag that passes the string to the function C{f}, for an
+	htmlfile (streaming iframe) response.  The response must begin with
+	C{responseHead}, which defines C{f}.
+	"""
+	__slots__ = ()
+
+	responseHead = (
+		'<!doctype html>\n<html><head><meta charset="utf-8"></head><body>\n'
+		'<script>var f = parent.__minervaHtmlfileFrame;</script>\n')
+
+	_prefix = '<script>f('
+	_suffix = ')</script>\n'
+
+	@classmethod
+	def encode(cls, s):
+		# Escaping every "<" keeps "</script>" and "<!--" out of the
+		# script element.
+		return cls._prefix + \
+			simplejson.dumps(s).replace('<', '\\u003c') + cls._suffix
+
+
+	@classmethod
+	def encodeStringFrame(cls, s):
+		return cls.encode(s + ' ')
+
+
+
 class IntNStringDecoder(object):
 	"""
 	Generic class for length prefixed protocols.
@@ -101,11 +175,18 @@ class IntNStringDecoder(object):
 	@type maxPossibleLength: C{int}
 	"""
 
-	__slots__ = ('maxLength', '_buffer')
+	__slots__ = (
+		'maxLength', '_chunks', '_chunksLength', '_pendingLength', '_tooLong')
 
 	def __init__(self, maxLength):
 		self.maxLength = maxLength
-		self._buffer = ""
+		# Pieces of the prefix (if _pendingLength is None) or the string
+		# (if not) that we are in the middle of receiving
+		self._chunks = []
+		self._chunksLength = 0
+		# The length of the string whose prefix we have already parsed
+		self._pendingLength = None
+		self._tooLong = False
 
 
 	@classmethod
@@ -123,39 +204,110 @@ class IntNStringDecoder(object):
 		return struct.pack(cls.structFormat, lenData) + s
 
 
+	@classmethod
+	def encodeStringFrame(cls, s):
+		"""
+		Equivalent to C{cls.encode(s + ' ')}, the encoding of a StringFrame
+		for C{str} C{s}, but without the intermediate string.
+		"""
+		lenData = len(s) + 1
+		if lenData >= cls.maxPossibleLength:
+			raise StringTooLongError(
+				"Cannot encode %s bytes; maximum is %s" % (
+				lenData, cls.maxPossibleLength))
+		return ''.join((struct.pack(cls.structFormat, lenData), s, ' '))
+
+
+	def _fail(self, strings):
+		self._tooLong = True
+		self._chunks = []
+		return strings, TOO_LONG
+
+
+	def _continuePending(self, data, strings):
+		"""
+		Continue receiving the prefix or string that started in an earlier
+		call.  Return how many bytes of C{data} were used, or C{None} if
+		all of C{data} was used without completing the string.
+		"""
+		lenData = len(data)
+		at = 0
+		if self._pendingLength is None:
+			need = self.prefixLength - self._chunksLength
+			if lenData < need:
+				self._chunks.append(data)
+				self._chunksLength += lenData
+				return None
+			self._chunks.append(data[:need])
+			length, = struct.unpack(self.structFormat, ''.join(self._chunks))
+			if length > self.maxLength:
+				return -1
+			self._pendingLength = length
+			self._chunks = []
+			self._chunksLength = 0
+			at = need
+
+		need = self._pendingLength - self._chunksLength
+		if lenData - at < need:
+			if lenData > at:
+				self._chunks.append(data[at:] if at else data)
+				self._chunksLength += lenData - at
+			return None
+		self._chunks.append(data[at:at + need])
+		string = ''.join(self._chunks)
+		strings.append(StringFragment(string, 0, len(string)))
+		self._chunks = []
+		self._chunksLength = 0
+		self._pendingLength = None
+		return at + need
+
+
 	def getNewFrames(self, data):
 		# Keep in mind that this must work with 0-length strings.
 
 		# This should re-return TOO_LONG when more data is fed into it, if
 		# TOO_LONG was already returned.
 
-		# This function will sometimes unpack the prefix many times for
-		# the same string, depending on how many getNewFrames calls it
-		# takes to arrive.  struct.unpack is fast in CPython 2.7, so this
-		# doesn't matter.
-
-		self._buffer += data
-		pLen = self.prefixLength
-		lenBuffer = len(self._buffer)
+		# Strings that arrive entirely within one C{data} are
+		# StringFragments of C{data}.  A string that spans more than one
+		# call is kept as a list of pieces, and joined only when it is
+		# complete.  Its prefix is parsed only once.
 		strings = []
+		if self._tooLong:
+			return strings, TOO_LONG
+
 		at = 0
-		
-		while True:
-			if lenBuffer - at < pLen: # not enough to read next prefix?
-				break
-			at_pLen = at + pLen
-			length, = struct.unpack(self.structFormat, self._buffer[at:at_pLen])
-			if length > self.maxLength:
+		if self._chunks or self._pendingLength is not None:
+			at = self._continuePending(data, strings)
+			if at is None:
+				return strings, OK
+			if at == -1:
+				return self._fail(strings)
+
+		unpack_from = struct.unpack_from
+		structFormat = self.structFormat
+		pLen = self.prefixLength
+		m = self.maxLength
+		lenData = len(data)
+		while lenData - at >= pLen:
+			length, = unpack_from(structFormat, data, at)
+			if length > m:
 				##print "Too long", length
-				return strings, TOO_LONG
-			if lenBuffer - at < length + pLen: # not enough to read next string?
-				break
-			strings.append(StringFragment(self._buffer, at_pLen, length))
-			at = at_pLen + length # move to the right
-
-		# Because the StringFragment(s) point to the old _buffer, this may
-		# create a copy.
-		self._buffer = self._buffer[at:]
+				return self._fail(strings)
+			start = at + pLen
+			if lenData - start < length: # not enough to read the string?
+				self._pendingLength = length
+				if lenData > start:
+					self._chunks.append(data[start:])
+					self._chunksLength = lenData - start
+				return strings, OK
+			strings.append(StringFragment(data, start, length))
+			at = start + length
+
+		if at < lenData:
+			# A partial prefix
+			self._chunks.append(data[at:])
+			self._chunksLength = lenData - at
 		return strings, OK
 
 
@@ -177,6 +329,246 @@ class Int32StringDecoder(IntNStringDecoder):
 
 
 
+def _unmask(payload, mask):
+	"""
+	XOR C{payload} with the repeated 4-byte C{mask}.  This works on the
+	whole string at once, using Python longs.
+	"""
+	lenPayload = len(payload)
+	if not lenPayload:
+		return payload
+	key = (mask * ((lenPayload + 3) // 4))[:lenPayload]
+	unmasked = int(hexlify(payload), 16) ^ int(hexlify(key), 16)
+	return unhexlify('%0*x' % (lenPayload * 2, unmasked))
+
+
+
+class WebSocketDecoder(object):
+	"""
+	Decodes the client-to-server frames of an RFC 6455 WebSocket
+	connection, after the opening handshake is done.  Each complete text or
+	binary message becomes one L{strfrag.StringFragment}.
+
+	Pings are answered by appending encoded pong frames to C{replies}; the
+	owner of the decoder must write (and clear) them.  A close frame makes
+	L{getNewFrames} return C{CLOSED}.  Unmasked frames, reserved bits, and
+	unknown opcodes make it return C{INVALID}.
+	"""
+	OP_CONTINUATION, OP_TEXT, OP_BINARY = 0x0, 0x1, 0x2
+	OP_CLOSE, OP_PING, OP_PONG = 0x8, 0x9, 0xA
+
+	__slots__ = (
+		'maxLength', 'replies', '_headerBuffer', '_chunks', '_chunksLength',
+		'_frameLength', '_frameHeader', '_frameMask', '_message',
+		'_messageLength', '_error')
+
+	def __init__(self, maxLength):
+		self.maxLength = maxLength
+		# Encoded frames that must be written to the peer
+		self.replies = []
+		# An incomplete frame header (at most 13 bytes)
+		self._headerBuffer = ''
+		# Pieces of the payload of the frame being received
+		self._chunks = []
+		self._chunksLength = 0
+		# The payload length, first header byte, and mask of the frame
+		# being received, or None if we are waiting for a header
+		self._frameLength = None
+		self._frameHeader = None
+		self._frameMask = None
+		# Unmasked payloads of a fragmented message, or None
+		self._message = None
+		self._messageLength = 0
+		self._error = None
+
+
+	@classmethod
+	def _encodeFrame(cls, opcode, payload):
+		lenPayload = len(payload)
+		first = chr(0x80 | opcode)
+		if lenPayload < 126:
+			return first + chr(lenPayload) + payload
+		elif lenPayload < 65536:
+			return first + '\x7e' + struct.pack('!H', lenPayload) + payload
+		else:
+			return first + '\x7f' + struct.pack('!Q', lenPayload) + payload
+
+
+	@classmethod
+	def encode(cls, s):
+		"""
+		Encode a string into an unmasked WebSocket text frame.
+
+		@type s: C{str}
+		"""
+		return cls._encodeFrame(cls.OP_TEXT, s)
+
+
+	@classmethod
+	def encodeStringFrame(cls, s):
+		"""
+		Equivalent to C{cls.encode(s + ' ')}, the encoding of a StringFrame
+		for C{str} C{s}.
+		"""
+		return cls._encodeFrame(cls.OP_TEXT, s + ' ')
+
+
+	@classmethod
+	def encodeClose(cls):
+		"""
+		Return an unmasked WebSocket close frame with status 1000 (normal
+		closure).
+		"""
+		return cls._encodeFrame(cls.OP_CLOSE, '\x03\xe8')
+
+
+	def _fail(self, strings, code):
+		self._error = code
+		self._chunks = []
+		self._message = None
+		return strings, code
+
+
+	def _parseHeader(self, data, at):
+		"""
+		Parse a frame header starting at C{data[at]}.  Return the position
+		just after the header, C{None} if the header is incomplete, or a
+		negative error code.
+		"""
+		lenData = len(data)
+		if lenData - at < 2:
+			return None
+		first = ord(data[at])
+		second = ord(data[at + 1])
+		if not second & 0x80:
+			# Client-to-server frames must be masked.
+			return -INVALID
+		length = second & 0x7f
+		start = at + 2
+		if length == 126:
+			if lenData - start < 2:
+				return None
+			length, = struct.unpack_from('!H', data, start)
+			start += 2
+		elif length == 127:
+			if lenData - start < 8:
+				return None
+			length, = struct.unpack_from('!Q', data, start)
+			start += 8
+		if lenData - start < 4:
+			return None
+
+		opcode = first & 0x0f
+		if first & 0x70:
+			return -INVALID
+		if opcode >= self.OP_CLOSE:
+			# Control frames must not be fragmented or long.
+			if opcode > self.OP_PONG or not first & 0x80 or length > 125:
+				return -INVALID
+		elif opcode > self.OP_BINARY:
+			return -INVALID
+		elif length + self._messageLength > self.maxLength:
+			return -TOO_LONG
+
+		self._frameLength = length
+		self._frameHeader = first
+		self._frameMask = data[start:start + 4]
+		return start + 4
+
+
+	def _frameReceived(self, payload, strings):
+		"""
+		Handle a complete, unmasked frame payload.  Return C{OK} or an
+		error code.
+		"""
+		first = self._frameHeader
+		opcode = first & 0x0f
+		fin = first & 0x80
+		if opcode == self.OP_CONTINUATION:
+			if self._message is None:
+				return INVALID
+			self._message.append(payload)
+			self._messageLength += len(payload)
+			if fin:
+				message = ''.join(self._message)
+				strings.append(StringFragment(message, 0, len(message)))
+				self._message = None
+				self._messageLength = 0
+		elif opcode <= self.OP_BINARY:
+			if self._message is not None:
+				return INVALID
+			if fin:
+				strings.append(StringFragment(payload, 0, len(payload)))
+			else:
+				self._message = [payload]
+				self._messageLength = len(payload)
+		elif opcode == self.OP_CLOSE:
+			return CLOSED
+		elif opcode == self.OP_PING:
+			self.replies.append(self._encodeFrame(self.OP_PONG, payload))
+		# Unsolicited pongs are ignored.
+		return OK
+
+
+	def getNewFrames(self, data):
+		# This should re-return the error code when more data is fed into
+		# it, if an error code was already returned.
+		strings = []
+		if self._error is not None:
+			return strings, self._error
+
+		at = 0
+		lenData = len(data)
+		while True:
+			if self._frameLength is None:
+				if self._headerBuffer:
+					# A header is at most 14 bytes, so there is no need to
+					# copy more than that from data.
+					head = self._headerBuffer + data[:14]
+					end = self._parseHeader(head, 0)
+					if end is None:
+						self._headerBuffer = head
+						break
+					at = end - len(self._headerBuffer)
+					self._headerBuffer = ''
+				else:
+					if at == lenData:
+						break
+					end = self._parseHeader(data, at)
+					if end is None:
+						self._headerBuffer = data[at:]
+						break
+					at = end
+				if end < 0:
+					return self._fail(strings, -end)
+
+			# Keep the payload pieces in a list until the whole payload
+			# has arrived, so that a slowly-arriving frame is copied
+			# only once.
+			need = self._frameLength - self._chunksLength
+			if lenData - at < need:
+				if lenData > at:
+					self._chunks.append(data[at:] if at else data)
+					self._chunksLength += lenData - at
+				break
+			if self._chunks:
+				self._chunks.append(data[at:at + need])
+				payload = ''.join(self._chunks)
+				self._chunks = []
+				self._chunksLength = 0
+			else:
+				payload = data[at:at + need]
+			at += need
+			self._frameLength = None
+			code = self._frameReceived(
+				_unmask(payload, self._frameMask), strings)
+			if code != OK:
+				return self._fail(strings, code)
+
+		return strings, OK
+
+
+
 try: from refbinder.api import bindRecursive
 except ImportError: pass
 else: bindRecursive(sys.modules[__name__], _postImportVars)
@@ -51,6 +51,8 @@ class HelloFrameArguments(object):
 	succeedsTransport = 'eeds'
 	sack = 'sack'
 	lastSackSeenByClient = 'seenack'
+	rangedSack = 'rsack'
+	binaryStrings = 'bin'
 
 
 
@@ -70,6 +72,8 @@ Hello_useMyTcpAcks = _hfa.useMyTcpAcks
 Hello_succeedsTransport = _hfa.succeedsTransport
 Hello_sack = _hfa.sack
 Hello_lastSackSeenByClient = _hfa.lastSackSeenByClient
+Hello_rangedSack = _hfa.rangedSack
+Hello_binaryStrings = _hfa.binaryStrings
 del _hfa
 
 
@@ -210,6 +214,25 @@ def helloDataToHelloFrame(helloData):
 	except (TypeError, ValueError):
 		raise InvalidHello("bad maxOpenTime")
 
+	# rangedSack is optional.  If missing or False/0, client does not
+	# understand range-compressed SACK strings.
+	try:
+		obj.rangedSack = ensureBool( # e: ValueError
+			helloData[Hello_rangedSack]) if \
+			Hello_rangedSack in helloData else False
+	except ValueError:
+		raise InvalidHello("bad rangedSack")
+
+	# binaryStrings is optional.  If missing or False/0, strings are
+	# restricted strings.  If the HelloFrame creates a stream, this
+	# decides whether the stream's strings may contain any bytes.
+	try:
+		obj.binaryStrings = ensureBool( # e: ValueError
+			helloData[Hello_binaryStrings]) if \
+			Hello_binaryStrings in helloData else False
+	except ValueError:
+		raise InvalidHello("bad binaryStrings")
+
 	# maxInactivity is required.  If 0, no heartbeat.
 	# Time is in seconds.
 	try:
@@ -321,7 +344,7 @@ class StringFrame(tuple):
 
 
 	def encode(self):
-		return str(self.string) + ' '
+		return encodeStringFrame(self.string)
 
 
 
@@ -385,7 +408,7 @@ class SeqNumFrame(tuple):
 
 
 	def encode(self):
-		return '%dN' % self.seqNum
+		return encodeSeqNumFrame(self.seqNum)
 
 
 
@@ -394,25 +417,82 @@ class InvalidSackString(Exception):
 
 
 
+# The maximum number of sackNumbers that the ranges in a single SACK string
+# may expand to.  This prevents a peer from making us allocate a giant tuple
+# with a SACK string like "0-9007199254740992|-1".
+MAX_SACK_NUMBERS = 4096
+
+def _sackNumbersFromRange(s):
+	"""
+	C{s} is a C{str} like "4" or "4-7".  Returns a list of the sackNumbers.
+	"""
+	if '-' in s:
+		startStr, endStr = s.split('-', 1)
+		start = strToNonNegLimit(startStr, 2**53)
+		end = strToNonNegLimit(endStr, 2**53)
+		if end <= start or end - start >= MAX_SACK_NUMBERS:
+			raise ValueError("bad sack range %r" % (s,))
+		return range(start, end + 1)
+	return [strToNonNegLimit(s, 2**53)]
+
+
 def sackStringToSack(sackString):
 	"""
 	C{sackString} is a C{str}.  Returns a L{window.SACK}.
+
+	The sackList may be either in the plain form ("4,5,6,9") or in the
+	range-compressed form ("4-6,9").
 	"""
 	try:
 		# If not enough args for split, Python raises ValueError
 		joinedSackList, ackNumberStr = sackString.rsplit('|', 1)
 		ackNumber = strToIntInRange(ackNumberStr, -1, 2**53)
-		sackList = tuple(strToNonNegLimit(s, 2**53) for s in joinedSackList.split(',')) if joinedSackList else ()
+		if not joinedSackList:
+			sackList = ()
+		elif '-' not in joinedSackList:
+			sackList = tuple(strToNonNegLimit(s, 2**53) for s in joinedSackList.split(','))
+		else:
+			sackNumbers = []
+			for s in joinedSackList.split(','):
+				sackNumbers.extend(_sackNumbersFromRange(s))
+				if len(sackNumbers) > MAX_SACK_NUMBERS:
+					raise ValueError("too many sackNumbers")
+			sackList = tuple(sackNumbers)
 	except ValueError:
 		raise InvalidSackString("bad sack")
 	return SACK(ackNumber, sackList)
 
 
-def sackToSackString(sack):
+def _rangedSackList(sackList):
+	"""
+	C{sackList} is a sorted tuple of sackNumbers.  Returns a C{str} with
+	runs of consecutive sackNumbers compressed to "start-end".
+	"""
+	parts = []
+	it = iter(sackList)
+	start = end = next(it)
+	for n in it:
+		if n == end + 1:
+			end = n
+			continue
+		parts.append(str(start) if start == end else '%d-%d' % (start, end))
+		start = end = n
+	parts.append(str(start) if start == end else '%d-%d' % (start, end))
+	return ','.join(parts)
+
+
+def sackToSackString(sack, ranged=False):
 	"""
 	C{sack} is a L{window.SACK}.  Returns a C{str}.
+
+	If C{ranged} is truthy, runs of consecutive sackNumbers are written in the
+	range-compressed form understood by L{sackStringToSack}.  Use this only
+	if the peer said it understands it.
 	"""
-	return ','.join(str(s) for s in sack.sackList) + '|' + str(sack.ackNumber)
+	sackList = sack.sackList
+	if ranged and len(sackList) > 2:
+		return _rangedSackList(sackList) + '|' + str(sack.ackNumber)
+	return ','.join(str(s) for s in sackList) + '|' + str(sack.ackNumber)
 
 
 class SackFrame(tuple):
@@ -444,8 +524,8 @@ class SackFrame(tuple):
 			raise InvalidFrame("bad sackList or ackNumber")
 
 
-	def encode(self):
-		return sackToSackString(self.sack) + 'A'
+	def encode(self, ranged=False):
+		return encodeSackFrame(self.sack, ranged)
 
 
 
@@ -478,8 +558,8 @@ class StreamStatusFrame(tuple):
 			raise InvalidFrame("bad sackList or ackNumber")
 
 
-	def encode(self):
-		return sackToSackString(self.lastSackSeen) + 'T'
+	def encode(self, ranged=False):
+		return encodeStreamStatusFrame(self.lastSackSeen, ranged)
 
 
 
@@ -556,6 +636,76 @@ def isRestrictedString(string):
 	return not not RESTRICTED_STRING_RE.match(string)
 
 
+def areRestrictedStrings(strings):
+	"""
+	Return C{True} if every object in C{strings} is a C{str} and a
+	restricted string.  This checks all of the strings in one regular
+	expression match, so it is much faster than calling
+	L{isRestrictedString} on each one.
+
+	@param strings: The strings to validate.
+	@type strings: a sequence of C{str}s
+	"""
+	try:
+		joined = ''.join(strings)
+	except TypeError:
+		return False
+	# A unicode object anywhere makes the joined string unicode.
+	if not isinstance(joined, str):
+		return False
+	# Restricted strings joined together are a restricted string, and a
+	# non-restricted byte anywhere makes the joined string non-restricted.
+	return not not RESTRICTED_STRING_RE.match(joined)
+
+
+RESTRICTED_LINES_RE = re.compile(r"\A[ -~\n]*\Z")
+
+def areRestrictedLines(data):
+	"""
+	Return C{True} if newline-delimited C{data} contains only restricted
+	strings.  This lets a transport validate all of the strings in a
+	received buffer before splitting it.
+
+	@param data: The newline-delimited strings to validate.
+	@type data: C{str} or C{buffer}
+	"""
+	return not not RESTRICTED_LINES_RE.match(data)
+
+
+# Functions that encode frames directly from their arguments, without
+# constructing the frame object.  The send path in L{minerva.mserver} uses
+# these.
+
+def encodeStringFrame(string):
+	"""
+	Equivalent to C{StringFrame(string).encode()}.  C{string} is a C{str}
+	or L{StringFragment}.
+	"""
+	return str(string) + ' '
+
+
+def encodeSeqNumFrame(seqNum):
+	"""
+	Equivalent to C{SeqNumFrame(seqNum).encode()}.
+	"""
+	return '%dN' % seqNum
+
+
+def encodeSackFrame(sack, ranged=False):
+	"""
+	Equivalent to C{SackFrame(sack).encode(ranged)}.
+	"""
+	return sackToSackString(sack, ranged) + 'A'
+
+
+def encodeStreamStatusFrame(lastSackSeen, ranged=False):
+	"""
+	Equivalent to C{StreamStatusFrame(lastSackSeen).encode(ranged)}.
+	"""
+	return sackToSackString(lastSackSeen, ranged) + 'T'
+
+
+
 class ResetFrame(tuple):
 	"""
 	A reset frame indicates this side has given up on the stream.
@@ -99,7 +99,8 @@ class IStringProtocol(Interface):
 
 	def stringReceived(s):
 		"""
-		@param s: A restricted string from the peer.
+		@param s: A restricted string from the peer, or any C{str} if the
+			stream has C{binaryStrings}.
 		@type s: C{str}
 		"""
 	del stringReceived # Because it's optional.  TODO: Interface subclass?
@@ -207,10 +208,13 @@ class IQANProtocol(Interface):
 			is raised (or errbacked), the string value of the L{qan.KnownError}
 			will be sent as the error-answer.  If another exception is raised,
 			an uninformative unknown-error-answer will be sent to the peer.
+			To send a large answer in parts, return (or callback) a
+			L{qan.StreamingAnswer}; the peer must understand
+			L{qan.PartialAnswer}.
 		@type s: C{str}
 
 		@return: If C{isQuestion}, an answer to the question.
-		@rtype: C{str} or L{Deferred} or C{None}.
+		@rtype: C{str} or L{qan.StreamingAnswer} or L{Deferred} or C{None}.
 		@raise KnownError: When an error-answer is desired.
 		"""
 
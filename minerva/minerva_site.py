@@ -11,7 +11,7 @@ import simplejson
 from twisted.python import log
 from twisted.python.filepath import FilePath
 
-from minerva.mserver import StreamTracker, WebPort, ServerTransportFactory
+from minerva.mserver import StreamTracker, WebPort, ServerTransportFactory, broadcast
 
 from minerva.dumbtest.pages import DumbTestPage
 from minerva.chatapp.pages import ChatAppPage
@@ -222,9 +222,9 @@ class DemoProtocol(object):
 
 		elif s.startswith('broadcast:'):
 			text = s.split(':', 1)[1]
-			for c in self.factory.chatters:
-				# We assume text contains only characters in the " " - "~" range.
-				c.stream.sendString("TEXT|" + str(self._id) + '|' + text)
+			# We assume text contains only characters in the " " - "~" range.
+			broadcast("TEXT|" + str(self._id) + '|' + text,
+				[c.stream for c in self.factory.chatters])
 
 		else:
 			self.stream.sendString('unknown_message_type')
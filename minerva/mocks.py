@@ -13,7 +13,8 @@ from strfrag import StringFragment
 
 from minerva.window import SACK, Queue, Incoming
 from minerva.mserver import (
-	NoSuchStream, IStringProtocol, IStringFactory, StreamAlreadyExists)
+	NoSuchStream, IStringProtocol, IStringFactory, StreamAlreadyExists,
+	TransportTimers)
 from minerva.decoders import OK
 from minerva.frames import decodeFrameFromServer
 
@@ -53,9 +54,14 @@ class FrameDecodingTcpTransport(DummyTCPTransport):
 			StringFragment(f, 0, len(f)) if isinstance(f, str) else f) for f in frames)
 
 
+	def writeSequence(self, seq):
+		self.write(''.join(seq))
+
+
 
 class MockServerStream(object):
 	streamId = "a stream id of unusual length"
+	binaryStrings = False
 
 	def __init__(self, clock=None, streamId=None, streamProtocolFactory=None):
 		## if streamId is None: # make a random one?
@@ -340,6 +346,7 @@ class DummyStreamTracker(object):
 		self._clock = clock
 		self._streamProtocolFactory = streamProtocolFactory
 		self._streams = _streams
+		self.transportTimers = TransportTimers(clock)
 
 
 	def getStream(self, streamId):
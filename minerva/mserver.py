@@ -9,9 +9,14 @@ See minerva.test_mserver for the tests.
 
 import sys
 import re
+import base64
+import hashlib
 import time
+import zlib
+import heapq
 import operator
 from functools import partial
+from urlparse import urlparse
 
 from zope.interface import Attribute, implements
 
@@ -33,14 +38,16 @@ from webmagic.filecache import FileCache
 from minerva import decoders
 from minerva.objcheck import strToNonNegLimit
 from minerva.window import SACK, Queue, Incoming
-from minerva.qan import QANHelper, qanFrameToString, stringToQANFrame
+from minerva.qan import (
+	QANHelper, InvalidQANFrame, qanFrameToString, stringToQANFrame, encodeBatch)
 from minerva.mutils import htmldumps
 from minerva.interfaces import IConsumerWithoutWrite, IStringProtocol, IStringFactory
 from minerva.frames import (
-	HelloFrame, StringFrame, SeqNumFrame, SackFrame, StreamStatusFrame,
-	StreamCreatedFrame, YouCloseItFrame, ResetFrame, CommentFrame,
-	TransportKillFrame, InvalidFrame, decodeFrameFromClient,
-	isRestrictedString)
+	HelloFrame, SeqNumFrame, SackFrame, StreamCreatedFrame, YouCloseItFrame,
+	ResetFrame, CommentFrame, TransportKillFrame, InvalidFrame,
+	decodeFrameFromClient, encodeSeqNumFrame, encodeSackFrame,
+	encodeStreamStatusFrame, isRestrictedString, areRestrictedStrings,
+	areRestrictedLines, FORMAT_HTMLFILE)
 
 try:
 	from brequire import requireFile, requireFiles
@@ -66,6 +73,43 @@ def _callStringsOrStringReceived(proto, strings):
 			proto.stringReceived(str(s))
 
 
+def _validateRestrictedString(string):
+	if not isinstance(string, str):
+		raise TypeError("not a str: %r" % (string,))
+	if not isRestrictedString(string):
+		raise ValueError("String %r contains illegal characters.  "
+			"Only 0x20 (SPACE) - 0x7E (~) is allowed.  "
+			"Consider using JSON or Base64 encoding, or a stream "
+			"created with binaryStrings." % (string,))
+
+
+def _validateString(string, binaryStrings):
+	if binaryStrings:
+		if not isinstance(string, str):
+			raise TypeError("not a str: %r" % (string,))
+	else:
+		_validateRestrictedString(string)
+
+
+def _validateStrings(strings, binaryStrings):
+	"""
+	Like L{_validateString}, but for a list of strings.  The common case
+	where every string is valid is checked with one C{join}.
+	"""
+	if binaryStrings:
+		try:
+			joined = ''.join(strings)
+		except TypeError:
+			joined = None
+		if isinstance(joined, str):
+			return
+	elif areRestrictedStrings(strings):
+		return
+	# Find the bad string, to raise the usual exception.
+	for string in strings:
+		_validateString(string, binaryStrings)
+
+
 def _cancelDc(obj, attr):
 	dc = getattr(obj, attr)
 	if dc is not None:
@@ -180,15 +224,40 @@ class QANProtocolWrapper(object):
 	"""
 	implements(IStringProtocol)
 
-	def __init__(self, qanProtocol, validateBodies=True):
+	# If the application does not set either of the stream's send-queue
+	# high watermarks in its streamStarted, we set sendQueueHighBytes to
+	# this, so that a large L{qan.StreamingAnswer} waits for the peer's
+	# ACKs instead of piling up in the send queue.
+	defaultSendQueueHighBytes = 1024 * 1024 # bytes
+
+	def __init__(self, qanProtocol, validateBodies=True, clock=None,
+	maxInFlight=None, maxQueued=0, batchFrames=False):
 		"""
 		@param qanProtocol: An object that implements L{IQANProtocol}.
 		@param validateBodies: Validate locally-created bodies of questions
 			and answers?  Default C{True}.  Set to C{False} if you're
 			sure your application works correctly.
-		"""
+		@param clock: An L{IReactorTime} provider, passed to L{QANHelper}.
+			Required if you want to C{ask} questions with a C{timeout}.
+		@param maxInFlight: Passed to L{QANHelper}; limits how many of the
+			peer's Questions are answered at once.
+		@param maxQueued: Passed to L{QANHelper}; limits how many of the
+			peer's Questions wait for one of the C{maxInFlight} slots.
+		@param batchFrames: Send the QAN frames produced in the same
+			reactor iteration as one L{qan.Batch} string?  Default
+			C{False}.  Set to C{True} only if the peer understands
+			L{qan.Batch}.  Requires C{clock}.
+		"""
+		if batchFrames and clock is None:
+			raise ValueError("batchFrames requires a clock")
 		self.qanProtocol = qanProtocol
 		self._validateBodies = validateBodies
+		self._clock = clock
+		self._maxInFlight = maxInFlight
+		self._maxQueued = maxQueued
+		self._batchFrames = batchFrames
+		self._pendingFrameStrings = []
+		self._flushCall = None
 
 
 	def _logError(self, message, failure):
@@ -197,24 +266,60 @@ class QANProtocolWrapper(object):
 
 
 	def _sendQANFrame(self, qanFrame):
-		self.stream.sendString(qanFrameToString(qanFrame), self._validateBodies)
+		frameString = qanFrameToString(qanFrame)
+		if not self._batchFrames:
+			self.stream.sendString(frameString, self._validateBodies)
+			return
+		# Validate now, so that a bad body raises an exception in the
+		# caller of ask (or notify) instead of in _flushQANFrames.
+		if self._validateBodies:
+			_validateString(frameString, self.stream.binaryStrings)
+		self._pendingFrameStrings.append(frameString)
+		if self._flushCall is None:
+			self._flushCall = self._clock.callLater(0, self._flushQANFrames)
+
+
+	def _flushQANFrames(self):
+		self._flushCall = None
+		frameStrings = self._pendingFrameStrings
+		self._pendingFrameStrings = []
+		if len(frameStrings) == 1:
+			self.stream.sendString(frameStrings[0], False)
+		else:
+			self.stream.sendString(encodeBatch(frameStrings), False)
 
 
 	def _fatalError(self, reason):
 		self.stream.reset("QANHelper said: %s" % (reason,))
 
 
+	def _waitForSendQueue(self):
+		if self.stream.isSendQueueFull():
+			return self.stream.notifySendQueueDrained()
+		return None
+
+
 	def streamStarted(self, stream):
 		self.stream = stream
 		self.qanHelper = QANHelper(
 			self.qanProtocol.bodyReceived,
 			self._logError,
 			self._sendQANFrame,
-			self._fatalError)
+			self._fatalError,
+			self._clock,
+			self._maxInFlight,
+			self._maxQueued,
+			self._waitForSendQueue)
 		self.qanProtocol.streamStarted(self.stream, self.qanHelper)
+		if stream.sendQueueHighStrings is None and stream.sendQueueHighBytes is None:
+			stream.sendQueueHighBytes = self.defaultSendQueueHighBytes
 
 
 	def streamReset(self, reasonString, applicationLevel):
+		if self._flushCall is not None:
+			self._flushCall.cancel()
+			self._flushCall = None
+		self._pendingFrameStrings = []
 		self.qanHelper.failAll("Stream reset "
 			"applicationLevel=%r, reason: %s" % (applicationLevel, reasonString))
 		self.qanProtocol.streamReset(reasonString, applicationLevel)
@@ -275,9 +380,9 @@ class ServerStream(object):
 
 	The (incomplete) producer/consumer code here is designed to deal with
 	TCP bandwidth pressure (and "lack of any S2C transport" pressure).
-	It does not help with any kind of application-level pressure.
-	Applications that want high-volume streaming should implement an
-	application-level producer/consumer system.
+	It can also pause a push producer when too many strings are waiting
+	for the peer's ACK; see L{sendQueueHighStrings} and
+	L{sendQueueHighBytes}.
 	"""
 	# Don't implement IPushProducer or IPullProducer because we don't
 	# expect stopProducing.
@@ -291,7 +396,11 @@ class ServerStream(object):
 		'_primaryTransport', '_notifications', '_transports', '_sendSoonDc',
 		'disconnected', 'queue', '_incoming', '_pretendAcked', '_producer',
 		'_streamingProducer', '_primaryHasProducer', '_primaryPaused',
-		'lastSackSeenByServer', 'lastReceived', 'maxIdleTime')
+		'lastSackSeenByServer', 'lastReceived', 'maxIdleTime',
+		'sendQueueHighStrings', 'sendQueueHighBytes', 'sendQueueLowStrings',
+		'sendQueueLowBytes', '_queueFull', '_budgetPaused', '_memoryBudget',
+		'_streamTracker', '_idleDeadline', '_flushScheduler', 'binaryStrings',
+		'_drainedNotifications')
 
 	def __init__(self, clock, streamId, streamProtocolFactory):
 		self._clock = clock
@@ -327,6 +436,38 @@ class ServerStream(object):
 		# disconnect string on page unload.
 		self.maxIdleTime = 120 # seconds
 
+		# Send-queue flow control.  When the number of unacked strings in
+		# self.queue reaches sendQueueHighStrings, or their size reaches
+		# sendQueueHighBytes, the queue is "full": a registered push producer
+		# is paused, and trySendString returns False.  The queue stops being
+		# full when both are at or below their low watermarks.  A low
+		# watermark of None means half of the high watermark, and a high
+		# watermark of None means no limit.  You can change these; just
+		# make your protocol set these attributes in streamStarted.
+		self.sendQueueHighStrings = None # strings
+		self.sendQueueHighBytes = None # bytes
+		self.sendQueueLowStrings = None # strings
+		self.sendQueueLowBytes = None # bytes
+		self._queueFull = False
+		# Deferreds from notifySendQueueDrained
+		self._drainedNotifications = []
+
+		# Set by StreamTracker if it has a MemoryBudget
+		self._memoryBudget = None
+		self._budgetPaused = False
+
+		# Set by StreamTracker, which we tell when we have no transports
+		self._streamTracker = None
+		# The deadline StreamTracker has in its idle index for us, or None
+		self._idleDeadline = None
+		# Set by StreamTracker to its FlushScheduler.  If None, we schedule
+		# our own flushes.
+		self._flushScheduler = None
+
+		# If True, strings may contain any bytes.  Set by the transport
+		# whose HelloFrame created the stream.
+		self.binaryStrings = False
+
 
 	def __repr__(self):
 		return ('<%s streamId=%r, queue.getQueuedCount()=%d, disconnected=%r>' % (
@@ -334,8 +475,14 @@ class ServerStream(object):
 			self.streamId, self.queue.getQueuedCount(), self.disconnected))
 
 
-	def _tryToSend(self):
+	def _cancelSendSoon(self):
 		_cancelDc(self, '_sendSoonDc')
+		if self._flushScheduler is not None:
+			self._flushScheduler.unschedule(self)
+
+
+	def _tryToSend(self):
+		self._cancelSendSoon()
 
 		##print '_tryToSend', self, self._primaryTransport, self.queue
 		if self.queue.getQueuedCount() == 0:
@@ -348,14 +495,140 @@ class ServerStream(object):
 			# if you're interested in the crazy logic that was here before, to
 			# avoid calling writeStrings when not necessary.
 			self._primaryTransport.writeStrings(self.queue, start)
+			# The queue may now be holding encoded strings.
+			self._reportMemoryUsage()
 
 
 	def _tryToSendSoon(self):
-		if self._sendSoonDc is None:
+		if self._flushScheduler is not None:
+			self._flushScheduler.schedule(self)
+		elif self._sendSoonDc is None:
 			self._sendSoonDc = self._clock.callLater(
 				0.001, self._tryToSend)
 
 
+	def _aboveHighWatermark(self):
+		high = self.sendQueueHighStrings
+		if high is not None and self.queue.getQueuedCount() >= high:
+			return True
+		high = self.sendQueueHighBytes
+		if high is not None and self.queue.getMaxConsumption() >= high:
+			return True
+		return False
+
+
+	def _atOrBelowLowWatermark(self):
+		high = self.sendQueueHighStrings
+		if high is not None:
+			low = self.sendQueueLowStrings
+			if low is None:
+				low = high // 2
+			if self.queue.getQueuedCount() > low:
+				return False
+		high = self.sendQueueHighBytes
+		if high is not None:
+			low = self.sendQueueLowBytes
+			if low is None:
+				low = high // 2
+			if self.queue.getMaxConsumption() > low:
+				return False
+		return True
+
+
+	def _pausedByApp(self):
+		"""
+		Is there application-level pressure (a full send queue or an
+		exceeded L{MemoryBudget}) on this stream?
+		"""
+		return self._queueFull or self._budgetPaused
+
+
+	def _appPressureChanged(self, wasPaused):
+		"""
+		Pause or resume the push producer if application-level pressure
+		started or ended, unless it is already paused for another reason.
+		"""
+		nowPaused = self._pausedByApp()
+		if nowPaused != wasPaused and self._producer and \
+		self._streamingProducer and self._primaryTransport and \
+		not self._primaryPaused:
+			if nowPaused:
+				self._producer.pauseProducing()
+			else:
+				self._producer.resumeProducing()
+
+
+	def _checkQueueFull(self):
+		"""
+		Called after strings are added to the queue.  If it crossed a high
+		watermark, pause the push producer (if not already paused for
+		another reason).
+		"""
+		if not self._queueFull and self._aboveHighWatermark():
+			wasPaused = self._pausedByApp()
+			self._queueFull = True
+			self._appPressureChanged(wasPaused)
+
+
+	def _checkQueueDrained(self):
+		"""
+		Called after strings are removed from the queue.  If it is now
+		below the low watermarks, resume the push producer (unless it is
+		paused for another reason).
+		"""
+		if self._queueFull and self._atOrBelowLowWatermark():
+			wasPaused = self._pausedByApp()
+			self._queueFull = False
+			self._appPressureChanged(wasPaused)
+			notifications = self._drainedNotifications
+			self._drainedNotifications = []
+			for d in notifications:
+				d.callback(None)
+
+
+	def _setBudgetPaused(self, paused):
+		"""
+		Private.  Called by L{MemoryBudget} when its policy is
+		L{BUDGET_PAUSE_PRODUCERS}.
+		"""
+		wasPaused = self._pausedByApp()
+		self._budgetPaused = paused
+		self._appPressureChanged(wasPaused)
+
+
+	def _reportMemoryUsage(self):
+		"""
+		Tell our L{MemoryBudget} (if any) how many bytes our send queue and
+		receive window are using.
+		"""
+		if self._memoryBudget is not None:
+			self._memoryBudget.setStreamUsage(self,
+				self.queue.getMaxConsumption() + self._incoming.getMaxConsumption())
+
+
+	def isSendQueueFull(self):
+		"""
+		@return: whether the send queue has crossed a high watermark and
+			has not yet drained to the low watermarks.
+		@rtype: C{bool}
+		"""
+		return self._queueFull
+
+
+	def notifySendQueueDrained(self):
+		"""
+		@return: a Deferred that fires with C{None} when the send queue
+			is no longer full (see L{isSendQueueFull}); immediately if it is
+			not full now.  If the stream resets first, it never fires.
+		@rtype: L{defer.Deferred}
+		"""
+		if not self._queueFull:
+			return defer.succeed(None)
+		d = defer.Deferred()
+		self._drainedNotifications.append(d)
+		return d
+
+
 	def _fireNotifications(self):
 		for d in self._notifications:
 			d.callback(None)
@@ -364,13 +637,15 @@ class ServerStream(object):
 
 	def sendString(self, string, validate=True):
 		"""
-		Send string C{string} to the peer.  String MUST contain only
-		bytes in inclusive range 0x20 (SPACE) - 0x7E (~).  String is always
+		Send string C{string} to the peer.  Unless C{binaryStrings} is
+		C{True}, string MUST contain only bytes in inclusive range 0x20
+		(SPACE) - 0x7E (~).  String is always
 		queued for sending "very soon", so multiple calls will not lead to
 		redundant network activity.  (This is especially important for
 		long-polling transports, which close right after sending.)
 
-		@param string: a restricted string
+		@param string: a restricted string, or any C{str} if
+			C{binaryStrings}
 		@type string: C{str}
 
 		@param validate: Raise C{TypeError} or C{ValueError} if string is
@@ -379,27 +654,65 @@ class ServerStream(object):
 		@type validate: C{bool}
 		"""
 		if validate:
-			if not isinstance(string, str):
-				raise TypeError("not a str: %r" % (string,))
-			if not isRestrictedString(string):
-				raise ValueError("String %r contains illegal characters.  "
-					"Only 0x20 (SPACE) - 0x7E (~) is allowed.  "
-					"Consider using JSON or Base64 encoding." % (string,))
+			_validateString(string, self.binaryStrings)
 
 		if self.disconnected:
 			raise RuntimeError("Cannot sendString on disconnected %r" % (self,))
 
-		# We don't need to self._producer.pauseProducing() if queue is too
-		# big here, because:
-		# 1)	Active S2C transport are responsible for pausing if there
-		# 		is TCP pressure.
-		# 2)	If there is no active S2C transport, we already paused it.
-		# TODO: actually implement flow control if Queue is too big, since
-		# clients can resource-exhaust by never sending Minerva ACKs.
+		# Active S2C transports are responsible for pausing if there
+		# is TCP pressure, and if there is no active S2C transport, we
+		# already paused the producer.  But clients can resource-exhaust
+		# by never sending Minerva ACKs, so also check the watermarks.
 		self.queue.append(string)
+		self._checkQueueFull()
+		self._reportMemoryUsage()
 		self._tryToSendSoon()
 
 
+	def sendStrings(self, strings, validate=True):
+		"""
+		Send every string in C{strings} to the peer.  This is equivalent to
+		calling L{sendString} for each string, but faster, because the
+		strings are validated and queued all at once.  If any string is
+		invalid, no strings are queued.
+
+		@param strings: restricted strings, or any C{str}s if
+			C{binaryStrings}
+		@type strings: an iterable of C{str}s
+
+		@param validate: Raise C{TypeError} or C{ValueError} if any string
+			is not a C{str} and restricted string?  Default C{True}.
+		@type validate: C{bool}
+		"""
+		# strings may be a generator, which we need to iterate twice.
+		strings = list(strings)
+		if validate:
+			_validateStrings(strings, self.binaryStrings)
+
+		if self.disconnected:
+			raise RuntimeError("Cannot sendStrings on disconnected %r" % (self,))
+
+		self.queue.extend(strings)
+		self._checkQueueFull()
+		self._reportMemoryUsage()
+		self._tryToSendSoon()
+
+
+	def trySendString(self, string, validate=True):
+		"""
+		Like L{sendString}, but if the send queue is full (see
+		L{isSendQueueFull}), or the L{MemoryBudget} has paused this stream,
+		do not queue C{string} and return C{False}.
+
+		@return: C{True} if C{string} was queued, else C{False}.
+		@rtype: C{bool}
+		"""
+		if self._pausedByApp():
+			return False
+		self.sendString(string, validate)
+		return True
+
+
 	def _finishReset(self, reasonString, applicationLevel):
 		self._fireNotifications()
 		try:
@@ -426,7 +739,7 @@ class ServerStream(object):
 		"""
 		if self.disconnected:
 			raise RuntimeError("Cannot reset disconnected ServerStream %r" % (self,))
-		_cancelDc(self, '_sendSoonDc')
+		self._cancelSendSoon()
 		self.disconnected = True
 		# .copy() because _transports shrinks as transports call
 		# ServerStream.transportOffline
@@ -446,7 +759,7 @@ class ServerStream(object):
 		"""
 		if self.disconnected:
 			return
-		_cancelDc(self, '_sendSoonDc')
+		self._cancelSendSoon()
 		self.disconnected = True
 		# .copy() because _transports shrinks as transports call
 		# ServerStream.transportOffline
@@ -463,7 +776,7 @@ class ServerStream(object):
 		"""
 		if self.disconnected:
 			return
-		_cancelDc(self, '_sendSoonDc')
+		self._cancelSendSoon()
 		self.disconnected = True
 		# .copy() because _transports shrinks as transports call
 		# ServerStream.transportOffline
@@ -490,6 +803,7 @@ class ServerStream(object):
 
 		items, hitLimit = self._incoming.give(
 			pairs, self.maxUndeliveredStrings, self.maxUndeliveredBytes)
+		self._reportMemoryUsage()
 		if items:
 			try:
 				_callStringsOrStringReceived(self._protocol, items)
@@ -521,9 +835,13 @@ class ServerStream(object):
 
 		self.lastSackSeenByServer = sack
 
-		if self.queue.handleSACK(sack):
+		badSACK = self.queue.handleSACK(sack)
+		self._reportMemoryUsage()
+		if badSACK:
 			return True
 
+		self._checkQueueDrained()
+
 		if wasPretending is not None:
 			# Try to send, because the SACK may have indicated that the client
 			# lost strings that were delivered to the older active S2C transport.
@@ -608,6 +926,9 @@ class ServerStream(object):
 		except KeyError:
 			raise RuntimeError("Cannot take %r offline; it wasn't registered" % (transport,))
 
+		if not self._transports and self._streamTracker is not None:
+			self._streamTracker.streamIdle(self)
+
 		if transport is self._primaryTransport:
 			# Is this really needed? Why would a transport send signals after it is offline?
 			self._unregisterProducerOnPrimary()
@@ -661,15 +982,17 @@ class ServerStream(object):
 			self._unregisterProducerOnPrimary()
 			# If old primary transport paused us, our producer was paused, and this pause state
 			# is no longer relevant, so go back to resume.
-			if self._primaryPaused and self._producer and self._streamingProducer:
+			if self._primaryPaused and self._producer and self._streamingProducer and \
+			not self._pausedByApp():
 				self._producer.resumeProducing()
 			self._primaryPaused = False
 			# TODO: test that transport calls transportOffline right after this happens.
 			self._primaryTransport.closeGently()
 		else:
 			# There was no active S2C transport, so if we had a push
-			# producer, it was paused, and we need to unpause it.
-			if self._producer and self._streamingProducer:
+			# producer, it was paused, and we need to unpause it (unless
+			# the send queue is full).
+			if self._producer and self._streamingProducer and not self._pausedByApp():
 				self._producer.resumeProducing()
 			assert self._primaryPaused == False
 
@@ -734,7 +1057,8 @@ class ServerStream(object):
 		self._producer = producer
 		self._streamingProducer = streaming
 
-		if self._streamingProducer and (self._primaryPaused or not self._primaryTransport):
+		if self._streamingProducer and (
+		self._primaryPaused or not self._primaryTransport or self._pausedByApp()):
 			self._producer.pauseProducing()
 
 		if self._primaryTransport:
@@ -773,11 +1097,58 @@ class ServerStream(object):
 		We assume this is called only by the primary transport.
 		"""
 		self._primaryPaused = False
-		if self._producer:
+		if self._producer and not self._pausedByApp():
 			self._producer.resumeProducing()
 
 
 
+class _BroadcastString(str):
+	"""
+	A C{str} queued in many L{ServerStream}s.  C{encoded} maps a decoder
+	class to the string encoded as a L{StringFrame} by that decoder, so
+	that every L{ServerTransport} using the same wire format can reuse it.
+	"""
+	# No __slots__ because str subclasses cannot have non-empty __slots__
+
+	def __new__(cls, string):
+		self = str.__new__(cls, string)
+		self.encoded = {}
+		return self
+
+
+
+def broadcast(string, streams, validate=True):
+	"""
+	Send string C{string} to every L{ServerStream} in C{streams}.  This is
+	faster than calling C{sendString} on each stream, because C{string} is
+	validated once and encoded once per wire format.  Disconnected streams
+	are skipped.
+
+	@param string: a restricted string
+	@type string: C{str}
+
+	@param streams: the streams to send C{string} to
+	@type streams: an iterable of L{ServerStream}s
+
+	@param validate: Raise C{TypeError} or C{ValueError} if string is
+		not a C{str} and restricted string?  Default C{True}.
+	@type validate: C{bool}
+
+	@return: the number of streams C{string} was queued in
+	@rtype: C{int}
+	"""
+	if validate:
+		_validateRestrictedString(string)
+	shared = _BroadcastString(string)
+	count = 0
+	for stream in streams:
+		if not stream.disconnected:
+			stream.sendString(shared, validate=False)
+			count += 1
+	return count
+
+
+
 class NoSuchStream(Exception):
 	pass
 
@@ -788,35 +1159,450 @@ class StreamAlreadyExists(Exception):
 
 
 
+class FlushScheduler(object):
+	"""
+	Flushes the send queues of many L{ServerStream}s from one scheduled
+	call, instead of one L{IDelayedCall} per stream.  L{StreamTracker}
+	owns one of these and gives it to every stream it builds.
+
+	C{delay} is how many seconds to wait after the first stream becomes
+	dirty before flushing every dirty stream.  A larger delay trades
+	latency for fewer, larger writes.
+	"""
+	__slots__ = ('_clock', 'delay', '_dirty', '_flushDc')
+
+	def __init__(self, clock, delay=0.001):
+		self._clock = clock
+		self.delay = delay
+		self._dirty = set()
+		self._flushDc = None
+
+
+	def __repr__(self):
+		return '<%s delay=%r, dirty=%d>' % (
+			self.__class__.__name__, self.delay, len(self._dirty))
+
+
+	def schedule(self, stream):
+		"""
+		Private.  Called by L{ServerStream} when it has strings to send.
+		"""
+		self._dirty.add(stream)
+		if self._flushDc is None:
+			self._flushDc = self._clock.callLater(self.delay, self._flush)
+
+
+	def unschedule(self, stream):
+		"""
+		Private.  Called by L{ServerStream} when it no longer needs a flush.
+		"""
+		self._dirty.discard(stream)
+
+
+	def _flush(self):
+		self._flushDc = None
+		# Swap in a new set because _tryToSend may make streams dirty again.
+		dirty = self._dirty
+		self._dirty = set()
+		for stream in dirty:
+			try:
+				stream._tryToSend()
+			except Exception:
+				log.err(None, "Error while flushing %r" % (stream,))
+
+
+
+class TransportTimers(object):
+	"""
+	Heartbeat and maxOpenTime timers for many L{ServerTransport}s, driven
+	by one L{IDelayedCall}.  L{StreamTracker} owns one of these.
+
+	Deadlines are rounded down to a multiple of C{granularity} seconds,
+	so that transports with nearby deadlines share a bucket and are
+	handled in one pass.  A heartbeat or maxOpenTime close may therefore
+	happen up to C{granularity} seconds early, but never late.
+
+	Writing to a transport does not touch the timers; the transport only
+	records when it last wrote.  When a heartbeat bucket comes due, any
+	transport that wrote since it was bucketed is moved to a later bucket.
+	"""
+	__slots__ = (
+		'_clock', 'granularity', '_buckets', '_times', '_staleTimes',
+		'_wakeDc', '_wakeTime', '_waking')
+
+	def __init__(self, clock, granularity=1.0):
+		self._clock = clock
+		self.granularity = granularity
+		# A dict mapping bucket time->set of (transport, isHeartbeat)
+		self._buckets = {}
+		# A heap of bucket times.  May contain times of removed buckets.
+		self._times = []
+		self._staleTimes = 0
+		self._wakeDc = None
+		self._wakeTime = None
+		# True while _wake is handling buckets
+		self._waking = False
+
+
+	def __repr__(self):
+		return '<%s granularity=%r, buckets=%d>' % (
+			self.__class__.__name__, self.granularity, len(self._buckets))
+
+
+	def _bucketFor(self, deadline, notAfter):
+		g = self.granularity
+		if g:
+			bucket = deadline - deadline % g
+			# Don't round a deadline down to (or before) the time it was
+			# set at, or a short interval would fire over and over.
+			if bucket > notAfter:
+				return bucket
+		return deadline
+
+
+	def _scheduleWake(self, when):
+		_cancelDc(self, '_wakeDc')
+		self._wakeTime = when
+		self._wakeDc = self._clock.callLater(
+			max(0, when - self._clock.seconds()), self._wake)
+
+
+	def _add(self, when, entry):
+		bucket = self._buckets.get(when)
+		if bucket is None:
+			bucket = self._buckets[when] = set()
+			heapq.heappush(self._times, when)
+			if self._wakeTime is None or when < self._wakeTime:
+				self._scheduleWake(when)
+		bucket.add(entry)
+
+
+	def _discard(self, when, entry):
+		bucket = self._buckets.get(when)
+		# The bucket is missing if it is being handled right now.
+		if bucket is None:
+			return
+		bucket.discard(entry)
+		if not bucket:
+			del self._buckets[when]
+			self._staleTimes += 1
+			# _wake is popping from the heap, so leave it alone until
+			# _wake is done.
+			if not self._waking:
+				self._maybeCompact()
+
+
+	def _maybeCompact(self):
+		if self._staleTimes > 50 and self._staleTimes * 2 > len(self._times):
+			self._times = self._buckets.keys()
+			heapq.heapify(self._times)
+			self._staleTimes = 0
+
+
+	def addHeartbeat(self, transport):
+		"""
+		Private.  Called by L{ServerTransport} to make sure a heartbeat is
+		written C{transport._maxInactivity} seconds after
+		C{transport._lastWriteTime}.
+		"""
+		lastWrite = transport._lastWriteTime
+		when = self._bucketFor(lastWrite + transport._maxInactivity, lastWrite)
+		transport._heartbeatBucket = when
+		self._add(when, (transport, True))
+
+
+	def addMaxOpen(self, transport, seconds):
+		"""
+		Private.  Called by L{ServerTransport} to be closed in C{seconds}
+		seconds.
+		"""
+		now = self._clock.seconds()
+		when = self._bucketFor(now + seconds, now)
+		transport._maxOpenBucket = when
+		self._add(when, (transport, False))
+
+
+	def remove(self, transport):
+		"""
+		Private.  Called by L{ServerTransport} when it is terminating.
+		"""
+		when = transport._heartbeatBucket
+		if when is not None:
+			transport._heartbeatBucket = None
+			self._discard(when, (transport, True))
+		when = transport._maxOpenBucket
+		if when is not None:
+			transport._maxOpenBucket = None
+			self._discard(when, (transport, False))
+
+
+	def _wake(self):
+		self._wakeDc = None
+		self._wakeTime = None
+		times = self._times
+		now = self._clock.seconds()
+		self._waking = True
+		try:
+			self._handleDueBuckets(times, now)
+		finally:
+			self._waking = False
+		buckets = self._buckets
+		while times and times[0] not in buckets:
+			heapq.heappop(times)
+			self._staleTimes -= 1
+		self._maybeCompact()
+		times = self._times
+		# Handling a bucket may have scheduled a wake for a new bucket that
+		# is later than the earliest remaining one.
+		if not times:
+			_cancelDc(self, '_wakeDc')
+			self._wakeTime = None
+		elif times[0] != self._wakeTime:
+			self._scheduleWake(times[0])
+
+
+	def _handleDueBuckets(self, times, now):
+		while times and times[0] <= now:
+			when = heapq.heappop(times)
+			bucket = self._buckets.pop(when, None)
+			if bucket is None:
+				self._staleTimes -= 1
+				continue
+			for transport, isHeartbeat in bucket:
+				# Skip transports removed while this bucket is being handled.
+				if isHeartbeat:
+					if transport._heartbeatBucket != when:
+						continue
+					transport._heartbeatBucket = None
+					lastWrite = transport._lastWriteTime
+					if self._bucketFor(
+					lastWrite + transport._maxInactivity, lastWrite) <= now:
+						# This calls addHeartbeat again.
+						transport._writeHeartbeat()
+					else:
+						self.addHeartbeat(transport)
+				else:
+					if transport._maxOpenBucket != when:
+						continue
+					transport._maxOpenBucket = None
+					transport._exceededMaxOpenTime()
+
+
+
+class MemoryBudgetExceeded(Exception):
+	pass
+
+
+
+# Policies for MemoryBudget
+BUDGET_REFUSE_NEW, BUDGET_RESET_LARGEST, BUDGET_PAUSE_PRODUCERS = \
+	("BUDGET_REFUSE_NEW",), ("BUDGET_RESET_LARGEST",), ("BUDGET_PAUSE_PRODUCERS",)
+
+
+class MemoryBudget(object):
+	"""
+	Keeps track of how many bytes the send queues and receive windows of all
+	L{ServerStream}s in a L{StreamTracker} are using, and applies a policy
+	when the total goes over C{maxBytes}:
+
+	-	L{BUDGET_REFUSE_NEW}: L{StreamTracker.buildStream} raises
+		L{MemoryBudgetExceeded}, so new streams cannot be created.
+
+	-	L{BUDGET_RESET_LARGEST}: the streams using the most memory are reset
+		(soon, not reentrantly) until the total is at or below C{lowBytes}.
+
+	-	L{BUDGET_PAUSE_PRODUCERS}: every stream's push producer is paused
+		(and L{ServerStream.trySendString} returns C{False}) until the total
+		is at or below C{lowBytes}.
+
+	Streams report their usage every time it changes, so the total is
+	always up-to-date without scanning all the streams.  Use L{getUsage}
+	to monitor it.
+	"""
+	__slots__ = ('_clock', 'maxBytes', 'lowBytes', 'policy', '_usage',
+		'_used', '_paused', '_enforceDc')
+
+	def __init__(self, clock, maxBytes=None, policy=BUDGET_REFUSE_NEW, lowBytes=None):
+		"""
+		@param clock: an L{IReactorTime} provider.
+
+		@param maxBytes: the total number of bytes above which the policy
+			is applied, or C{None} for no limit.
+
+		@param policy: one of L{BUDGET_REFUSE_NEW}, L{BUDGET_RESET_LARGEST},
+			L{BUDGET_PAUSE_PRODUCERS}.
+
+		@param lowBytes: the total number of bytes at or below which
+			L{BUDGET_RESET_LARGEST} stops resetting streams and
+			L{BUDGET_PAUSE_PRODUCERS} resumes producers.  If C{None}, 90% of
+			C{maxBytes}.
+		"""
+		if policy not in (BUDGET_REFUSE_NEW, BUDGET_RESET_LARGEST, BUDGET_PAUSE_PRODUCERS):
+			raise ValueError("Unknown policy %r" % (policy,))
+		self._clock = clock
+		self.maxBytes = maxBytes
+		self.lowBytes = lowBytes if lowBytes is not None or maxBytes is None \
+			else maxBytes * 9 // 10
+		self.policy = policy
+		# A dict mapping ServerStream->bytes
+		self._usage = {}
+		self._used = 0
+		self._paused = False
+		self._enforceDc = None
+
+
+	def __repr__(self):
+		return '<%s used=%r, maxBytes=%r, policy=%r, streams=%d, paused=%r>' % (
+			self.__class__.__name__, self._used, self.maxBytes,
+			self.policy[0], len(self._usage), self._paused)
+
+
+	def getUsage(self):
+		"""
+		@return: the total number of bytes used by all streams.
+		@rtype: C{int}
+		"""
+		return self._used
+
+
+	def getStreamUsage(self, stream):
+		"""
+		@return: the number of bytes used by L{ServerStream} C{stream}.
+		@rtype: C{int}
+		"""
+		return self._usage.get(stream, 0)
+
+
+	def isExceeded(self):
+		"""
+		@return: whether the total usage is over C{maxBytes}.
+		@rtype: C{bool}
+		"""
+		return self.maxBytes is not None and self._used > self.maxBytes
+
+
+	def registerStream(self, stream):
+		"""
+		Private.  Called by L{StreamTracker} when it builds a stream.
+		"""
+		self._usage[stream] = 0
+		stream._memoryBudget = self
+		if self._paused:
+			stream._setBudgetPaused(True)
+
+
+	def unregisterStream(self, stream):
+		"""
+		Private.  Called by L{StreamTracker} when it forgets a stream.
+		"""
+		self._used -= self._usage.pop(stream, 0)
+		self._maybeUnpause()
+
+
+	def setStreamUsage(self, stream, usage):
+		"""
+		Private.  Called by L{ServerStream} when its usage may have changed.
+		"""
+		old = self._usage.get(stream)
+		if old is None or usage == old:
+			return
+		self._usage[stream] = usage
+		self._used += usage - old
+		if usage > old:
+			if self.isExceeded():
+				self._exceeded()
+		else:
+			self._maybeUnpause()
+
+
+	def _exceeded(self):
+		if self.policy is BUDGET_PAUSE_PRODUCERS:
+			if not self._paused:
+				self._paused = True
+				for stream in self._usage.keys():
+					stream._setBudgetPaused(True)
+		elif self.policy is BUDGET_RESET_LARGEST:
+			# Reset the streams later, because we might be underneath
+			# a ServerStream.sendString or stringsReceived call.
+			if self._enforceDc is None:
+				self._enforceDc = self._clock.callLater(0, self._resetLargest)
+
+
+	def _maybeUnpause(self):
+		if self._paused and self._used <= self.lowBytes:
+			self._paused = False
+			for stream in self._usage.keys():
+				stream._setBudgetPaused(False)
+
+
+	def _resetLargest(self):
+		self._enforceDc = None
+		if not self.isExceeded():
+			return
+		# This scan only happens when the budget is exceeded.
+		largest = sorted(self._usage.iteritems(),
+			key=operator.itemgetter(1), reverse=True)
+		for stream, usage in largest:
+			if self._used <= self.lowBytes or usage == 0:
+				break
+			log.msg("Memory budget exceeded (%d > %d bytes); resetting %r, "
+				"which uses %d bytes" % (self._used, self.maxBytes, stream, usage))
+			stream._internalReset("memory budget exceeded")
+			# Resetting the stream made StreamTracker unregister it, but in
+			# case this did not happen, stop counting it anyway.
+			self.unregisterStream(stream)
+
+
+
 class StreamTracker(object):
 	"""
 	L{StreamTracker} constructs and keeps track of L{ServerStream}s.
 	This is needed to get a reference to the right L{ServerStream} based on
 	the stream ID sent by the client.
 
-	L{StreamTracker} also disconnects inactive streams.
+	L{StreamTracker} also disconnects inactive streams.  To avoid looking
+	at every stream, it keeps a min-heap of (deadline, counter, stream) for
+	the streams that have no transports.  Entries are invalidated lazily:
+	a stream that got a new transport, or received something, or reset since
+	its entry was pushed is skipped or re-pushed when its entry comes due.
 
 	You do not want to subclass this.
 	"""
 	__slots__  = (
 		'_clock', '_streamProtocolFactory', '_inactiveCheckInterval',
-		'_streams', '_idleKiller')
+		'_streams', '_idleKiller', 'memoryBudget', '_idleHeap', '_idleCounter',
+		'flushScheduler', 'transportTimers')
 
 	stream = ServerStream
 
-	def __init__(self, clock, streamProtocolFactory, inactiveCheckInterval=60):
+	def __init__(self, clock, streamProtocolFactory, inactiveCheckInterval=60,
+	memoryBudget=None, flushDelay=0.001):
 		"""
 		C{clock} is an L{IReactorTime} provider.
 		C{streamProtocolFactory} is an L{IStringFactory} provider.
 		C{inactiveCheckInterval} is how many seconds between a check that
 			disconnect inactive Streams, or None, or no check is desired.  (With
 			no check, you'll need to call C{.disconnectInactive()} yourself.)
+		C{memoryBudget} is a L{MemoryBudget}, or None for a L{MemoryBudget}
+			with no limit (which still keeps track of the total usage).
+		C{flushDelay} is how many seconds a stream's new strings may wait
+			before being written.  Streams that get strings in the same
+			interval are flushed together.
 		"""
 		self._clock = clock
 		self._streamProtocolFactory = streamProtocolFactory
 		self._inactiveCheckInterval = inactiveCheckInterval
 		# A dict mapping streamId->ServerStream
 		self._streams = securedict()
+		if memoryBudget is None:
+			memoryBudget = MemoryBudget(clock)
+		self.memoryBudget = memoryBudget
+		# A heap of (deadline, counter, ServerStream) for streams that may
+		# be idle.  counter makes sure ServerStreams are never compared.
+		self._idleHeap = []
+		self._idleCounter = 0
+		self.flushScheduler = FlushScheduler(clock, flushDelay)
+		self.transportTimers = TransportTimers(clock)
 
 		if self._inactiveCheckInterval is not None:
 			self._idleKiller = LoopingCall(self.disconnectInactive)
@@ -836,9 +1622,19 @@ class StreamTracker(object):
 		if streamId in self._streams:
 			raise StreamAlreadyExists(
 				"cannot make stream with id %r because it already exists" % (streamId,))
+		budget = self.memoryBudget
+		if budget.policy is BUDGET_REFUSE_NEW and budget.isExceeded():
+			raise MemoryBudgetExceeded(
+				"cannot make stream with id %r because %r is exceeded" % (
+					streamId, budget))
 
 		s = self.stream(self._clock, streamId, self._streamProtocolFactory)
 		self._streams[streamId] = s
+		budget.registerStream(s)
+		s._streamTracker = self
+		s._flushScheduler = self.flushScheduler
+		# It has no transports yet, so it is already idle.
+		self.streamIdle(s)
 
 		d = s.notifyFinish()
 		d.addBoth(self._forgetStream, streamId)
@@ -846,21 +1642,50 @@ class StreamTracker(object):
 
 
 	def _forgetStream(self, _ignoredNone, streamId):
+		self.memoryBudget.unregisterStream(self._streams[streamId])
 		del self._streams[streamId]
 
 
+	def streamIdle(self, stream):
+		"""
+		Private.  Called by L{ServerStream} when it has no transports.
+		"""
+		deadline = stream.lastReceived + stream.maxIdleTime
+		# If the stream already has an entry that is due no later than this
+		# one, that entry will re-push the stream with its real deadline.
+		if stream._idleDeadline is not None and stream._idleDeadline <= deadline:
+			return
+		stream._idleDeadline = deadline
+		self._idleCounter += 1
+		heapq.heappush(self._idleHeap, (deadline, self._idleCounter, stream))
+
+
 	def disconnectInactive(self):
 		"""
 		Disconnect L{ServerStream}s that the client appears to have abandoned.
 		By default, this is called automatically every 60 seconds, so you do
 		not need to call it.
-		"""
-		# Make a "copy" with .values() because s.timedOut() below calls our
-		# self._forgetStream, which mutates self._streams.
-		for s in self._streams.values():
-			if not s._transports and (
-			s.lastReceived + s.maxIdleTime <= self._clock.seconds()):
+
+		This only looks at streams whose idle deadline has passed.
+		"""
+		heap = self._idleHeap
+		now = self._clock.seconds()
+		while heap and heap[0][0] <= now:
+			deadline, _, s = heapq.heappop(heap)
+			if s._idleDeadline != deadline:
+				# A newer, earlier entry replaced this one.
+				continue
+			s._idleDeadline = None
+			if s.disconnected or s._transports:
+				# It will be pushed again when it loses its transports.
+				continue
+			realDeadline = s.lastReceived + s.maxIdleTime
+			if realDeadline <= now:
+				# s.timedOut() calls our self._forgetStream.
 				s.timedOut()
+			else:
+				# It received something since its entry was pushed.
+				self.streamIdle(s)
 
 
 
@@ -982,9 +1807,11 @@ def _sanitizeHelloFrame(helloFrame, isHttp):
 
 
 # Acceptable protocol modes for ServerTransport to be in.
-# POLICYFILE and INT32 are for Flash Socket.
-UNKNOWN, POLICYFILE, INT32, HTTP = \
-	("UNKNOWN",), ("POLICYFILE",), ("INT32",), ("HTTP",)
+# POLICYFILE, INT32, and INT32_ZLIB are for Flash Socket.
+# WEBSOCKET is for connections upgraded by L{_WebSocketIo}.
+UNKNOWN, POLICYFILE, INT32, INT32_ZLIB, HTTP, WEBSOCKET = \
+	("UNKNOWN",), ("POLICYFILE",), ("INT32",), ("INT32_ZLIB",), ("HTTP",), \
+	("WEBSOCKET",)
 
 # HTTP_RESPONSE_PREAMBLE is sent as the first frame over HTTP transports.
 HTTP_RESPONSE_PREAMBLE = CommentFrame(";)]}")
@@ -1011,9 +1838,17 @@ class ServerTransport(object):
 		'streamId', 'transportNumber', 'factory', '_sackDirty',
 		'transport', '_maxReceiveBytes', '_maxOpenTime', '_callingStream',
 		'_lastSackSeenByClient', '_streamingResponse', '_needPaddingBytes',
-		'_wantsStrings', '_clock', '_maxOpenDc', '_maxInactivity', '_heartbeatDc')
+		'_wantsStrings', '_clock', '_maxInactivity', '_rangedSack',
+		'_lastWriteTime', '_heartbeatBucket', '_maxOpenBucket',
+		'_compressor', '_decompressor', '_bytesWritten', '_binaryStrings',
+		'_escapeStrings', '_stringsKnownRestricted', '_upgradeRequestHeaders')
 
 	maxLength = 1024*1024
+	# In INT32_ZLIB mode, received data is decompressed this many bytes at
+	# a time, and the frames in each piece are handled before the next
+	# piece is decompressed.  A zlib bomb is therefore limited by
+	# maxLength and the stream's receive window, like uncompressed data.
+	inflateChunkSize = 256*1024
 	noisy = True
 
 	def __init__(self, clock):
@@ -1024,7 +1859,8 @@ class ServerTransport(object):
 
 		# _initialBuffer buffers data while determining the mode
 		self._initialBuffer = ''
-		self._toSend = ''
+		# A list of encoded frames waiting to be written
+		self._toSend = []
 		self._sackDirty = False
 		self._terminating = False
 		self._callingStream = False
@@ -1036,6 +1872,22 @@ class ServerTransport(object):
 		self._peerSeqNum = -1
 
 		self._maxInactivity = None
+		# Set from the HelloFrame, for HTTP transports
+		self._maxReceiveBytes = 2**53
+		self._needPaddingBytes = 0
+		# The number of bytes written to an HTTP response
+		self._bytesWritten = 0
+		# Set from the stream's binaryStrings.  Binary strings are
+		# escaped over transports that are not length-prefixed.
+		self._binaryStrings = False
+		self._escapeStrings = False
+		# True if dataReceived already validated every string in the
+		# frames being processed.
+		self._stringsKnownRestricted = False
+		# For WEBSOCKET, the headers of the HTTP request that was upgraded
+		self._upgradeRequestHeaders = None
+		# Does the peer understand range-compressed SACK strings?
+		self._rangedSack = False
 		# _streamingResponse is False by default because client may fail
 		# to send a proper Hello frame in their HTTP request, and we don't
 		# want the request to get "stuck".
@@ -1044,8 +1896,14 @@ class ServerTransport(object):
 		self._producer = None
 		self._paused = False
 
-		self._maxOpenDc = None
-		self._heartbeatDc = None
+		# zlib contexts, used only in INT32_ZLIB mode
+		self._compressor = None
+		self._decompressor = None
+
+		# Used by the StreamTracker's TransportTimers
+		self._lastWriteTime = None
+		self._heartbeatBucket = None
+		self._maxOpenBucket = None
 
 
 	def __repr__(self):
@@ -1064,8 +1922,8 @@ class ServerTransport(object):
 
 	def _maybeWriteToPeer(self):
 		"""
-		Writes bytes in C{self._toSend} to the peer, and terminates the
-		transport if C{self._terminating} is truthy.
+		Writes the encoded frames in C{self._toSend} to the peer, and
+		terminates the transport if C{self._terminating} is truthy.
 		"""
 		if self._callingStream:
 			return
@@ -1076,29 +1934,59 @@ class ServerTransport(object):
 			self._writeTerminationFrames()
 			# Just in case we ever have a non-HTTP non-streamingResponse...
 			if self._mode != HTTP:
-				self._toSend += self._encodeFrame(YouCloseItFrame())
+				self._toSend.append(self._encodeFrame(YouCloseItFrame()))
 			self._terminating = True
 
 		toSend = self._toSend
 		if toSend:
-			self._toSend = ''
+			self._toSend = []
 			# Heartbeats are only sent when there's no S2C activity;
 			# Because we're sending something, reset the heartbeat DelayedCall.
 			self._resetHeartbeat()
 
-			if self._mode == HTTP and not self.writable.startedWriting:
-				encodedPreamble = self._encodeFrame(HTTP_RESPONSE_PREAMBLE)
-				if self._terminating:
-					headers = self.writable.responseHeaders
-					headers.setRawHeaders('content-length',
-						[str(len(encodedPreamble) + len(toSend))])
-				self.writable.write(encodedPreamble)
-
-			self.writable.write(toSend)
+			if self._mode == HTTP:
+				# Join the frames because each write to a Request may
+				# become an HTTP chunk.
+				toSend = ''.join(toSend)
+				if not self.writable.startedWriting:
+					encodedPreamble = self._encodeFrame(HTTP_RESPONSE_PREAMBLE)
+					if isinstance(self._parser, decoders.ScriptWrappedStringDecoder):
+						encodedPreamble = self._parser.responseHead + encodedPreamble
+					if self._streamingResponse and self._needPaddingBytes:
+						# Some proxies buffer a streaming response until
+						# enough bytes have arrived.
+						encodedPreamble += self._encodeFrame(
+							CommentFrame(' ' * self._needPaddingBytes))
+				else:
+					encodedPreamble = ''
+
+				self._bytesWritten += len(encodedPreamble) + len(toSend)
+				if not self._terminating and \
+				self._bytesWritten >= self._maxReceiveBytes:
+					# The client does not want its responseText to grow
+					# any larger, so finish the response.
+					self._writeTerminationFrames()
+					toSend += ''.join(self._toSend)
+					self._toSend = []
+					self._terminating = True
+
+				if encodedPreamble:
+					if self._terminating:
+						headers = self.writable.responseHeaders
+						headers.setRawHeaders('content-length',
+							[str(len(encodedPreamble) + len(toSend))])
+					self.writable.write(encodedPreamble)
+				self.writable.write(toSend)
+			elif self._compressor is not None:
+				compressor = self._compressor
+				self.writable.write(compressor.compress(''.join(toSend)) +
+					compressor.flush(zlib.Z_SYNC_FLUSH))
+			else:
+				self.writable.writeSequence(toSend)
 
 		if self._terminating:
-			_cancelDc(self, '_maxOpenDc')
-			_cancelDc(self, '_heartbeatDc')
+			if self._heartbeatBucket is not None or self._maxOpenBucket is not None:
+				self.factory.streamTracker.transportTimers.remove(self)
 
 			# Tell ServerStream this transport is offline.  Whether we
 			# still have a TCP connection open to the peer is irrelevant.
@@ -1139,17 +2027,17 @@ class ServerTransport(object):
 			#     new primary with an up-to-date lastSackSeenByClient.
 			self._appendSack()
 
-			self._toSend += self._encodeFrame(StreamStatusFrame(
-				self._stream.lastSackSeenByServer))
+			self._toSend.append(self._parser.encode(encodeStreamStatusFrame(
+				self._stream.lastSackSeenByServer, self._rangedSack)))
 
 
 	def _closeWith(self, reason):
 		assert not self._terminating, self
 
 		self._writeTerminationFrames()
-		self._toSend += self._encodeFrame(TransportKillFrame(reason))
+		self._toSend.append(self._encodeFrame(TransportKillFrame(reason)))
 		if self._mode != HTTP:
-			self._toSend += self._encodeFrame(YouCloseItFrame())
+			self._toSend.append(self._encodeFrame(YouCloseItFrame()))
 		self._terminating = True
 		self._maybeWriteToPeer()
 
@@ -1162,7 +2050,7 @@ class ServerTransport(object):
 
 		self._writeTerminationFrames()
 		if self._mode != HTTP:
-			self._toSend += self._encodeFrame(YouCloseItFrame())
+			self._toSend.append(self._encodeFrame(YouCloseItFrame()))
 		self._terminating = True
 		self._maybeWriteToPeer()
 
@@ -1185,9 +2073,10 @@ class ServerTransport(object):
 			self._appendSack()
 
 		# Because it's a reset, there's no need to send a StreamStatusFrame
-		self._toSend += self._encodeFrame(ResetFrame(reasonString, applicationLevel))
+		self._toSend.append(
+			self._encodeFrame(ResetFrame(reasonString, applicationLevel)))
 		if self._mode != HTTP:
-			self._toSend += self._encodeFrame(YouCloseItFrame())
+			self._toSend.append(self._encodeFrame(YouCloseItFrame()))
 		self._terminating = True
 		self._maybeWriteToPeer()
 
@@ -1214,23 +2103,62 @@ class ServerTransport(object):
 			self._lastStartParam = start
 
 		queueStart = max(start, self.ourSeqNum + 1)
+		# The queue keeps the encoded StringFrames, so writing the same
+		# strings again over a new transport does not encode them again.
+		encodedItems = queue.getEncodedItems(
+			queueStart, self._stringEncodingKey(), self._encodeStringFrame)
 		# Even if there's a lot of stuff in the queue, write everything.
-		for seqNum, string in queue.iterItems(queueStart):
-			##print seqNum, string, self.ourSeqNum
+		for seqNum, encoded in encodedItems:
+			##print seqNum, encoded, self.ourSeqNum
 			if self.ourSeqNum == -1 or self.ourSeqNum + 1 != seqNum:
-				self._toSend += self._encodeFrame(SeqNumFrame(seqNum))
-			self._toSend += self._encodeFrame(StringFrame(string))
+				self._toSend.append(
+					self._parser.encode(encodeSeqNumFrame(seqNum)))
+			self._toSend.append(encoded)
 			self.ourSeqNum = seqNum
 		self._maybeWriteToPeer()
 
 
+	def _stringEncodingKey(self):
+		"""
+		Return a key that is the same for every transport that encodes
+		StringFrames the same way.
+		"""
+		if self._escapeStrings:
+			return (self._parser.__class__, 'string_escape')
+		return self._parser.__class__
+
+
+	def _encodeStringFrame(self, string):
+		"""
+		Equivalent to C{self._encodeFrame(StringFrame(string))}, but
+		reuses the encoding of a L{_BroadcastString} done by another
+		transport.
+		"""
+		if isinstance(string, _BroadcastString):
+			key = self._stringEncodingKey()
+			encoded = string.encoded.get(key)
+			if encoded is None:
+				encoded = string.encoded[key] = self._parser.encodeStringFrame(
+					self._escapeIfNeeded(string))
+			return encoded
+		return self._parser.encodeStringFrame(self._escapeIfNeeded(string))
+
+
+	def _escapeIfNeeded(self, string):
+		# string_escape output only has bytes 0x20-0x7E, so it can be
+		# sent over HTTP and WebSocket.
+		if self._escapeStrings:
+			return string.encode('string_escape')
+		return string
+
+
 	def _exceededMaxOpenTime(self):
 		if self._stream is not None: # isAttached?
 			self.closeGently()
 
 
 	def _appendHeartbeat(self):
-		self._toSend += self._encodeFrame(CommentFrame('beat'))
+		self._toSend.append(self._encodeFrame(CommentFrame('beat')))
 
 
 	def _writeHeartbeat(self):
@@ -1240,12 +2168,13 @@ class ServerTransport(object):
 
 
 	def _resetHeartbeat(self):
-		_cancelDc(self, '_heartbeatDc')
-
 		# Could be None if no HelloFrame, or 0 if HelloFrame received.
 		if self._maxInactivity:
-			self._heartbeatDc = self._clock.callLater(
-				self._maxInactivity, self._writeHeartbeat)
+			self._lastWriteTime = self._clock.seconds()
+			# If the transport is already in a heartbeat bucket,
+			# TransportTimers will notice the new _lastWriteTime.
+			if self._heartbeatBucket is None:
+				self.factory.streamTracker.transportTimers.addHeartbeat(self)
 
 
 	def _writeInitialFrames(self, stream, requestNewStream):
@@ -1256,7 +2185,7 @@ class ServerTransport(object):
 			# we send.  If we send something else like a SackFrame first, and
 			# transport abruptly disconnects after that frame, client may get
 			# into an inconsistent state.
-			self._toSend += self._encodeFrame(StreamCreatedFrame())
+			self._toSend.append(self._encodeFrame(StreamCreatedFrame()))
 
 		# Write the initial SACK if we have not already written a SACK,
 		# but only if the client has an out-of-date impression of the SACK.
@@ -1265,14 +2194,16 @@ class ServerTransport(object):
 		if self._lastSackSeenByClient is not DontWriteSack:
 			currentSack = stream.getSACK()
 			if currentSack != self._lastSackSeenByClient:
-				self._toSend += self._encodeFrame(SackFrame(currentSack))
+				self._toSend.append(self._parser.encode(
+					encodeSackFrame(currentSack, self._rangedSack)))
 
 
 	def _handleHelloFrame(self, hello, moreFrames):
 		"""
 		C{hello} is a L{HelloFrame}.  If a stream with the streamId in the
 		HelloFrame does not exist (and requestNewStream is falsy), raises
-		L{NoSuchStream}.
+		L{NoSuchStream}.  If the stream cannot be created because the
+		L{MemoryBudget} is exceeded, raises L{MemoryBudgetExceeded}.
 		"""
 		_sanitizeHelloFrame(hello, self._mode == HTTP)
 
@@ -1283,14 +2214,22 @@ class ServerTransport(object):
 		self._maxInactivity = hello.maxInactivity
 		self._lastSackSeenByClient = hello.lastSackSeenByClient
 		self._wantsStrings = hello.wantsStrings()
+		self._rangedSack = hello.rangedSack
 
 		if self._mode == HTTP:
+			if hello.httpFormat == FORMAT_HTMLFILE:
+				# The request body was already decoded, so the parser is
+				# now used only to encode the response.
+				self._parser = decoders.ScriptWrappedStringDecoder(
+					maxLength=self.maxLength)
+				self.writable.responseHeaders.setRawHeaders(
+					'content-type', ['text/html; charset=UTF-8'])
 			self._needPaddingBytes = hello.needPaddingBytes
 			self._maxReceiveBytes = hello.maxReceiveBytes
 			self._maxOpenTime = hello.maxOpenTime
 			if self._maxOpenTime is not None:
-				self._maxOpenDc = self._clock.callLater(
-					self._maxOpenTime, self._exceededMaxOpenTime)
+				self.factory.streamTracker.transportTimers.addMaxOpen(
+					self, self._maxOpenTime)
 
 		# Note that requestNewStream=True doesn't always imply that a
 		# new stream will actually be created.
@@ -1299,11 +2238,18 @@ class ServerTransport(object):
 				stream = self.factory.streamTracker.buildStream(self.streamId)
 			except StreamAlreadyExists:
 				stream = self.factory.streamTracker.getStream(self.streamId)
+			else:
+				stream.binaryStrings = hello.binaryStrings
 		else:
 			stream = self.factory.streamTracker.getStream(self.streamId)
 		# Above .getStream(...) calls may raise NoSuchStream, which is
 		# caught by our caller.
 
+		# The stream decides, not this HelloFrame.
+		self._binaryStrings = stream.binaryStrings
+		self._escapeStrings = \
+			self._binaryStrings and self._mode not in (INT32, INT32_ZLIB)
+
 		self._writeInitialFrames(stream, hello.requestNewStream)
 		if hello.sack is not None:
 			# Call sackReceived before transportOnline:
@@ -1354,53 +2300,103 @@ class ServerTransport(object):
 		"""
 		Append a SackFrame to the internal send buffer.
 		"""
-		self._toSend += self._encodeFrame(SackFrame(self._stream.getSACK()))
+		self._toSend.append(self._parser.encode(
+			encodeSackFrame(self._stream.getSACK(), self._rangedSack)))
 		self._sackDirty = False
 		# We no longer need to write the "initial SACK" to client
 		self._lastSackSeenByClient = DontWriteSack
 
 
-	def _framesReceived(self, frames):
-		nonlocal = dict(bunchedStrings=[])
-		def handleStrings():
-			# bunchedStrings is already sorted 99.99%+ of the time, so this
-			# sort is particularly fast with Timsort.
-			nonlocal['bunchedStrings'].sort()
-
-			# The _sackDirty behavior in this class reduces the number
-			# of SackFrames that are written out, while making sure that
-			# SackFrames are not "held up" by StringFrames written out by
-			# ServerStream.  If ServerStream writes strings during the
-			# ServerStream.stringsReceived call below, a SackFrame is
-			# sent before the StringFrames.
-			assert not self._sackDirty, self
-			self._sackDirty = True
-			self._callingStream = True
-			try:
-				self._stream.stringsReceived(self, nonlocal['bunchedStrings'])
-			finally:
-				self._callingStream = False
-			# Remember that a lot can happen underneath that stringsReceived call,
-			# including a call to our own `reset` or `closeGently` or `writeStrings`.
+	def _deliverStrings(self, bunch, writeSack=True):
+		"""
+		Give the (seqNum, string) pairs in C{bunch} to the stream.  If
+		C{writeSack} is false, leave the SackFrame to the caller.
+		"""
+		# bunch is already sorted 99.99%+ of the time, so this
+		# sort is particularly fast with Timsort.
+		bunch.sort()
 
-			nonlocal['bunchedStrings'] = []
+		# The _sackDirty behavior in this class reduces the number
+		# of SackFrames that are written out, while making sure that
+		# SackFrames are not "held up" by StringFrames written out by
+		# ServerStream.  If ServerStream writes strings during the
+		# ServerStream.stringsReceived call below, a SackFrame is
+		# sent before the StringFrames.
+		assert not self._sackDirty, self
+		self._sackDirty = True
+		self._callingStream = True
+		try:
+			self._stream.stringsReceived(self, bunch)
+		finally:
+			self._callingStream = False
+		# Remember that a lot can happen underneath that stringsReceived call,
+		# including a call to our own `reset` or `closeGently` or `writeStrings`.
+
+		if writeSack and not self._terminating and self._sackDirty:
+			self._appendSack()
+
+
+	def _killAfterStrings(self, bunch, reason):
+		# Deliver the strings received before the bad frame first.  Don't
+		# write a SackFrame for them, because _closeWith writes one.
+		if bunch:
+			self._deliverStrings(bunch, False)
+		if not self._terminating:
+			self._closeWith(reason)
 
-			if not self._terminating and self._sackDirty:
-				self._appendSack()
+
+	def _framesReceived(self, frames):
+		# Because we may have received multiple Minerva strings,
+		# collect them into a list and then deliver them all at
+		# once to ServerStream.  This does not add any latency;
+		# it just reduces the number of funcalls.
+		bunch = []
+		escapeStrings = self._escapeStrings
+		checkStrings = not (self._binaryStrings or self._stringsKnownRestricted)
 
 		for frameString in frames:
 			if self._terminating:
 				return
 			self.receivedCounter += 1
 
-			if isinstance(frameString, str):
+			if frameString.__class__ is str:
 				frameString = StringFragment(frameString, 0, len(frameString))
 
+			# Fast path for StringFrames, which are by far the most common
+			# frames: recognize the trailing " " here instead of making a
+			# StringFrame with decodeFrameFromClient.  The first frame must
+			# be a HelloFrame, so leave it to the general path.
+			size = frameString.size - 1
+			if size >= 0 and self.receivedCounter:
+				backing = frameString._string
+				pos = frameString._pos
+				if backing[pos + size] == ' ':
+					string = StringFragment(backing, pos, size)
+					if escapeStrings:
+						try:
+							string = str(string).decode('string_escape')
+						except ValueError:
+							self._killAfterStrings(
+								bunch, tk_invalid_frame_type_or_arguments)
+							break
+						string = StringFragment(string, 0, len(string))
+					elif checkStrings:
+						# Make sure the string only contains bytes in the
+						# restricted string range.
+						if not isRestrictedString(buffer(backing, pos, size)):
+							self._killAfterStrings(
+								bunch, tk_invalid_frame_type_or_arguments)
+							break
+
+					self._peerSeqNum += 1
+					bunch.append((self._peerSeqNum, string))
+					continue
+
 			try:
 				frame = decodeFrameFromClient(frameString)
 			except InvalidFrame:
 				##log.err()
-				self._closeWith(tk_invalid_frame_type_or_arguments)
+				self._killAfterStrings(bunch, tk_invalid_frame_type_or_arguments)
 				break
 
 			frameType = frame.__class__
@@ -1411,65 +2407,47 @@ class ServerTransport(object):
 				if frameType == HelloFrame:
 					try:
 						self._handleHelloFrame(frame, frames[1:])
-					except NoSuchStream:
-						self._closeWith(tk_stream_attach_failure)
+					except (NoSuchStream, MemoryBudgetExceeded):
+						self._killAfterStrings(bunch, tk_stream_attach_failure)
 						break
 					# break because self._framesReceived(frames[1:])
 					# processes the remaining frames.
 					break
 				else:
-					self._closeWith(tk_invalid_frame_type_or_arguments)
-					break
-
-			elif frameType == StringFrame:
-				# Make sure the string only contains bytes in the restricted
-				# string range.  In the future, we could support dynamic
-				# switching to strings that allow a wider byte/char range.
-				if not isRestrictedString(frame.string.as_buffer()):
-					self._closeWith(tk_invalid_frame_type_or_arguments)
+					self._killAfterStrings(bunch, tk_invalid_frame_type_or_arguments)
 					break
 
-				self._peerSeqNum += 1
-				# Because we may have received multiple Minerva strings,
-				# collect them into a list and then deliver them all at
-				# once to ServerStream.  This does not add any latency;
-				# it just reduces the number of funcalls.
-				nonlocal['bunchedStrings'].append((self._peerSeqNum, frame.string))
-
 			elif frameType == SackFrame:
 				self._callingStream = True
 				badSack = self._stream.sackReceived(frame.sack)
 				self._callingStream = False
 				if badSack:
 					# It was a bad SACK, so close.
-					self._closeWith(tk_acked_unsent_strings)
+					self._killAfterStrings(bunch, tk_acked_unsent_strings)
 					break
 
 			elif frameType == SeqNumFrame:
 				self._peerSeqNum = frame.seqNum - 1
 
-			else:
+			elif frameType == ResetFrame:
 				# Deliver the strings before processing client's reset frame.  This
 				# is an implementation detail that may change.
-				if nonlocal['bunchedStrings']:
-					handleStrings()
-
-				if frameType == ResetFrame:
-					self._callingStream = True
-					self._stream.resetFromPeer(
-						frame.reasonString, frame.applicationLevel)
-					self._callingStream = False
-					break # No need to process any frames after the reset frame
+				if bunch:
+					self._deliverStrings(bunch)
+					bunch = []
 
-				else:
-					self._closeWith(tk_invalid_frame_type_or_arguments)
-					break
+				self._callingStream = True
+				self._stream.resetFromPeer(
+					frame.reasonString, frame.applicationLevel)
+				self._callingStream = False
+				break # No need to process any frames after the reset frame
 
-		# TODO: add test to ensure that we successfully process bunchedStrings
-		# before transport-killing due to a bad frame.
+			else:
+				self._killAfterStrings(bunch, tk_invalid_frame_type_or_arguments)
+				break
 
-		if nonlocal['bunchedStrings']:
-			handleStrings()
+		if bunch and not self._terminating:
+			self._deliverStrings(bunch)
 		self._maybeWriteToPeer()
 
 
@@ -1508,7 +2486,17 @@ class ServerTransport(object):
 				del self._initialBuffer
 				self._parser = decoders.Int32StringDecoder(
 					maxLength=self.maxLength)
-			# TODO: implement <int32-zlib/> but beware of zlib bombs
+
+			elif self._initialBuffer.startswith('<int32-zlib/>\n'):
+				# Like INT32, but both directions are a zlib stream,
+				# sync-flushed after every write.
+				self._mode = INT32_ZLIB
+				frameData = self._initialBuffer[len('<int32-zlib/>\n'):]
+				del self._initialBuffer
+				self._parser = decoders.Int32StringDecoder(
+					maxLength=self.maxLength)
+				self._compressor = zlib.compressobj()
+				self._decompressor = zlib.decompressobj()
 
 			# We need far less than 512, but stay on the safe side.
 			elif len(self._initialBuffer) >= 512:
@@ -1531,12 +2519,42 @@ class ServerTransport(object):
 		else:
 			frameData = data
 
-		out, code = self._parser.getNewFrames(frameData)
-		if code == decoders.OK:
-			##print out
-			self._framesReceived(out)
+		if self._decompressor is None:
+			pieces = (frameData,)
 		else:
-			self._closeWith(tk_frame_corruption)
+			pieces = self._inflate(frameData)
+
+		for frameData in pieces:
+			if frameData is None:
+				self._closeWith(tk_frame_corruption)
+				break
+
+			out, code = self._parser.getNewFrames(frameData)
+			if code == decoders.OK:
+				##print out
+				if self._mode == HTTP:
+					# Validate all of the newline-delimited strings in one
+					# pass, instead of once per StringFrame.
+					self._stringsKnownRestricted = areRestrictedLines(frameData)
+				self._framesReceived(out)
+				self._stringsKnownRestricted = False
+			elif code == decoders.CLOSED:
+				self._framesReceived(out)
+				self._webSocketClosed()
+				return
+			else:
+				self._closeWith(tk_frame_corruption)
+
+			if self._mode == WEBSOCKET:
+				# Pongs are not Minerva frames, so they bypass _toSend.
+				replies = self._parser.replies
+				if replies:
+					self.writable.writeSequence(replies)
+					del replies[:]
+
+			if self._terminating:
+				# Don't decompress the rest.
+				break
 
 		if self._stream:
 			self._stream.lastReceived = self._clock.seconds()
@@ -1544,6 +2562,46 @@ class ServerTransport(object):
 		self._maybeWriteToPeer()
 
 
+	def _webSocketClosed(self):
+		"""
+		The peer sent a WebSocket close frame.  Finish up like
+		L{closeGently}, then answer with our own close frame and close the
+		TCP connection.
+		"""
+		if not self._terminating:
+			if self._stream is not None:
+				self.closeGently()
+			else:
+				self._terminating = True
+				self._maybeWriteToPeer()
+		self.writable.write(decoders.WebSocketDecoder.encodeClose())
+		self.writable.loseConnection()
+
+
+	def _inflate(self, data):
+		"""
+		Decompress C{data} received in INT32_ZLIB mode.  Yield the
+		decompressed data in pieces of at most C{inflateChunkSize} bytes,
+		decompressing each piece only when the previous one has been
+		handled.  Yield C{None} if C{data} is not valid zlib data.
+		"""
+		limit = self.inflateChunkSize
+		decompressor = self._decompressor
+		while True:
+			try:
+				out = decompressor.decompress(data, limit)
+			except zlib.error:
+				yield None
+				return
+			data = decompressor.unconsumed_tail
+			if out:
+				yield out
+			# If the output filled the limit, zlib may have more output
+			# even though all of the input was consumed.
+			if not data and len(out) < limit:
+				return
+
+
 	# called by ServerStream
 	def registerProducer(self, producer, streaming):
 		if self._producer:
@@ -1655,6 +2713,15 @@ class ServerTransport(object):
 		self._handleRequestBody()
 
 
+	# Called by _WebSocketIo, after makeConnection
+	def webSocketStarted(self, requestHeaders=None):
+		assert self._mode == UNKNOWN, self._mode
+		self._mode = WEBSOCKET
+		self._upgradeRequestHeaders = requestHeaders
+		del self._initialBuffer
+		self._parser = decoders.WebSocketDecoder(maxLength=self.maxLength)
+
+
 	# Called by twisted.web if client closes connection before the request is finished
 	def requestAborted(self, reason):
 		if self.noisy:
@@ -1722,7 +2789,8 @@ class ServerTransport(object):
 			streamingToPeer=self.isStreamingToPeer(),
 			host=self.getHost(),
 			requestHeaders=\
-				self.writable.requestHeaders if self.isHttp() else None)
+				self.writable.requestHeaders if self.isHttp() else
+				self._upgradeRequestHeaders)
 
 
 
@@ -1863,6 +2931,127 @@ class _HttpIo(BetterResource):
 
 
 
+def _getHeader(request, name):
+	values = request.requestHeaders.getRawHeaders(name)
+	if not values:
+		return ''
+	return values[0]
+
+
+def _isAllowedOrigin(origin, host, allowedDomains):
+	"""
+	Return C{True} if a page from C{origin} (the value of an C{Origin}
+	header) may connect to a server reached at C{host} (the value of a
+	C{Host} header).  That is, if the origin's hostname is C{host}'s
+	hostname, or is one of C{allowedDomains}, or is a subdomain of one
+	of them.  Ports are ignored, as they are for C{document.domain}.
+	"""
+	hostname = urlparse(origin).hostname
+	if not hostname:
+		# Including the "null" origin of sandboxed pages
+		return False
+	if hostname == host.split(':', 1)[0].lower():
+		return True
+	for domain in allowedDomains:
+		domain = domain.lower()
+		if hostname == domain or hostname.endswith('.' + domain):
+			return True
+	return False
+
+
+# From RFC 6455
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def _replaceProtocol(transport, oldProtocol, newProtocol):
+	"""
+	Make C{transport} deliver its data to C{newProtocol} instead of
+	C{oldProtocol}.  Over TLS, the data for C{oldProtocol} comes from a
+	protocol wrapper (like L{twisted.protocols.tls.TLSMemoryBIOProtocol})
+	that decrypts it, so replace the wrapper's C{wrappedProtocol} instead
+	of the protocol that receives the ciphertext.
+	"""
+	# The wrapper itself is the transport (twisted.protocols.tls used as
+	# a wrapping factory)
+	if getattr(transport, 'wrappedProtocol', None) is oldProtocol:
+		transport.wrappedProtocol = newProtocol
+		return
+	# The transport's protocol is the wrapper (twisted.internet._newtls,
+	# used by listenSSL and startTLS)
+	protocol = getattr(transport, 'protocol', None)
+	while protocol is not oldProtocol:
+		wrapped = getattr(protocol, 'wrappedProtocol', None)
+		if wrapped is None:
+			break
+		if wrapped is oldProtocol:
+			protocol.wrappedProtocol = newProtocol
+			return
+		protocol = wrapped
+	transport.protocol = newProtocol
+
+
+
+class _WebSocketIo(BetterResource):
+	"""
+	Upgrades a GET request to an RFC 6455 WebSocket connection, and hands
+	the TCP connection to a L{ServerTransport} in C{WEBSOCKET} mode.  Both
+	directions stream Minerva frames, one frame per WebSocket message.
+
+	Browsers let any page open a WebSocket to any server, with the user's
+	cookies, so upgrades from a page on another domain are refused; see
+	L{_isAllowedOrigin}.  Requests without an C{Origin} header do not
+	come from a browser page, and are allowed.
+	"""
+	isLeaf = True
+	protocol = ServerTransport
+
+	def __init__(self, clock, streamTracker, allowedDomains=()):
+		BetterResource.__init__(self)
+		self._clock = clock
+		self.streamTracker = streamTracker
+		self._allowedDomains = allowedDomains
+
+
+	def render_GET(self, request):
+		key = _getHeader(request, 'sec-websocket-key')
+		if _getHeader(request, 'upgrade').lower() != 'websocket' or \
+		'upgrade' not in _getHeader(request, 'connection').lower() or \
+		_getHeader(request, 'sec-websocket-version') != '13' or not key:
+			request.setResponseCode(400)
+			request.responseHeaders.setRawHeaders(
+				'sec-websocket-version', ['13'])
+			return 'Expected a WebSocket version 13 handshake\n'
+
+		origin = _getHeader(request, 'origin')
+		if origin and not _isAllowedOrigin(
+		origin, _getHeader(request, 'host'), self._allowedDomains):
+			request.setResponseCode(403)
+			return 'Origin not allowed\n'
+
+		accept = base64.b64encode(hashlib.sha1(key + _WEBSOCKET_GUID).digest())
+
+		# Take the TCP connection away from the HTTPChannel.  twisted.web
+		# will never finish this request, and it must not time out the
+		# connection.
+		channel = request.channel
+		transport, channel.transport = channel.transport, None
+		if hasattr(channel, 'setTimeout'):
+			channel.setTimeout(None)
+
+		transport.write(
+			'HTTP/1.1 101 Switching Protocols\r\n'
+			'Upgrade: websocket\r\n'
+			'Connection: Upgrade\r\n'
+			'Sec-WebSocket-Accept: %s\r\n\r\n' % (accept,))
+
+		t = self.protocol(self._clock)
+		t.factory = self
+		_replaceProtocol(transport, channel, t)
+		t.makeConnection(transport)
+		t.webSocketStarted(request.requestHeaders)
+		return NOT_DONE_YET
+
+
+
 requireFiles([
 	FilePath(__file__).sibling('compiled_client').child('FlashConnector.swf').path])
 
@@ -1875,6 +3064,9 @@ class WebPort(BetterResource):
 
 	-	io: used by Minerva client's HTTP transports to send and receive Minerva frames.
 
+	-	ws: a WebSocket endpoint that sends and receives Minerva frames over
+		one full-duplex connection.
+
 	-	xdrframe: cross-subdomain communication helper; compiled JS.
 
 	-	xdrframe_dev: cross-subdomain communication helper; uncompiled JS.
@@ -1893,6 +3085,7 @@ class WebPort(BetterResource):
 			allowedDomains = []
 
 		self.putChild('io', _HttpIo(clock, streamTracker))
+		self.putChild('ws', _WebSocketIo(clock, streamTracker, allowedDomains))
 		self.putChild('xdrframe', XDRFrame(allowedDomains, fileCache))
 		self.putChild('xdrframe_dev', XDRFrameDev(allowedDomains, fileCache))
 
@@ -11,7 +11,9 @@ stream.
 """
 
 import sys
+import heapq
 import operator
+from collections import OrderedDict, deque
 
 from twisted.python import failure
 from twisted.internet import defer
@@ -78,6 +80,16 @@ class OkayAnswer(_BodyAndId):
 
 
 
+class PartialAnswer(_BodyAndId):
+	"""
+	A part of a streamed answer.  The parts are followed by an
+	L{OkayAnswer} (with the last part) or an error answer.
+	"""
+	__slots__ = ()
+	_MARKER = object()
+
+
+
 class KnownErrorAnswer(_BodyAndId):
 	__slots__ = ()
 	_MARKER = object()
@@ -102,16 +114,55 @@ class Notification(_JustBody):
 
 
 
+class Batch(tuple):
+	"""
+	Several QAN frames (none of which are L{Batch}es) sent as one string.
+	"""
+	__slots__ = ()
+	_MARKER = object()
+
+	frames = property(operator.itemgetter(1))
+
+	def __new__(cls, frames):
+		return tuple.__new__(cls, (cls._MARKER, tuple(frames)))
+
+
+	def __repr__(self):
+		return '%s(%r)' % (self.__class__.__name__, list(self[1]))
+
+
+
 qanTypeToCode = {
 	 Question: "Q"
 	,OkayAnswer: "K"
+	,PartialAnswer: "P"
 	,KnownErrorAnswer: "E"
 	,UnknownErrorAnswer: "U"
 	,Cancellation: "C"
 	,Notification: "#"
+	,Batch: "B"
 }
 
 
+def encodeBatch(frameStrings):
+	"""
+	@param frameStrings: QAN frames that were already encoded with
+		L{qanFrameToString}.
+	@type frameStrings: sequence of C{str}
+
+	@return: The encoded L{Batch} frame, which is each frame prefixed
+		with its length and a ":", followed by "B".
+	@rtype: str
+	"""
+	parts = []
+	for frameString in frameStrings:
+		parts.append(str(len(frameString)))
+		parts.append(':')
+		parts.append(frameString)
+	parts.append('B')
+	return ''.join(parts)
+
+
 def qanFrameToString(qanFrame):
 	"""
 	@param qanFrame: The QAN frame to encode
@@ -125,7 +176,12 @@ def qanFrameToString(qanFrame):
 	"""
 	qanFrameType = type(qanFrame)
 	code = qanTypeToCode[qanFrameType]
-	if qanFrameType == Cancellation:
+	if qanFrameType == Batch:
+		for f in qanFrame.frames:
+			if type(f) == Batch:
+				raise TypeError("Batch cannot contain a Batch")
+		return encodeBatch([qanFrameToString(f) for f in qanFrame.frames])
+	elif qanFrameType == Cancellation:
 		return str(qanFrame.qid) + code
 	else:
 		if not isinstance(qanFrame.body, str):
@@ -150,6 +206,31 @@ def _qidOrThrow(s):
 		raise InvalidQANFrame("bad qid")
 
 
+def _decodeBatch(frameString):
+	frames = []
+	pos = 0
+	end = len(frameString) - 1
+	while pos < end:
+		colon = frameString.find(':', pos, end)
+		if colon == -1:
+			raise InvalidQANFrame("Expected colon in Batch")
+		try:
+			length = strToNonNegLimit(frameString[pos:colon], end)
+		except ValueError:
+			raise InvalidQANFrame("bad length in Batch")
+		pos = colon + 1 + length
+		if pos > end:
+			raise InvalidQANFrame("Batch item extends past end of Batch")
+		# Check before decoding the item, so that a deeply nested Batch
+		# is not decoded recursively.
+		if length and frameString[pos - 1] == "B":
+			raise InvalidQANFrame("Batch cannot contain a Batch")
+		frames.append(stringToQANFrame(frameString[colon + 1:pos]))
+	if not frames:
+		raise InvalidQANFrame("Empty Batch")
+	return Batch(frames)
+
+
 def stringToQANFrame(frameString):
 	"""
 	@param frameString: The QAN frame, encoded as a string
@@ -157,14 +238,17 @@ def stringToQANFrame(frameString):
 
 	@return: The QAN frame
 	@rtype qf: a L{Question} or L{OkayAnswer} or L{ErrorAnswer} or
-		L{Cancellation} or L{Notification}, with a C{str} C{.body}.
+		L{Cancellation} or L{Notification}, with a C{str} C{.body}, or
+		a L{Batch} of these.
 	"""
 	try:
 		lastByte = frameString[-1]
 	except IndexError:
 		raise InvalidQANFrame("0-length frame")
 
-	if lastByte == "#":
+	if lastByte == "B":
+		return _decodeBatch(frameString)
+	elif lastByte == "#":
 		return Notification(frameString[:-1])
 	elif lastByte == "C":
 		qid = _qidOrThrow(frameString[:-1])
@@ -180,6 +264,8 @@ def stringToQANFrame(frameString):
 			return Question(body, qid)
 		elif lastByte == "K":
 			return OkayAnswer(body, qid)
+		elif lastByte == "P":
+			return PartialAnswer(body, qid)
 		elif lastByte == "E":
 			return KnownErrorAnswer(body, qid)
 		elif lastByte == "U":
@@ -197,9 +283,10 @@ def isAnswerFrame(qanFrame):
 
 def frameHasBody(qanFrame):
 	"""
-	Does this C{qanFrame} have a body?  (Everything but L{Cancellation} does.)
+	Does this C{qanFrame} have a body?  (Everything but L{Cancellation} and
+	L{Batch} does.)
 	"""
-	return not isinstance(qanFrame, Cancellation)
+	return not isinstance(qanFrame, (Cancellation, Batch))
 
 
 class KnownError(Exception):
@@ -217,8 +304,43 @@ class QuestionFailed(Exception):
 
 
 
+class QuestionTimedOut(QuestionFailed):
+	pass
+
+
+
+class AnswerTooLarge(QuestionFailed):
+	pass
+
+
+
+class StreamingAnswer(object):
+	"""
+	Return this from C{bodyReceived} (or fire its Deferred with this) to
+	answer a Question with the C{str} bodies produced by iterator
+	C{chunks}, instead of with one body.  The chunks are pulled from
+	C{chunks} one at a time, and every chunk but the last is sent as a
+	L{PartialAnswer}.  The asker's Deferred fires with all of the chunks
+	joined together, unless it passed C{partReceived} to L{QANHelper.ask}.
+
+	If C{chunks} raises an exception, the Question is answered with an
+	error answer, as if C{bodyReceived} had raised it.
+	"""
+	__slots__ = ('chunks',)
+
+	def __init__(self, chunks):
+		self.chunks = chunks
+
+
+
 class QANHelper(object):
-	def __init__(self, bodyReceived, logError, sendQANFrame, fatalError):
+	# How long to remember the qid of a Question that timed out, so that
+	# a late answer to it is ignored instead of being a fatal error.
+	timedOutAnswerGrace = 300 # seconds
+
+	def __init__(self, bodyReceived, logError, sendQANFrame, fatalError,
+	clock=None, maxInFlight=None, maxQueued=0, waitForSendQueue=None,
+	maxAnswerBytes=16*1024*1024):
 		"""
 		@param bodyReceived: The 2-arg function to call when
 			a Question or Notification is received (via a call to .handleString).
@@ -236,15 +358,70 @@ class QANHelper(object):
 			in inclusive range 0x20 (SPACE) to 0x7E (~)).  After fatalError is called,
 			you must stop calling C{handleQANFrame} to prevent fatalError from
 			possibly being called again.
+
+		@param clock: An L{IReactorTime} provider, used to time out
+			questions asked with a C{timeout}.  Required only if you
+			pass a C{timeout} to L{ask}.
+
+		@param maxInFlight: The maximum number of the peer's Questions for
+			which C{bodyReceived} may be running (that is, it returned a
+			Deferred that has not fired yet), or C{None} for no limit.
+			Questions received while this many are in flight are queued,
+			and started in the order they were received.
+
+		@param maxQueued: The maximum number of the peer's Questions to
+			queue when C{maxInFlight} Questions are in flight.  Questions
+			received when the queue is full are answered with a
+			L{KnownErrorAnswer} with body C{"Too many questions"}.
+
+		@param waitForSendQueue: A 0-arg function called before each chunk
+			of a L{StreamingAnswer} is sent.  It returns C{None} if the
+			chunk may be sent now, or a Deferred that fires when the peer
+			has acknowledged enough of what was sent.  If C{None}, chunks are
+			sent without waiting.
+
+		@param maxAnswerBytes: The maximum number of bytes of
+			L{PartialAnswer} bodies to keep for one of our Questions.  If
+			the peer sends more, the Question is cancelled and errbacks with
+			L{AnswerTooLarge}.  Does not apply to Questions asked with a
+			C{partReceived}.
 		"""
 		self._bodyReceived = bodyReceived
 		self._logError = logError
 		self._sendQANFrame = sendQANFrame
 		self._fatalError = fatalError
+		self._fatalErrorCalled = False
+		self._clock = clock
+		self._waitForSendQueue = waitForSendQueue
+		self._maxAnswerBytes = maxAnswerBytes
+
+		self._maxInFlight = maxInFlight
+		self._maxQueued = maxQueued
 
 		self._qidCounter = 0
 		self._ourQuestions = {}
 		self._theirQuestions = {}
+		# qid -> body for the peer's Questions waiting for a free slot
+		self._queuedQuestions = OrderedDict()
+		self._startingQueued = False
+		# qid -> [iterator, held chunk or None, DelayedCall or None] for
+		# the answers we are streaming to the peer
+		self._streamingAnswers = {}
+		# qid -> [total size, list of PartialAnswer bodies] received for our
+		# questions, or qid -> partReceived function
+		self._answerParts = {}
+		self._partReceivers = {}
+
+		# A heap of (deadline, qid) for our questions that have a timeout.
+		# Entries for questions that were already answered are skipped when
+		# they reach the top of the heap.  One DelayedCall is scheduled for
+		# the earliest deadline, no matter how many questions are pending.
+		self._deadlines = []
+		self._timeoutCall = None
+		# The qids of our questions that timed out and have not been
+		# answered yet, and a deque of (forget time, qid) to prune them.
+		self._timedOutQids = set()
+		self._timedOutExpiry = deque()
 
 
 	def __repr__(self):
@@ -254,13 +431,142 @@ class QANHelper(object):
 				len(self._theirQuestions))
 
 
+	def countInFlight(self):
+		"""
+		@return: the number of the peer's Questions that we are answering.
+		@rtype: C{int}
+		"""
+		return len(self._theirQuestions)
+
+
+	def countQueued(self):
+		"""
+		@return: the number of the peer's Questions waiting to be answered
+			because C{maxInFlight} Questions are in flight.
+		@rtype: C{int}
+		"""
+		return len(self._queuedQuestions)
+
+
+	def _startQuestion(self, body, qid):
+		d = defer.maybeDeferred(self._bodyReceived, body, True)
+		self._theirQuestions[qid] = d
+		d.addCallbacks(
+			self._sendOkayAnswer, self._sendErrorAnswer,
+			callbackArgs=(qid,), errbackArgs=(qid,))
+		d.addErrback(lambda failure: self._logError(
+			"Bug in QANHelper._sendOkayAnswer or _sendErrorAnswer", failure))
+
+
+	def _startQueuedQuestions(self):
+		# Questions answered synchronously finish inside _startQuestion and
+		# call us again; let the outer loop start the next one instead of
+		# recursing once per Question.
+		if self._startingQueued:
+			return
+		self._startingQueued = True
+		try:
+			queued = self._queuedQuestions
+			while queued and len(self._theirQuestions) < self._maxInFlight:
+				qid, body = queued.popitem(last=False)
+				self._startQuestion(body, qid)
+		finally:
+			self._startingQueued = False
+
+
 	def _sendOkayAnswer(self, body, qid):
+		if isinstance(body, StreamingAnswer):
+			try:
+				iterator = iter(body.chunks)
+			except Exception:
+				self._sendErrorAnswer(failure.Failure(), qid)
+			else:
+				self._streamingAnswers[qid] = [iterator, None, None]
+				self._continueStreamingAnswer(qid)
+			return
 		del self._theirQuestions[qid]
-		self._sendQANFrame(OkayAnswer(body, qid))
+		try:
+			self._sendQANFrame(OkayAnswer(body, qid))
+		finally:
+			self._startQueuedQuestions()
 
 
 	def _sendErrorAnswer(self, failure, qid):
 		del self._theirQuestions[qid]
+		try:
+			self._sendErrorAnswerFrame(failure, qid)
+		finally:
+			self._startQueuedQuestions()
+
+
+	def _continueStreamingAnswer(self, qid):
+		state = self._streamingAnswers[qid]
+		state[2] = None
+		iterator = state[0]
+		while True:
+			# Wait for the peer to acknowledge enough of what we sent, so that
+			# a large answer does not pile up in the send queue.
+			if self._waitForSendQueue is not None:
+				d = self._waitForSendQueue()
+				if d is not None:
+					d.addCallback(self._resumeStreamingAnswer, qid, state)
+					d.addErrback(lambda failure: self._logError(
+						"Bug in QANHelper._resumeStreamingAnswer", failure))
+					return
+			try:
+				chunk = iterator.next()
+				# Hold back one chunk, so that the last chunk can be sent in
+				# the OkayAnswer.
+				if state[1] is not None:
+					self._sendQANFrame(PartialAnswer(state[1], qid))
+			except StopIteration:
+				del self._streamingAnswers[qid]
+				self._finishStreamingAnswer(state[1], qid)
+				return
+			except Exception:
+				# Includes an invalid chunk rejected by _sendQANFrame
+				f = failure.Failure()
+				self._stopStreamingAnswer(qid)
+				self._sendErrorAnswer(f, qid)
+				return
+			state[1] = chunk
+
+			# Send one chunk per reactor iteration, so that frames for
+			# other questions are not stuck behind a large answer.
+			if self._clock is not None:
+				state[2] = self._clock.callLater(
+					0, self._continueStreamingAnswer, qid)
+				return
+
+
+	def _finishStreamingAnswer(self, held, qid):
+		try:
+			self._sendQANFrame(OkayAnswer('' if held is None else held, qid))
+		except Exception:
+			# An invalid last chunk rejected by _sendQANFrame.  The peer
+			# already has our PartialAnswers, so it must get an error answer.
+			self._sendErrorAnswer(failure.Failure(), qid)
+		else:
+			del self._theirQuestions[qid]
+			self._startQueuedQuestions()
+
+
+	def _resumeStreamingAnswer(self, _ignored, qid, state):
+		# The answer may have been stopped while we were waiting.
+		if self._streamingAnswers.get(qid) is state:
+			self._continueStreamingAnswer(qid)
+
+
+	def _stopStreamingAnswer(self, qid):
+		iterator, held, call = self._streamingAnswers.pop(qid)
+		if call is not None:
+			call.cancel()
+		close = getattr(iterator, 'close', None)
+		if close is not None:
+			close()
+
+
+	def _sendErrorAnswerFrame(self, failure, qid):
 		if failure.check(KnownError):
 			body = failure.value[0]
 			self._sendQANFrame(KnownErrorAnswer(body, qid))
@@ -274,20 +580,44 @@ class QANHelper(object):
 			self._sendQANFrame(UnknownErrorAnswer("Uncaught exception", qid))
 
 
+	def _callFatalError(self, reason):
+		self._fatalErrorCalled = True
+		self._fatalError(reason)
+
+
 	def handleQANFrame(self, qanFrame):
-		if isAnswerFrame(qanFrame):
+		if isinstance(qanFrame, Batch):
+			for f in qanFrame.frames:
+				# Stop handling the frames after a fatal error, like
+				# our caller would.
+				if self._fatalErrorCalled:
+					break
+				self.handleQANFrame(f)
+
+		elif isAnswerFrame(qanFrame):
 			qid = qanFrame.qid
+			parts = self._answerParts.pop(qid, None)
+			self._partReceivers.pop(qid, None)
 			try:
 				d = self._ourQuestions.pop(qid)
 			except KeyError:
-				self._fatalError("Received an answer with invalid qid: %d" % (qid,))
+				# Ignore one late answer to a question that timed out.
+				if self._isTimedOut(qid):
+					self._timedOutQids.remove(qid)
+				else:
+					self._callFatalError("Received an answer with invalid qid: %d" % (qid,))
 				return
 
 			if d is None:
 				# Ignore the answer to a question we cancelled or failAll'ed.
 				pass
 			elif isinstance(qanFrame, OkayAnswer):
-				d.callback(qanFrame.body)
+				if parts is not None:
+					parts = parts[1]
+					parts.append(qanFrame.body)
+					d.callback(''.join(parts))
+				else:
+					d.callback(qanFrame.body)
 			elif isinstance(qanFrame, KnownErrorAnswer):
 				d.errback(KnownError(qanFrame.body))
 			elif isinstance(qanFrame, UnknownErrorAnswer):
@@ -295,6 +625,24 @@ class QANHelper(object):
 			else:
 				raise RuntimeError("handleQANFrame bug")
 
+		elif isinstance(qanFrame, PartialAnswer):
+			qid = qanFrame.qid
+			d = self._ourQuestions.get(qid, False)
+			if d is False:
+				if not self._isTimedOut(qid):
+					self._callFatalError(
+						"Received a PartialAnswer with invalid qid: %d" % (qid,))
+			elif d is not None:
+				partReceived = self._partReceivers.get(qid)
+				if partReceived is None:
+					self._answerPartReceived(d, qanFrame.body, qid)
+				else:
+					try:
+						partReceived(qanFrame.body)
+					except Exception:
+						self._logError("partReceived for Question #%d raised "
+							"uncaught exception" % (qid,), failure.Failure())
+
 		elif isinstance(qanFrame, Notification):
 			try:
 				self._bodyReceived(qanFrame.body, False)
@@ -304,20 +652,24 @@ class QANHelper(object):
 
 		elif isinstance(qanFrame, Question):
 			qid = qanFrame.qid
-			if qid in self._theirQuestions:
-				self._fatalError("Received Question with duplicate qid: %d" % (qid,))
+			if qid in self._theirQuestions or qid in self._queuedQuestions:
+				self._callFatalError("Received Question with duplicate qid: %d" % (qid,))
 				return
-			d = defer.maybeDeferred(
-				self._bodyReceived, qanFrame.body, True)
-			self._theirQuestions[qid] = d
-			d.addCallbacks(
-				self._sendOkayAnswer, self._sendErrorAnswer,
-				callbackArgs=(qid,), errbackArgs=(qid,))
-			d.addErrback(lambda failure: self._logError(
-				"Bug in QANHelper._sendOkayAnswer or _sendErrorAnswer", failure))
+			maxInFlight = self._maxInFlight
+			if maxInFlight is None or len(self._theirQuestions) < maxInFlight:
+				self._startQuestion(qanFrame.body, qid)
+			elif len(self._queuedQuestions) < self._maxQueued:
+				self._queuedQuestions[qid] = qanFrame.body
+			else:
+				self._sendQANFrame(KnownErrorAnswer("Too many questions", qid))
 
 		elif isinstance(qanFrame, Cancellation):
 			qid = qanFrame.qid
+			if qid in self._streamingAnswers:
+				self._stopStreamingAnswer(qid)
+				self._sendErrorAnswer(
+					failure.Failure(defer.CancelledError()), qid)
+				return
 			try:
 				# We don't .pop() it here because a cancelled Deferred
 				# still goes through the callback or errback chain, and
@@ -325,14 +677,33 @@ class QANHelper(object):
 				# deletes it from self._theirQuestions.
 				d = self._theirQuestions[qid]
 			except KeyError:
+				if qid in self._queuedQuestions:
+					# Answer it the same way as a cancelled in-flight Question.
+					del self._queuedQuestions[qid]
+					self._sendQANFrame(UnknownErrorAnswer("CancelledError", qid))
 				# Cancellations for nonexistent questions are ignored.
-				pass
 			else:
 				d.cancel()
 
 
+	def _answerPartReceived(self, d, body, qid):
+		parts = self._answerParts.get(qid)
+		if parts is None:
+			parts = self._answerParts[qid] = [0, []]
+		parts[0] += len(body)
+		if parts[0] > self._maxAnswerBytes:
+			# Like d.cancel(), but with a different error.
+			self._sendCancel(qid)
+			d.errback(AnswerTooLarge("Answer to Question #%d exceeded "
+				"%d bytes" % (qid, self._maxAnswerBytes)))
+		else:
+			parts[1].append(body)
+
+
 	def _sendCancel(self, qid):
 		self._ourQuestions[qid] = None
+		self._answerParts.pop(qid, None)
+		self._partReceivers.pop(qid, None)
 
 		# Note: when we cancel something, we still expect to get either
 		# an OkayAnswer or *ErrorAnswer from the peer, at least in the
@@ -343,17 +714,81 @@ class QANHelper(object):
 		# Deferred calls .errback(CancelledError()) for us.
 
 
-	def ask(self, body):
+	def _isTimedOut(self, qid):
+		# Forget the qids that timed out too long ago.
+		now = self._clock.seconds() if self._clock is not None else 0
+		expiry = self._timedOutExpiry
+		while expiry and expiry[0][0] <= now:
+			self._timedOutQids.discard(expiry.popleft()[1])
+		return qid in self._timedOutQids
+
+
+	def _scheduleTimeouts(self):
+		deadline = self._deadlines[0][0]
+		call = self._timeoutCall
+		if call is None:
+			self._timeoutCall = self._clock.callLater(
+				max(0, deadline - self._clock.seconds()), self._timeOutQuestions)
+		elif deadline < call.getTime():
+			call.reset(max(0, deadline - self._clock.seconds()))
+
+
+	def _timeOutQuestions(self):
+		self._timeoutCall = None
+		now = self._clock.seconds()
+		deadlines = self._deadlines
+		expired = []
+		while deadlines and deadlines[0][0] <= now:
+			qid = heapq.heappop(deadlines)[1]
+			# Skip questions that were answered, cancelled, or failAll'ed.
+			d = self._ourQuestions.get(qid)
+			if d is not None:
+				expired.append((qid, d))
+		if deadlines:
+			self._scheduleTimeouts()
+
+		for qid, d in expired:
+			# Forget the question entirely (instead of waiting for the peer
+			# to answer the Cancellation), because a peer that ignored the
+			# question may ignore the Cancellation as well.
+			del self._ourQuestions[qid]
+			self._timedOutQids.add(qid)
+			self._timedOutExpiry.append((now + self.timedOutAnswerGrace, qid))
+			self._answerParts.pop(qid, None)
+			self._partReceivers.pop(qid, None)
+			self._sendQANFrame(Cancellation(qid))
+			d.errback(QuestionTimedOut(
+				"No answer to Question #%d after timeout" % (qid,)))
+
+
+	def ask(self, body, timeout=None, partReceived=None):
 		"""
 		Send a Question to the peer.
 
 		@param body: The question body
 		@type body: *
 
+		@param timeout: If not C{None}, the number of seconds after which
+			to give up on the question: a L{Cancellation} is sent to the
+			peer, and the Deferred errbacks with L{QuestionTimedOut}.
+			Requires that this L{QANHelper} was given a C{clock}.
+		@type timeout: C{int} or C{float} or C{NoneType}
+
+		@param partReceived: If not C{None}, a 1-arg function called with
+			the body of each L{PartialAnswer} as it arrives.  The returned
+			Deferred then fires with just the body of the final
+			L{OkayAnswer}.  If C{None}, the bodies of L{PartialAnswer}s are
+			joined with the body of the final L{OkayAnswer}.
+
 		@return: a Deferred that will callback the response object, or errback
-			with L{KnownError} or L{UnknownError} or L{QuestionFailed}.
+			with L{KnownError} or L{UnknownError} or L{QuestionFailed} or
+			L{QuestionTimedOut}.
 		@rtype: L{defer.Deferred}
 		"""
+		if timeout is not None and self._clock is None:
+			raise ValueError("Cannot ask with a timeout because "
+				"QANHelper has no clock")
+
 		qid = self._qidCounter + 1
 		# Note: _sendQANFrame may raise exception if body is invalid
 		self._sendQANFrame(Question(body, qid))
@@ -362,6 +797,11 @@ class QANHelper(object):
 		assert qid not in self._ourQuestions
 		d = defer.Deferred(lambda _: self._sendCancel(qid))
 		self._ourQuestions[qid] = d
+		if partReceived is not None:
+			self._partReceivers[qid] = partReceived
+		if timeout is not None:
+			heapq.heappush(self._deadlines, (self._clock.seconds() + timeout, qid))
+			self._scheduleTimeouts()
 		return d
 
 
@@ -380,12 +820,27 @@ class QANHelper(object):
 
 	def failAll(self, reason):
 		"""
-		Errback all of our questions with L{QuestionFailed}.
+		Errback all of our questions with L{QuestionFailed}, drop the
+		peer's queued Questions without starting them, and stop streaming
+		answers to the peer.
 
 		@param reason: Reason for failing; used as the L{QuestionFailed}
 			exception message.
 		@type reason: C{str}
 		"""
+		if self._timeoutCall is not None:
+			self._timeoutCall.cancel()
+			self._timeoutCall = None
+		self._deadlines = []
+		self._timedOutQids.clear()
+		self._timedOutExpiry.clear()
+		self._queuedQuestions.clear()
+		self._answerParts.clear()
+		self._partReceivers.clear()
+		for qid in self._streamingAnswers.keys():
+			self._stopStreamingAnswer(qid)
+			del self._theirQuestions[qid]
+
 		# .copy() because some buggy errback might .ask() a question
 		for qid, d in self._ourQuestions.copy().iteritems():
 			self._ourQuestions[qid] = None
@@ -393,6 +848,134 @@ class QANHelper(object):
 
 
 
+
+class AnswerCache(object):
+	"""
+	An opt-in layer for C{IQANProtocol.bodyReceived} that answers identical
+	read-only Questions once.  Share one L{AnswerCache} between all of the
+	protocols (and streams) that answer a kind of Question, and in
+	C{bodyReceived}, return C{cache.answer(body, computeAnswer)}.
+
+	While an answer for a key is being computed, more Questions with the
+	same key wait for that computation instead of starting another one.
+	If C{ttl} is not C{None}, answers are also kept for C{ttl} seconds, and
+	at most C{maxSize} answers are kept; the least recently used answer is
+	dropped first.  Errors are never kept.
+
+	Use this only for Questions answered with a C{str} (not a
+	L{StreamingAnswer}), and only for Questions whose answer does not
+	depend on who asked them.
+
+	@ivar hits: The number of Questions answered with a kept answer.
+	@ivar misses: The number of Questions for which the answer was computed.
+	@ivar coalesced: The number of Questions that waited for another
+		Question's computation.
+	"""
+	def __init__(self, clock, ttl=None, maxSize=1000, key=None):
+		"""
+		@param clock: An L{IReactorTime} provider.
+
+		@param ttl: How many seconds to keep answers for, or C{None} to
+			not keep answers at all.
+
+		@param maxSize: The maximum number of answers to keep.
+
+		@param key: A 1-arg function that returns the key for a Question
+			body, or C{None} to use the body itself as the key.
+		"""
+		self._clock = clock
+		self._ttl = ttl
+		self._maxSize = maxSize
+		self._key = key
+
+		# key -> (expireTime, answer), least recently used first
+		self._answers = OrderedDict()
+		# key -> list of Deferreds waiting for the answer being computed
+		self._waiters = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.coalesced = 0
+
+
+	def __repr__(self):
+		return '<%s with %d answers, %d computing; %d hits, %d misses, %d coalesced>' % (
+			self.__class__.__name__, len(self._answers), len(self._waiters),
+			self.hits, self.misses, self.coalesced)
+
+
+	def answer(self, body, computeAnswer):
+		"""
+		Answer Question body C{body} with a kept answer, the answer being
+		computed for the same key, or a new call to C{computeAnswer(body)}.
+
+		@param body: The Question body.
+		@type body: C{str}
+
+		@param computeAnswer: A 1-arg function that returns the answer, or
+			a Deferred that fires with it.
+
+		@return: A new Deferred for each call, so that cancelling one does
+			not affect the other Questions.
+		@rtype: L{defer.Deferred}
+		"""
+		key = body if self._key is None else self._key(body)
+
+		answers = self._answers
+		entry = answers.get(key)
+		if entry is not None:
+			if entry[0] > self._clock.seconds():
+				# Move it to the most-recently-used end
+				del answers[key]
+				answers[key] = entry
+				self.hits += 1
+				return defer.succeed(entry[1])
+			del answers[key]
+
+		d = defer.Deferred(lambda d: self._waiterCancelled(d, key))
+		waiters = self._waiters.get(key)
+		if waiters is not None:
+			self.coalesced += 1
+			waiters.append(d)
+			return d
+
+		self.misses += 1
+		self._waiters[key] = [d]
+		computed = defer.maybeDeferred(computeAnswer, body)
+		computed.addBoth(self._answerComputed, key)
+		return d
+
+
+	def _waiterCancelled(self, d, key):
+		waiters = self._waiters.get(key)
+		# d is not in the list if the answer was already computed (and the
+		# list popped), even if a new computation for key has started.
+		if waiters is not None and d in waiters:
+			waiters.remove(d)
+
+
+	def _answerComputed(self, result, key):
+		waiters = self._waiters.pop(key)
+		isFailure = isinstance(result, failure.Failure)
+		if not isFailure and self._ttl is not None:
+			answers = self._answers
+			answers[key] = (self._clock.seconds() + self._ttl, result)
+			while len(answers) > self._maxSize:
+				answers.popitem(last=False)
+
+		for d in waiters:
+			# A callback of an earlier waiter may have cancelled this one.
+			if d.called:
+				continue
+			if isFailure:
+				d.errback(result)
+			else:
+				d.callback(result)
+		# Every waiter got the failure, if there was one.
+		return None
+
+
+
 try: from refbinder.api import bindRecursive
 except ImportError: pass
 else: bindRecursive(sys.modules[__name__], _postImportVars)
@@ -83,6 +83,13 @@ class CommonTests(object):
 			self.assertEqual(self.strings, got)
 
 
+	def test_encodeStringFrame(self):
+		for s in self.strings:
+			self.assertEqual(
+				self.receiver.encode(s + ' '),
+				self.receiver.encodeStringFrame(s))
+
+
 	def test_illegalWithPacketSizes(self):
 		"""
 		Assert that illegal strings return the correct error code
@@ -165,6 +172,42 @@ class DelimitedStringDecoderTests(CommonTests, unittest.TestCase):
 		self.assertEqual((strings, decoders.TOO_LONG), (got, code))
 
 
+	def test_tooLongIsSticky(self):
+		"""
+		After returning TOO_LONG, the decoder keeps returning TOO_LONG
+		and no strings, even if the new data is valid.
+		"""
+		a = self.receiver(maxLength=5)
+		self.assertEqual(([], decoders.TOO_LONG), a.getNewFrames('123456'))
+		self.assertEqual(([], decoders.TOO_LONG), a.getNewFrames('\nhi\n'))
+
+
+	def test_stringsInOneReadNotCopied(self):
+		"""
+		Strings that arrive entirely within one read are fragments of
+		that read.
+		"""
+		a = self.receiver(maxLength=100)
+		data = 'hello\nthere\npartial'
+		got, code = a.getNewFrames(data)
+		self.assertEqual(decoders.OK, code)
+		self.assertEqual(['hello', 'there'], fragmentsToStr(got))
+		for frag in got:
+			self.assertIdentical(data, frag._string)
+		got, code = a.getNewFrames('ly\n')
+		self.assertEqual(['partially'], fragmentsToStr(got))
+
+
+	def test_spanningStringLengthLimit(self):
+		"""
+		The length limit applies to a string that spans many reads.
+		"""
+		a = self.receiver(maxLength=5)
+		self.assertEqual(([], decoders.OK), a.getNewFrames('123'))
+		self.assertEqual(([], decoders.OK), a.getNewFrames('45'))
+		self.assertEqual(([], decoders.TOO_LONG), a.getNewFrames('6\n'))
+
+
 
 class Int32StringDecoderTests(CommonTests, unittest.TestCase):
 
@@ -252,6 +295,9 @@ class Int32StringDecoderTests(CommonTests, unittest.TestCase):
 		s = 'x' * (65536 + 1)
 
 		self.assertRaises(decoders.StringTooLongError, lambda: Int16StringDecoder.encode(s))
+		# The trailing " " of the StringFrame makes it 1 byte too long
+		self.assertRaises(decoders.StringTooLongError,
+			lambda: Int16StringDecoder.encodeStringFrame('x' * 65535))
 
 	
 	def test_lengthLimitExceeded(self):
@@ -279,3 +325,204 @@ class Int32StringDecoderTests(CommonTests, unittest.TestCase):
 		self.assertEqual(([], decoders.OK), r.getNewFrames('\x00'))
 		self.assertEqual(([], decoders.OK), r.getNewFrames('\x00'))
 		self.assertEqual(([], decoders.TOO_LONG), r.getNewFrames('\x00'))
+
+
+	def test_pendingLengthRemembered(self):
+		"""
+		While a string trickles in, its prefix is parsed only once, and
+		its pieces are kept until it is complete.
+		"""
+		r = self.receiver(maxLength=100)
+		self.assertEqual(([], decoders.OK), r.getNewFrames('\x00\x00'))
+		self.assertEqual(None, r._pendingLength)
+		self.assertEqual(([], decoders.OK), r.getNewFrames('\x00\x0bhello'))
+		self.assertEqual(11, r._pendingLength)
+		self.assertEqual(([], decoders.OK), r.getNewFrames(' the'))
+		self.assertEqual(['hello', ' the'], r._chunks)
+		got, code = fstValueToStrs(r.getNewFrames('re\x00\x00\x00\x01x\x00'))
+		self.assertEqual((['hello there', 'x'], decoders.OK), (got, code))
+		self.assertEqual(None, r._pendingLength)
+		self.assertEqual(['\x00'], r._chunks)
+
+
+	def test_stringsInOneReadNotCopied(self):
+		"""
+		Strings that arrive entirely within one read are fragments of
+		that read.
+		"""
+		r = self.receiver(maxLength=100)
+		data = '\x00\x00\x00\x05hello\x00\x00\x00\x05there\x00'
+		got, code = r.getNewFrames(data)
+		self.assertEqual(['hello', 'there'], fragmentsToStr(got))
+		for frag in got:
+			self.assertIdentical(data, frag._string)
+
+
+	def test_tooLongIsSticky(self):
+		r = self.receiver(maxLength=10)
+		self.assertEqual(([], decoders.TOO_LONG), r.getNewFrames('\x00\x00\x00\x0b'))
+		self.assertEqual(([], decoders.TOO_LONG), r.getNewFrames('\x00\x00\x00\x01x'))
+
+
+
+class ScriptWrappedStringDecoderTests(unittest.TestCase):
+
+	def test_encode(self):
+		encode = decoders.ScriptWrappedStringDecoder.encode
+		self.assertEqual('<script>f("hello")</script>\n', encode('hello'))
+		self.assertEqual(
+			'<script>f("\\u003c/script>\\u003c!-- \\"\\\\")</script>\n',
+			encode('</script><!-- "\\'))
+
+
+	def test_encodeStringFrame(self):
+		self.assertEqual('<script>f("hello ")</script>\n',
+			decoders.ScriptWrappedStringDecoder.encodeStringFrame('hello'))
+
+
+	def test_decode(self):
+		"""
+		Request bodies are newline-delimited, like with
+		L{decoders.DelimitedStringDecoder}.
+		"""
+		r = decoders.ScriptWrappedStringDecoder(maxLength=100)
+		self.assertEqual((['a', 'b'], decoders.OK),
+			fstValueToStrs(r.getNewFrames('a\nb\n')))
+
+
+
+def _maskedFrame(payload, opcode=0x1, fin=True, mask='\x37\xfa\x21\x3d'):
+	"""
+	Encode C{payload} as a masked client-to-server WebSocket frame.
+	"""
+	first = chr((0x80 if fin else 0) | opcode)
+	lenPayload = len(payload)
+	if lenPayload < 126:
+		header = first + chr(0x80 | lenPayload)
+	elif lenPayload < 65536:
+		header = first + '\xfe' + struct.pack('!H', lenPayload)
+	else:
+		header = first + '\xff' + struct.pack('!Q', lenPayload)
+	return header + mask + decoders._unmask(payload, mask)
+
+
+
+class WebSocketDecoderTests(unittest.TestCase):
+
+	receiver = decoders.WebSocketDecoder
+	strings = ["", "a", "b" * 125, "c" * 126, "d" * 65535, "e" * 65536]
+
+	def test_unmask(self):
+		self.assertEqual('', decoders._unmask('', '\x01\x02\x03\x04'))
+		self.assertEqual('\x01\x02\x03\x04\x01\x02',
+			decoders._unmask('\x00' * 6, '\x01\x02\x03\x04'))
+		self.assertEqual('Hello', decoders._unmask(
+			'\x7f\x9f\x4d\x51\x58', '\x37\xfa\x21\x3d'))
+
+
+	def test_encode(self):
+		self.assertEqual('\x81\x05hello', self.receiver.encode('hello'))
+		self.assertEqual('\x81\x7e\x00\x7e' + 'x' * 126,
+			self.receiver.encode('x' * 126))
+		self.assertEqual('\x81\x7f' + struct.pack('!Q', 65536) + 'x' * 65536,
+			self.receiver.encode('x' * 65536))
+		self.assertEqual('\x88\x02\x03\xe8', self.receiver.encodeClose())
+
+
+	def test_encodeStringFrame(self):
+		for s in self.strings:
+			self.assertEqual(
+				self.receiver.encode(s + ' '),
+				self.receiver.encodeStringFrame(s))
+
+
+	def test_buffer(self):
+		"""
+		Frames are decoded correctly no matter how the data is split up.
+		"""
+		toSend = ''.join(_maskedFrame(s) for s in self.strings)
+		for packetSize in (1, 2, 3, 7, 13, 14, 15, 1000, 70000):
+			r = self.receiver(maxLength=70000)
+			got = []
+			for s in diceString(toSend, packetSize):
+				out, code = r.getNewFrames(s)
+				self.assertEqual(decoders.OK, code)
+				got.extend(out)
+			self.assertEqual(self.strings, fragmentsToStr(got))
+
+
+	def test_fragmentedMessage(self):
+		"""
+		A message split into several frames is delivered as one string,
+		and control frames may appear between its fragments.
+		"""
+		r = self.receiver(maxLength=100)
+		data = (_maskedFrame('hel', fin=False) +
+			_maskedFrame('lo', opcode=0x0, fin=False) +
+			_maskedFrame('', opcode=0xA) +
+			_maskedFrame(' there', opcode=0x0))
+		self.assertEqual((['hello there'], decoders.OK),
+			fstValueToStrs(r.getNewFrames(data)))
+
+
+	def test_ping(self):
+		r = self.receiver(maxLength=100)
+		self.assertEqual(([], decoders.OK),
+			r.getNewFrames(_maskedFrame('abc', opcode=0x9)))
+		self.assertEqual(['\x8a\x03abc'], r.replies)
+
+
+	def test_close(self):
+		r = self.receiver(maxLength=100)
+		got, code = fstValueToStrs(r.getNewFrames(
+			_maskedFrame('before') + _maskedFrame('', opcode=0x8) +
+			_maskedFrame('after')))
+		self.assertEqual((['before'], decoders.CLOSED), (got, code))
+		self.assertEqual(([], decoders.CLOSED),
+			r.getNewFrames(_maskedFrame('more')))
+
+
+	def test_invalid(self):
+		for data in [
+			'\x81\x05hello', # unmasked
+			'\xc1\x80\x00\x00\x00\x00', # reserved bit
+			'\x83\x80\x00\x00\x00\x00', # reserved opcode
+			'\x09\x80\x00\x00\x00\x00', # fragmented ping
+			_maskedFrame('x' * 126, opcode=0x9), # long ping
+			_maskedFrame('x', opcode=0x0), # continuation without start
+			_maskedFrame('x', fin=False) + _maskedFrame('y'), # interleaved
+		]:
+			r = self.receiver(maxLength=1000)
+			self.assertEqual(decoders.INVALID, r.getNewFrames(data)[1])
+			self.assertEqual(([], decoders.INVALID), r.getNewFrames(_maskedFrame('x')))
+
+
+	def test_tooLong(self):
+		r = self.receiver(maxLength=10)
+		self.assertEqual(([], decoders.TOO_LONG),
+			r.getNewFrames(_maskedFrame('x' * 11)[:6]))
+		r = self.receiver(maxLength=10)
+		self.assertEqual(([], decoders.TOO_LONG), r.getNewFrames(
+			_maskedFrame('x' * 6, fin=False) +
+			_maskedFrame('x' * 5, opcode=0x0)))
+		r = self.receiver(maxLength=10)
+		self.assertEqual((['x' * 10], decoders.OK),
+			fstValueToStrs(r.getNewFrames(_maskedFrame('x' * 10))))
+
+
+	def test_trickledFrameKeptAsPieces(self):
+		"""
+		While a frame trickles in, its header is parsed only once and its
+		payload is kept as a list of pieces.
+		"""
+		r = self.receiver(maxLength=100)
+		data = _maskedFrame('hello there')
+		self.assertEqual(([], decoders.OK), r.getNewFrames(data[:3]))
+		self.assertEqual(None, r._frameLength)
+		self.assertEqual(([], decoders.OK), r.getNewFrames(data[3:10]))
+		self.assertEqual(11, r._frameLength)
+		self.assertEqual(([], decoders.OK), r.getNewFrames(data[10:13]))
+		self.assertEqual([data[6:10], data[10:13]], r._chunks)
+		self.assertEqual((['hello there'], decoders.OK),
+			fstValueToStrs(r.getNewFrames(data[13:])))
+		self.assertEqual([], r._chunks)
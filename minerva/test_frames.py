@@ -8,10 +8,12 @@ from minerva.frames import (
 	HelloFrame, StreamCreatedFrame, StringFrame, SeqNumFrame,
 	SackFrame, StreamStatusFrame, YouCloseItFrame, ResetFrame, CommentFrame,
 	TransportKillFrame, InvalidFrame, InvalidHello, CannotEncode,
-	decodeFrameFromClient, decodeFrameFromServer)
+	decodeFrameFromClient, decodeFrameFromServer, isRestrictedString,
+	areRestrictedStrings, areRestrictedLines, encodeStringFrame,
+	encodeSeqNumFrame, encodeSackFrame, encodeStreamStatusFrame)
 
 from minerva.frames import (
-	FORMAT_XHR, FORMAT_HTMLFILE,
+	FORMAT_XHR, FORMAT_HTMLFILE, MAX_SACK_NUMBERS,
 )
 
 from minerva.window import SACK
@@ -121,7 +123,9 @@ class HelloFrameTests(unittest.TestCase, ReallyEqualMixin):
 				needPaddingBytes=0,
 				httpFormat=None,
 				sack=None,
-				lastSackSeenByClient=SACK(-1, ()))),
+				lastSackSeenByClient=SACK(-1, ()),
+				rangedSack=False,
+				binaryStrings=False)),
 			HelloFrame.decode(sf(s)))
 
 
@@ -207,6 +211,8 @@ class HelloFrameTests(unittest.TestCase, ReallyEqualMixin):
 			# We can pass either a string or a SACK
 			sack=['', '|', SACK(-2, ()), SACK(-1, (-2,))],
 			lastSackSeenByClient=[DeleteProperty, '', '|', SACK(-2, ()), SACK(-1, (-2,))],
+			rangedSack=[2, 3] + listWithout(genericBad, [True, False]),
+			binaryStrings=[2, 3] + listWithout(genericBad, [True, False]),
 		)
 		##print badMutations
 
@@ -231,7 +237,7 @@ class HelloFrameTests(unittest.TestCase, ReallyEqualMixin):
 				ran += 1
 
 		# sanity check; make sure we actually tested things
-		assert ran == 116, "Ran %d times; change this assert as needed" % (ran,)
+		assert ran == 140, "Ran %d times; change this assert as needed" % (ran,)
 
 
 	def test_encode(self):
@@ -249,6 +255,8 @@ class HelloFrameTests(unittest.TestCase, ReallyEqualMixin):
 			streamingResponse=True,
 			needPaddingBytes=0,
 			maxInactivity=1,
+			rangedSack=False,
+			binaryStrings=False,
 			sack=SACK(-1, ())))
 		encodedDecodedHello = HelloFrame.decode(sf(hello.encode()))
 		self.assertEqual(hello, encodedDecodedHello)
@@ -293,6 +301,12 @@ class StringFrameTests(unittest.TestCase):
 		self.assertEqual(s + ' ', StringFrame(sf(s)).encode())
 
 
+	def test_encodeStringFrame(self):
+		s = '\x00unchecked\xfftext'
+		self.assertEqual(s + ' ', encodeStringFrame(s))
+		self.assertEqual(s + ' ', encodeStringFrame(sf(s)))
+
+
 
 class CommentFrameTests(unittest.TestCase):
 
@@ -359,6 +373,11 @@ class SeqNumFrameTests(unittest.TestCase):
 		self.assertEqual('%dN' % 2**53, SeqNumFrame(2**53).encode())
 
 
+	def test_encodeSeqNumFrame(self):
+		self.assertEqual('2N', encodeSeqNumFrame(2))
+		self.assertEqual('%dN' % 2**53, encodeSeqNumFrame(2**53))
+
+
 
 class SackFrameTests(unittest.TestCase):
 
@@ -420,6 +439,59 @@ class SackFrameTests(unittest.TestCase):
 		self.assertEqual('1,4|2A', SackFrame(SACK(2, (1, 4))).encode())
 		self.assertEqual('4|2A', SackFrame(SACK(2, (4,))).encode())
 		self.assertEqual('|2A', SackFrame(SACK(2, ())).encode())
+		self.assertEqual('4,5,6,9|2A', SackFrame(SACK(2, (4, 5, 6, 9))).encode())
+
+
+	def test_encodeRanged(self):
+		self.assertEqual('|2A', SackFrame(SACK(2, ())).encode(ranged=True))
+		self.assertEqual('4|2A', SackFrame(SACK(2, (4,))).encode(ranged=True))
+		self.assertEqual('4,5|2A', SackFrame(SACK(2, (4, 5))).encode(ranged=True))
+		self.assertEqual('4-6,9|2A', SackFrame(SACK(2, (4, 5, 6, 9))).encode(ranged=True))
+		self.assertEqual('4,6-7,9-11|2A',
+			SackFrame(SACK(2, (4, 6, 7, 9, 10, 11))).encode(ranged=True))
+
+
+	def test_encodeSackFrame(self):
+		self.assertEqual('|2A', encodeSackFrame(SACK(2, ())))
+		self.assertEqual('4,5,6,9|2A', encodeSackFrame(SACK(2, (4, 5, 6, 9))))
+		self.assertEqual('4-6,9|2A',
+			encodeSackFrame(SACK(2, (4, 5, 6, 9)), ranged=True))
+
+
+	def test_decodeRanged(self):
+		for s in ('4-6,9|2A', '4,5,6,9|2A', '4-5,6,9|2A', '4,5-6,9|2A'):
+			self.assertEqual(
+				SackFrame(SACK(2, (4, 5, 6, 9))),
+				SackFrame.decode(sf(s)))
+
+
+	def test_encodeDecodeRangedEquality(self):
+		for sack in (SACK(-1, ()), SACK(2, (4,)), SACK(2, (4, 5, 6, 9, 10, 2**53))):
+			self.assertEqual(
+				SackFrame(sack),
+				SackFrame.decode(sf(SackFrame(sack).encode(ranged=True))))
+
+
+	def test_decodeFailedRangeInvalid(self):
+		for s in ('5-4|2A', '4-4|2A', '4-|2A', '-4|2A', '4--6|2A', '4-6-8|2A',
+		'0-%d|2A' % (2**53,), '1,4-%d|2A' % (2**53 + 1,)):
+			self.assertRaises(
+				InvalidFrame,
+				lambda: SackFrame.decode(sf(s)))
+
+
+	def test_decodeFailedRangesExpandTooMuch(self):
+		"""
+		Ranges that would expand to more than L{MAX_SACK_NUMBERS} sackNumbers
+		are rejected, even if every individual range is small enough.
+		"""
+		n = MAX_SACK_NUMBERS
+		ok = '0-%d|-1A' % (n - 1,)
+		self.assertEqual(n, len(SackFrame.decode(sf(ok)).sack.sackList))
+		for s in ('0-%d|-1A' % (n,), '0-%d,%d-%d|-1A' % (n // 2, n // 2 + 2, n + 1)):
+			self.assertRaises(
+				InvalidFrame,
+				lambda: SackFrame.decode(sf(s)))
 
 
 
@@ -451,6 +523,13 @@ class StreamStatusFrameTests(unittest.TestCase):
 
 	def test_encode(self):
 		self.assertEqual('1,4|2T', StreamStatusFrame(SACK(2, (1, 4))).encode())
+		self.assertEqual('1-3|2T', StreamStatusFrame(SACK(2, (1, 2, 3))).encode(ranged=True))
+
+
+	def test_encodeStreamStatusFrame(self):
+		self.assertEqual('1,4|2T', encodeStreamStatusFrame(SACK(2, (1, 4))))
+		self.assertEqual('1-3|2T',
+			encodeStreamStatusFrame(SACK(2, (1, 2, 3)), ranged=True))
 
 
 
@@ -604,4 +683,32 @@ class TransportKillFrameTests(unittest.TestCase):
 			lambda: TransportKillFrame.decode(sf(s)))
 
 
+
+class RestrictedStringTests(unittest.TestCase):
+
+	def test_isRestrictedString(self):
+		self.assertTrue(isRestrictedString(''))
+		self.assertTrue(isRestrictedString(' hello ~'))
+		for bad in ['\x00', '\x1f', '\x7f', '\xff', '\n', 'hello\tworld']:
+			self.assertFalse(isRestrictedString(bad))
+
+
+	def test_areRestrictedStrings(self):
+		self.assertTrue(areRestrictedStrings([]))
+		self.assertTrue(areRestrictedStrings(['', 'a', ' ~']))
+		self.assertFalse(areRestrictedStrings(['okay', u'unicode']))
+		self.assertFalse(areRestrictedStrings(['okay', 3]))
+		for bad in ['\x00', '\x1f', '\x7f', '\xff', '\n', 'hello\tworld']:
+			self.assertFalse(areRestrictedStrings(['okay', bad, 'okay']))
+
+
+	def test_areRestrictedLines(self):
+		self.assertTrue(areRestrictedLines(''))
+		self.assertTrue(areRestrictedLines('hello\n~ world\n\n'))
+		self.assertTrue(areRestrictedLines(buffer('xhello\n', 1)))
+		for bad in ['\x00', '\x1f', '\x7f', '\xff', '\r', '\t']:
+			self.assertFalse(areRestrictedLines('okay\n%s\nokay\n' % (bad,)))
+
+
+
 # TODO: add direct tests for decodeFrameFromClient, decodeFrameFromServer
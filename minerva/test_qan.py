@@ -1,4 +1,6 @@
-from twisted.internet import defer
+import sys
+
+from twisted.internet import defer, task
 from twisted.python import failure
 from twisted.trial import unittest
 
@@ -6,8 +8,24 @@ from webmagic.fakes import ListLog
 
 from minerva.qan import (
 	OkayAnswer, KnownErrorAnswer, UnknownErrorAnswer, Question, Notification,
-	Cancellation, QANHelper, qanFrameToString, InvalidQANFrame,
-	stringToQANFrame, KnownError, UnknownError, QuestionFailed)
+	Cancellation, Batch, PartialAnswer, StreamingAnswer, QANHelper,
+	AnswerCache, qanFrameToString, InvalidQANFrame,
+	stringToQANFrame, KnownError, UnknownError, QuestionFailed,
+	QuestionTimedOut, AnswerTooLarge)
+
+
+def _runPendingCalls(clock):
+	"""
+	Run the calls that are due on L{task.Clock} C{clock}, but unlike
+	C{clock.advance(0)}, not the calls they schedule, like one iteration
+	of a real reactor.
+	"""
+	for call in clock.getDelayedCalls():
+		if call.getTime() <= clock.seconds():
+			clock.calls.remove(call)
+			call.called = True
+			call.func(*call.args, **call.kw)
+
 
 
 class QANFrameTests(unittest.TestCase):
@@ -34,6 +52,7 @@ class QANFrameTests(unittest.TestCase):
 		self.assertEqual("blah|100E", qanFrameToString(KnownErrorAnswer("blah", 100)))
 		self.assertEqual("blah|100U", qanFrameToString(UnknownErrorAnswer("blah", 100)))
 		self.assertEqual("100C", qanFrameToString(Cancellation(100)))
+		self.assertEqual("blah|100P", qanFrameToString(PartialAnswer("blah", 100)))
 
 
 	def test_qanFrameToStringInvalid(self):
@@ -48,6 +67,7 @@ class QANFrameTests(unittest.TestCase):
 		self.assertEqual(UnknownErrorAnswer("blah", 10), stringToQANFrame("blah|10U"))
 		self.assertEqual(Cancellation(10), stringToQANFrame("10C"))
 		self.assertEqual(Notification("blah"), stringToQANFrame("blah#"))
+		self.assertEqual(PartialAnswer("blah", 10), stringToQANFrame("blah|10P"))
 
 
 	def test_stringToQANFrameInvalid(self):
@@ -60,12 +80,48 @@ class QANFrameTests(unittest.TestCase):
 		self.assertRaises(InvalidQANFrame, lambda: stringToQANFrame("Q"))
 
 
+	def test_batch(self):
+		batch = Batch([Question("a|b", 1), Notification("n"), Cancellation(2)])
+		encoded = qanFrameToString(batch)
+		self.assertEqual("6:a|b|1Q2:n#2:2CB", encoded)
+		self.assertEqual(batch, stringToQANFrame(encoded))
+		self.assertEqual(
+			Batch([OkayAnswer("", 3)]), stringToQANFrame("3:|3KB"))
+
+
+	def test_batchInvalid(self):
+		self.assertRaises(TypeError,
+			lambda: qanFrameToString(Batch([Batch([Notification("n")])])))
+		for bad in [
+			"B", # empty
+			"2n#B", # no colon
+			"x:n#B", # bad length
+			"3:n#B", # length too long
+			"1:n#B", # length too short
+			"2:nXB", # bad item
+			"6:2:n#BB", # nested Batch
+		]:
+			self.assertRaises(InvalidQANFrame, lambda: stringToQANFrame(bad))
+
+
+	def test_batchDeeplyNested(self):
+		"""
+		A deeply nested Batch raises L{InvalidQANFrame}, not a
+		C{RuntimeError} from recursing into every level.
+		"""
+		frameString = "n#"
+		for _ in xrange(sys.getrecursionlimit() * 2):
+			frameString = "%d:%sB" % (len(frameString), frameString)
+		self.assertRaises(InvalidQANFrame, lambda: stringToQANFrame(frameString))
+
+
 	def test_repr(self):
 		self.assertEqual("Question('blah', 10)", repr(Question('blah', 10)))
 		self.assertEqual("OkayAnswer('blah', 10)", repr(OkayAnswer('blah', 10)))
 		self.assertEqual("KnownErrorAnswer('blah', 10)", repr(KnownErrorAnswer('blah', 10)))
 		self.assertEqual("Cancellation(10)", repr(Cancellation(10)))
 		self.assertEqual("Notification('blah')", repr(Notification('blah')))
+		self.assertEqual("Batch([Cancellation(10)])", repr(Batch([Cancellation(10)])))
 
 
 
@@ -446,3 +502,696 @@ class QANHelperTests(unittest.TestCase):
 		# Peer can still send an answer to the failed Questions
 		h.handleQANFrame(OkayAnswer("no", 1))
 		h.handleQANFrame(KnownErrorAnswer("what?", 2))
+
+
+	def test_askWithTimeout(self):
+		"""
+		A question that is not answered before its timeout errbacks with
+		L{QuestionTimedOut}, and a L{Cancellation} is sent to the peer.
+		"""
+		sent = ListLog()
+		fatalErrors = ListLog()
+		clock = task.Clock()
+		h = QANHelper(None, None, sent.append, fatalErrors.append, clock)
+		d1 = h.ask("going to the theater?", timeout=10)
+		d2 = h.ask("mu?", timeout=20)
+		d3 = h.ask("no timeout")
+		self.assertEqual([
+			Question("going to the theater?", 1),
+			Question("mu?", 2),
+			Question("no timeout", 3),
+		], sent.getNew())
+		# One DelayedCall for all questions
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+
+		clock.advance(9.5)
+		self.assertFalse(d1.called)
+		clock.advance(0.5)
+		self.assertEqual([Cancellation(1)], sent.getNew())
+		d1_ = self.assertFailure(d1, QuestionTimedOut)
+		assert d1_.called
+		self.assertFalse(d2.called)
+
+		clock.advance(10)
+		self.assertEqual([Cancellation(2)], sent.getNew())
+		d2_ = self.assertFailure(d2, QuestionTimedOut)
+		assert d2_.called
+		self.assertEqual([], clock.getDelayedCalls())
+		self.assertFalse(d3.called)
+
+		# Timed-out questions are forgotten, and late answers are ignored.
+		self.assertEqual("<QANHelper asked 3 questions, waiting for 1 "
+			"peer answers and 0 local answers>", repr(h))
+		h.handleQANFrame(PartialAnswer("ye", 1))
+		h.handleQANFrame(OkayAnswer("yes", 1))
+		h.handleQANFrame(KnownErrorAnswer("what?", 2))
+		self.assertEqual([], fatalErrors.getNew())
+
+		# But a second answer to a timed-out question is a fatal error,
+		h.handleQANFrame(OkayAnswer("yes", 1))
+		self.assertEqual(["Received an answer with invalid qid: 1"],
+			fatalErrors.getNew())
+
+		# and so is an answer to a qid we never used.
+		h.handleQANFrame(OkayAnswer("yes", 4))
+		self.assertEqual(["Received an answer with invalid qid: 4"],
+			fatalErrors.getNew())
+
+
+	def test_askWithTimeoutAnsweredAfterGrace(self):
+		"""
+		A timed-out question is remembered for only
+		L{QANHelper.timedOutAnswerGrace} seconds; an answer after that is
+		a fatal error.
+		"""
+		fatalErrors = ListLog()
+		clock = task.Clock()
+		h = QANHelper(None, None, lambda _: None, fatalErrors.append, clock)
+		d = h.ask("what?", timeout=10)
+		clock.advance(10)
+		self.assertFailure(d, QuestionTimedOut)
+
+		clock.advance(h.timedOutAnswerGrace)
+		h.handleQANFrame(OkayAnswer("late", 1))
+		self.assertEqual(["Received an answer with invalid qid: 1"],
+			fatalErrors.getNew())
+		self.assertEqual(set(), h._timedOutQids)
+
+
+	def test_duplicateAnswer(self):
+		"""
+		A second answer to a question is a fatal error.
+		"""
+		fatalErrors = ListLog()
+		h = QANHelper(None, None, lambda _: None, fatalErrors.append)
+		answers = []
+		h.ask("what?").addCallback(answers.append)
+		h.handleQANFrame(OkayAnswer("this", 1))
+		self.assertEqual(["this"], answers)
+		self.assertEqual([], fatalErrors.getNew())
+		h.handleQANFrame(OkayAnswer("that", 1))
+		self.assertEqual(["Received an answer with invalid qid: 1"],
+			fatalErrors.getNew())
+		h.handleQANFrame(PartialAnswer("that", 1))
+		self.assertEqual(["Received a PartialAnswer with invalid qid: 1"],
+			fatalErrors.getNew())
+		self.assertEqual(["this"], answers)
+
+
+	def test_askWithTimeoutAnswered(self):
+		"""
+		A question answered before its timeout does not time out.
+		"""
+		sent = ListLog()
+		clock = task.Clock()
+		h = QANHelper(None, None, sent.append, None, clock)
+		answers = []
+		d = h.ask("what?", timeout=10)
+		d.addCallback(answers.append)
+		h.handleQANFrame(OkayAnswer("no.", 1))
+		self.assertEqual(["no."], answers)
+
+		clock.advance(10)
+		self.assertEqual([Question("what?", 1)], sent.getNew())
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+	def test_askWithEarlierTimeout(self):
+		"""
+		Asking a question with a timeout earlier than the pending ones
+		reschedules the one DelayedCall.
+		"""
+		sent = ListLog()
+		clock = task.Clock()
+		h = QANHelper(None, None, sent.append, None, clock)
+		d1 = h.ask("slow", timeout=100)
+		d2 = h.ask("fast", timeout=1)
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+		sent.getNew()
+
+		clock.advance(1)
+		self.assertEqual([Cancellation(2)], sent.getNew())
+		self.assertFailure(d2, QuestionTimedOut)
+		self.assertFalse(d1.called)
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+
+
+	def test_askWithTimeoutNeedsClock(self):
+		sent = ListLog()
+		h = QANHelper(None, None, sent.append, None)
+		self.assertRaises(ValueError, lambda: h.ask("what?", timeout=10))
+		self.assertEqual([], sent.getNew())
+
+
+	def test_failAllCancelsTimeouts(self):
+		sent = ListLog()
+		clock = task.Clock()
+		h = QANHelper(None, None, sent.append, None, clock)
+		d = h.ask("what?", timeout=10)
+		h.failAll("just because")
+		self.assertFailure(d, QuestionFailed)
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+	def test_maxInFlight(self):
+		"""
+		The peer's Questions beyond C{maxInFlight} are queued and started
+		in order when a slot frees up; Questions beyond C{maxQueued} are
+		rejected with a L{KnownErrorAnswer}.
+		"""
+		sent = ListLog()
+		started = ListLog()
+		deferreds = {}
+		def bodyReceived(body, isQuestion):
+			started.append(body)
+			d = deferreds[body] = defer.Deferred()
+			return d
+
+		h = QANHelper(bodyReceived, None, sent.append, None,
+			maxInFlight=2, maxQueued=1)
+		for qid in (1, 2, 3, 4):
+			h.handleQANFrame(Question("q%d" % (qid,), qid))
+
+		self.assertEqual(["q1", "q2"], started.getNew())
+		self.assertEqual([KnownErrorAnswer("Too many questions", 4)], sent.getNew())
+		self.assertEqual((2, 1), (h.countInFlight(), h.countQueued()))
+
+		deferreds["q1"].callback("a1")
+		self.assertEqual([OkayAnswer("a1", 1)], sent.getNew())
+		self.assertEqual(["q3"], started.getNew())
+		self.assertEqual((2, 0), (h.countInFlight(), h.countQueued()))
+
+		deferreds["q2"].errback(KnownError("e2"))
+		deferreds["q3"].callback("a3")
+		self.assertEqual([
+			KnownErrorAnswer("e2", 2),
+			OkayAnswer("a3", 3),
+		], sent.getNew())
+		self.assertEqual((0, 0), (h.countInFlight(), h.countQueued()))
+
+
+	def test_maxInFlightCancelQueued(self):
+		"""
+		A Cancellation for a queued Question removes it from the queue and
+		answers it like a cancelled in-flight Question.
+		"""
+		sent = ListLog()
+		fatalErrors = ListLog()
+		started = ListLog()
+		def bodyReceived(body, isQuestion):
+			started.append(body)
+			return defer.Deferred()
+
+		h = QANHelper(bodyReceived, None, sent.append, fatalErrors.append,
+			maxInFlight=1, maxQueued=10)
+		h.handleQANFrame(Question("q1", 1))
+		h.handleQANFrame(Question("q2", 2))
+		self.assertEqual((1, 1), (h.countInFlight(), h.countQueued()))
+
+		# A duplicate qid of a queued Question is a fatal error
+		h.handleQANFrame(Question("q2 again", 2))
+		self.assertEqual(["Received Question with duplicate qid: 2"],
+			fatalErrors.getNew())
+
+		h.handleQANFrame(Cancellation(2))
+		self.assertEqual([UnknownErrorAnswer("CancelledError", 2)], sent.getNew())
+		self.assertEqual((1, 0), (h.countInFlight(), h.countQueued()))
+
+		h.handleQANFrame(Cancellation(1))
+		self.assertEqual([UnknownErrorAnswer("CancelledError", 1)], sent.getNew())
+		self.assertEqual(["q1"], started.getNew())
+
+
+	def test_maxInFlightManySynchronousQueued(self):
+		"""
+		When a slot frees up, a long queue of Questions that are answered
+		synchronously is drained without recursing once per Question.
+		"""
+		sent = []
+		slow = defer.Deferred()
+		def bodyReceived(body, isQuestion):
+			if body == "slow":
+				return slow
+			return body
+
+		h = QANHelper(bodyReceived, None, sent.append, None,
+			maxInFlight=1, maxQueued=5000)
+		h.handleQANFrame(Question("slow", 1))
+		for qid in xrange(2, 3002):
+			h.handleQANFrame(Question("q%d" % (qid,), qid))
+		self.assertEqual((1, 3000), (h.countInFlight(), h.countQueued()))
+
+		slow.callback("done")
+		self.assertEqual((0, 0), (h.countInFlight(), h.countQueued()))
+		self.assertEqual(3001, len(sent))
+		self.assertEqual(OkayAnswer("done", 1), sent[0])
+		self.assertEqual(OkayAnswer("q3001", 3001), sent[-1])
+
+
+	def test_failAllDropsQueued(self):
+		sent = ListLog()
+		h = QANHelper(lambda body, isQuestion: defer.Deferred(), None,
+			sent.append, None, maxInFlight=1, maxQueued=10)
+		h.handleQANFrame(Question("q1", 1))
+		h.handleQANFrame(Question("q2", 2))
+		h.failAll("just because")
+		self.assertEqual((1, 0), (h.countInFlight(), h.countQueued()))
+		self.assertEqual([], sent.getNew())
+
+
+	def test_batchReceived(self):
+		"""
+		The frames in a L{Batch} are handled in order.
+		"""
+		sent = ListLog()
+		received = ListLog()
+		def bodyReceived(body, isQuestion):
+			received.append((body, isQuestion))
+			return body.upper()
+
+		h = QANHelper(bodyReceived, None, sent.append, None)
+		h.handleQANFrame(Batch([
+			Question("one", 1), Notification("two"), Question("three", 2)]))
+		self.assertEqual(
+			[("one", True), ("two", False), ("three", True)], received.getNew())
+		self.assertEqual(
+			[OkayAnswer("ONE", 1), OkayAnswer("THREE", 2)], sent.getNew())
+
+
+	def test_batchStopsAfterFatalError(self):
+		sent = ListLog()
+		fatalErrors = ListLog()
+		h = QANHelper(lambda body, isQuestion: defer.Deferred(), None,
+			sent.append, fatalErrors.append)
+		h.handleQANFrame(Batch([
+			Question("one", 1), Question("dupe", 1), Question("two", 2)]))
+		self.assertEqual(["Received Question with duplicate qid: 1"],
+			fatalErrors.getNew())
+		self.assertEqual(1, h.countInFlight())
+
+
+	def _streamingHelper(self, chunks, clock=None, waitForSendQueue=None):
+		sent = ListLog()
+		logged = ListLog()
+		h = QANHelper(lambda body, isQuestion: StreamingAnswer(chunks),
+			lambda msg, f: logged.append(msg), sent.append, None, clock,
+			waitForSendQueue=waitForSendQueue)
+		return h, sent, logged
+
+
+	def test_streamingAnswer(self):
+		"""
+		With a clock, one chunk of a L{StreamingAnswer} is sent per reactor
+		iteration, and the last chunk is sent in the L{OkayAnswer}.
+		"""
+		clock = task.Clock()
+		h, sent, logged = self._streamingHelper(iter(["a", "b", "c"]), clock)
+		h.handleQANFrame(Question("big", 1))
+		self.assertEqual([], sent.getNew())
+		self.assertEqual(1, h.countInFlight())
+
+		_runPendingCalls(clock)
+		self.assertEqual([PartialAnswer("a", 1)], sent.getNew())
+		_runPendingCalls(clock)
+		self.assertEqual([PartialAnswer("b", 1)], sent.getNew())
+		_runPendingCalls(clock)
+		self.assertEqual([OkayAnswer("c", 1)], sent.getNew())
+		self.assertEqual(0, h.countInFlight())
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+	def test_streamingAnswerWithoutClock(self):
+		h, sent, logged = self._streamingHelper(["a", "b", "c"])
+		h.handleQANFrame(Question("big", 1))
+		self.assertEqual([
+			PartialAnswer("a", 1),
+			PartialAnswer("b", 1),
+			OkayAnswer("c", 1),
+		], sent.getNew())
+
+
+	def test_streamingAnswerEmpty(self):
+		h, sent, logged = self._streamingHelper([])
+		h.handleQANFrame(Question("big", 1))
+		self.assertEqual([OkayAnswer("", 1)], sent.getNew())
+
+
+	def test_streamingAnswerRaises(self):
+		def chunks():
+			yield "a"
+			yield "b"
+			raise KnownError("ran out")
+
+		h, sent, logged = self._streamingHelper(chunks())
+		h.handleQANFrame(Question("big", 1))
+		self.assertEqual([
+			PartialAnswer("a", 1),
+			KnownErrorAnswer("ran out", 1),
+		], sent.getNew())
+		self.assertEqual(0, h.countInFlight())
+
+
+	def test_streamingAnswerInvalidLastChunk(self):
+		"""
+		If the last chunk of a L{StreamingAnswer} is rejected by
+		C{sendQANFrame}, the peer gets an error answer instead of the
+		L{OkayAnswer}.
+		"""
+		sent = ListLog()
+		logged = ListLog()
+		def sendQANFrame(frame):
+			if '\x00' in getattr(frame, 'body', ''):
+				raise ValueError("bad body")
+			sent.append(frame)
+
+		clock = task.Clock()
+		h = QANHelper(
+			lambda body, isQuestion: StreamingAnswer(iter(["ok1", "ok2", "bad\x00"])),
+			lambda msg, f: logged.append(msg), sendQANFrame, None, clock)
+		h.handleQANFrame(Question("big", 1))
+		for _ in xrange(3):
+			_runPendingCalls(clock)
+		self.assertEqual([
+			PartialAnswer("ok1", 1),
+			PartialAnswer("ok2", 1),
+			UnknownErrorAnswer("Uncaught exception", 1),
+		], sent.getNew())
+		self.assertEqual(["Peer's Question #1 caused uncaught exception"],
+			logged.getNew())
+		self.assertEqual(0, h.countInFlight())
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+	def test_streamingAnswerCancelled(self):
+		closed = []
+		def chunks():
+			try:
+				while True:
+					yield "x"
+			finally:
+				closed.append(True)
+
+		clock = task.Clock()
+		h, sent, logged = self._streamingHelper(chunks(), clock)
+		h.handleQANFrame(Question("big", 1))
+		_runPendingCalls(clock)
+		self.assertEqual([PartialAnswer("x", 1)], sent.getNew())
+		h.handleQANFrame(Cancellation(1))
+		self.assertEqual([UnknownErrorAnswer("CancelledError", 1)], sent.getNew())
+		self.assertEqual([True], closed)
+		self.assertEqual([], clock.getDelayedCalls())
+		self.assertEqual(0, h.countInFlight())
+
+
+	def test_failAllStopsStreamingAnswers(self):
+		clock = task.Clock()
+		h, sent, logged = self._streamingHelper(iter(["a", "b", "c"]), clock)
+		h.handleQANFrame(Question("big", 1))
+		h.failAll("just because")
+		self.assertEqual([], clock.getDelayedCalls())
+		self.assertEqual(0, h.countInFlight())
+		self.assertEqual([], sent.getNew())
+
+
+	def test_streamingAnswerWaitsForSendQueue(self):
+		"""
+		When C{waitForSendQueue} returns a Deferred, no more chunks are
+		pulled from the iterator until it fires, even without a clock.
+		"""
+		waiting = []
+		def waitForSendQueue():
+			if len(sent) >= 2 and not waiting:
+				waiting.append(defer.Deferred())
+				return waiting[0]
+			return None
+
+		pulled = []
+		def chunks():
+			for c in "abcd":
+				pulled.append(c)
+				yield c
+
+		h, sent, logged = self._streamingHelper(chunks(),
+			waitForSendQueue=waitForSendQueue)
+		h.handleQANFrame(Question("big", 1))
+		self.assertEqual([PartialAnswer("a", 1), PartialAnswer("b", 1)], sent)
+		self.assertEqual(["a", "b", "c"], pulled)
+		self.assertEqual(1, h.countInFlight())
+
+		waiting[0].callback(None)
+		self.assertEqual([
+			PartialAnswer("a", 1),
+			PartialAnswer("b", 1),
+			PartialAnswer("c", 1),
+			OkayAnswer("d", 1),
+		], sent.getNew())
+		self.assertEqual(0, h.countInFlight())
+		self.assertEqual([], logged.getNew())
+
+
+	def test_streamingAnswerCancelledWhileWaiting(self):
+		d = defer.Deferred()
+		h, sent, logged = self._streamingHelper(iter(["a", "b", "c"]),
+			waitForSendQueue=lambda: d)
+		h.handleQANFrame(Question("big", 1))
+		self.assertEqual([], sent.getNew())
+		h.handleQANFrame(Cancellation(1))
+		self.assertEqual([UnknownErrorAnswer("CancelledError", 1)], sent.getNew())
+		d.callback(None)
+		self.assertEqual([], sent.getNew())
+		self.assertEqual([], logged.getNew())
+
+
+	def test_partialAnswersReassembled(self):
+		sent = ListLog()
+		h = QANHelper(None, None, sent.append, None)
+		answers = []
+		d = h.ask("big?")
+		d.addCallback(answers.append)
+		h.handleQANFrame(PartialAnswer("a", 1))
+		h.handleQANFrame(PartialAnswer("b", 1))
+		self.assertEqual([], answers)
+		h.handleQANFrame(OkayAnswer("c", 1))
+		self.assertEqual(["abc"], answers)
+
+
+	def test_partialAnswersIncremental(self):
+		sent = ListLog()
+		h = QANHelper(None, None, sent.append, None)
+		parts = []
+		answers = []
+		d = h.ask("big?", partReceived=parts.append)
+		d.addCallback(answers.append)
+		h.handleQANFrame(PartialAnswer("a", 1))
+		h.handleQANFrame(PartialAnswer("b", 1))
+		self.assertEqual(["a", "b"], parts)
+		h.handleQANFrame(OkayAnswer("c", 1))
+		self.assertEqual(["c"], answers)
+
+
+	def test_partialAnswerThenError(self):
+		h = QANHelper(None, None, lambda _: None, None)
+		d = h.ask("big?")
+		h.handleQANFrame(PartialAnswer("a", 1))
+		h.handleQANFrame(UnknownErrorAnswer("oops", 1))
+		self.assertFailure(d, UnknownError)
+		self.assertEqual({}, h._answerParts)
+
+
+	def test_partialAnswersTooLarge(self):
+		"""
+		If the buffered L{PartialAnswer} bodies exceed C{maxAnswerBytes},
+		the question is cancelled and fails with L{AnswerTooLarge}; later
+		parts of its answer are ignored.
+		"""
+		sent = ListLog()
+		fatalErrors = ListLog()
+		h = QANHelper(None, None, sent.append, fatalErrors.append,
+			maxAnswerBytes=5)
+		d = h.ask("big?")
+		self.assertEqual([Question("big?", 1)], sent.getNew())
+		h.handleQANFrame(PartialAnswer("abc", 1))
+		h.handleQANFrame(PartialAnswer("de", 1))
+		self.assertEqual([], sent.getNew())
+		h.handleQANFrame(PartialAnswer("f", 1))
+		self.assertEqual([Cancellation(1)], sent.getNew())
+		self.assertFailure(d, AnswerTooLarge)
+		self.assertEqual({}, h._answerParts)
+
+		h.handleQANFrame(PartialAnswer("g", 1))
+		h.handleQANFrame(OkayAnswer("h", 1))
+		self.assertEqual([], fatalErrors.getNew())
+		return d
+
+
+	def test_partialAnswerInvalidQid(self):
+		fatalErrors = ListLog()
+		h = QANHelper(None, None, lambda _: None, fatalErrors.append)
+		d = h.ask("big?")
+		d.cancel()
+		self.assertFailure(d, defer.CancelledError)
+		# Parts of an answer to a cancelled question are ignored
+		h.handleQANFrame(PartialAnswer("a", 1))
+		self.assertEqual([], fatalErrors.getNew())
+		h.handleQANFrame(PartialAnswer("a", 2))
+		self.assertEqual(["Received a PartialAnswer with invalid qid: 2"],
+			fatalErrors.getNew())
+
+
+
+class AnswerCacheTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = task.Clock()
+		self.computing = {}
+		self.computed = ListLog()
+
+
+	def _compute(self, body):
+		self.computed.append(body)
+		d = self.computing[body] = defer.Deferred()
+		return d
+
+
+	def _answers(self, cache, bodies):
+		answers = ListLog()
+		for body in bodies:
+			cache.answer(body, self._compute).addBoth(answers.append)
+		return answers
+
+
+	def test_coalesced(self):
+		"""
+		Concurrent identical Questions share one computation.
+		"""
+		cache = AnswerCache(self.clock)
+		answers = self._answers(cache, ["a", "a", "b", "a"])
+		self.assertEqual(["a", "b"], self.computed.getNew())
+		self.assertEqual((2, 2, 0), (cache.misses, cache.coalesced, cache.hits))
+
+		self.computing["a"].callback("A")
+		self.assertEqual(["A", "A", "A"], answers.getNew())
+		self.computing["b"].callback("B")
+		self.assertEqual(["B"], answers.getNew())
+
+		# Without a ttl, nothing is kept.
+		self._answers(cache, ["a"])
+		self.assertEqual(["a"], self.computed.getNew())
+		self.assertEqual(0, cache.hits)
+
+
+	def test_ttl(self):
+		cache = AnswerCache(self.clock, ttl=10)
+		self._answers(cache, ["a"])
+		self.computing["a"].callback("A")
+		self.computed.getNew()
+
+		self.clock.advance(9)
+		answers = self._answers(cache, ["a", "a"])
+		self.assertEqual(["A", "A"], answers.getNew())
+		self.assertEqual([], self.computed.getNew())
+		self.assertEqual(2, cache.hits)
+
+		self.clock.advance(1)
+		self._answers(cache, ["a"])
+		self.assertEqual(["a"], self.computed.getNew())
+		self.assertEqual(2, cache.misses)
+
+
+	def test_lruEviction(self):
+		cache = AnswerCache(self.clock, ttl=10, maxSize=2)
+		for body in ("a", "b"):
+			self._answers(cache, [body])
+			self.computing[body].callback(body.upper())
+		# "a" is now more recently used than "b"
+		self._answers(cache, ["a"])
+		self._answers(cache, ["c"])
+		self.computing["c"].callback("C")
+		self.computed.getNew()
+
+		self._answers(cache, ["a", "c", "b"])
+		self.assertEqual(["b"], self.computed.getNew())
+
+
+	def test_errorsNotKept(self):
+		cache = AnswerCache(self.clock, ttl=10)
+		answers = self._answers(cache, ["a", "a"])
+		self.computing["a"].errback(KnownError("no"))
+		failures = answers.getNew()
+		self.assertEqual(2, len(failures))
+		for f in failures:
+			self.assertTrue(f.check(KnownError))
+
+		self._answers(cache, ["a"])
+		self.assertEqual(["a", "a"], self.computed.getNew())
+
+
+	def test_cancelOneWaiter(self):
+		"""
+		Cancelling one Question's Deferred does not affect the others.
+		"""
+		cache = AnswerCache(self.clock)
+		d1 = cache.answer("a", self._compute)
+		d2 = cache.answer("a", self._compute)
+		d1.cancel()
+		self.assertFailure(d1, defer.CancelledError)
+		answers = []
+		d2.addCallback(answers.append)
+		self.computing["a"].callback("A")
+		self.assertEqual(["A"], answers)
+
+
+	def test_cancelWaiterFromAnotherWaiter(self):
+		"""
+		A waiter's callback can cancel another waiter for the same key,
+		even after it starts a new computation for that key.
+		"""
+		cache = AnswerCache(self.clock)
+		d1 = cache.answer("a", self._compute)
+		d2 = cache.answer("a", self._compute)
+		d3 = cache.answer("a", self._compute)
+		later = []
+		def gotAnswer(answer):
+			later.append(cache.answer("a", self._compute))
+			d2.cancel()
+			d3.cancel()
+		d1.addCallback(gotAnswer)
+		self.computing["a"].callback("A")
+		self.assertFailure(d2, defer.CancelledError)
+		self.assertFailure(d3, defer.CancelledError)
+		self.assertEqual(["a", "a"], self.computed.getNew())
+
+		answers = []
+		later[0].addCallback(answers.append)
+		self.computing["a"].callback("B")
+		self.assertEqual(["B"], answers)
+
+
+	def test_key(self):
+		cache = AnswerCache(self.clock, key=lambda body: body.lower())
+		answers = self._answers(cache, ["a", "A"])
+		self.assertEqual(["a"], self.computed.getNew())
+		self.computing["a"].callback("x")
+		self.assertEqual(["x", "x"], answers.getNew())
+
+
+	def test_withQANHelper(self):
+		"""
+		L{AnswerCache} works as the C{bodyReceived} of a L{QANHelper}.
+		"""
+		cache = AnswerCache(self.clock, ttl=1)
+		sent = ListLog()
+		h = QANHelper(
+			lambda body, isQuestion: cache.answer(body, self._compute),
+			None, sent.append, None)
+		h.handleQANFrame(Question("a", 1))
+		h.handleQANFrame(Question("a", 2))
+		self.computing["a"].callback("A")
+		self.assertEqual([OkayAnswer("A", 1), OkayAnswer("A", 2)], sent.getNew())
+
+
+	def test_repr(self):
+		cache = AnswerCache(self.clock, ttl=1)
+		self._answers(cache, ["a", "a"])
+		self.assertEqual("<AnswerCache with 0 answers, 1 computing; "
+			"0 hits, 1 misses, 1 coalesced>", repr(cache))
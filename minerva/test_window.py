@@ -170,6 +170,100 @@ class QueueTests(unittest.TestCase):
 		self.assertEqual([(2, 'two'), (4, 'four')], list(q.iterItems()))
 
 
+	def test_handleSACKHolesThenAck(self):
+		"""
+		Items SACKed out of order are not yielded again, and a later
+		ackNumber that passes over them does not double-count their size.
+		"""
+		q = Queue()
+		q.extend(['zero', 'one', 'two', 'three', 'four'])
+		self.assertEqual(False, q.handleSACK(SACK(-1, (1, 2, 4))))
+		self.assertEqual(2, q.getQueuedCount())
+		self.assertEqual([(3, 'three')], list(q.iterItems(start=1)))
+		self.assertEqual(False, q.handleSACK(SACK(2, (4,))))
+		self.assertEqual([(3, 'three')], list(q.iterItems()))
+		self.assertEqual(1, q.getQueuedCount())
+		self.assertEqual(totalSizeOf('three'), q.getMaxConsumption())
+		self.assertEqual(False, q.handleSACK(SACK(4, ())))
+		self.assertEqual(0, q.getQueuedCount())
+		self.assertEqual(0, q.getMaxConsumption())
+		q.append('five')
+		self.assertEqual([(5, 'five')], list(q.iterItems()))
+
+
+	def test_manyItemsWithCompaction(self):
+		"""
+		Queue keeps the correct seqNums after ACKing enough items to
+		cause its internal storage to be compacted.
+		"""
+		q = Queue()
+		q.extend(str(n) for n in xrange(2000))
+		for ackNum in xrange(0, 1990, 7):
+			self.assertEqual(False, q.handleSACK(SACK(ackNum, (ackNum + 2,))))
+			expected = [(n, str(n)) for n in xrange(ackNum + 1, 2000)
+				if n != ackNum + 2]
+			self.assertEqual(expected[:3], list(q.iterItems())[:3])
+			self.assertEqual(len(expected), q.getQueuedCount())
+		self.assertEqual([(1999, '1999')], list(q.iterItems(start=1999)))
+		self.assertEqual([], list(q.iterItems(start=2000)))
+		q.append('2000')
+		self.assertEqual([(1999, '1999'), (2000, '2000')], list(q.iterItems(start=1999)))
+
+
+	def test_modifyWhileIterating(self):
+		"""
+		The queue can be modified while the caller is iterating over
+		C{iterItems}.
+		"""
+		q = Queue()
+		q.extend(['zero', 'one', 'two'])
+		got = []
+		for seqNum, item in q.iterItems():
+			got.append((seqNum, item))
+			q.handleSACK(SACK(seqNum, ()))
+			q.append('x')
+		self.assertEqual([(0, 'zero'), (1, 'one'), (2, 'two')], got)
+		self.assertEqual(3, q.getQueuedCount())
+
+
+	def test_getEncodedItems(self):
+		"""
+		getEncodedItems encodes each item once per key, and counts the
+		kept encodings in getMaxConsumption.
+		"""
+		calls = []
+		def encode(item):
+			calls.append(item)
+			return item.upper()
+
+		q = Queue()
+		q.extend(['zero', 'one', 'two'])
+		sizeBefore = q.getMaxConsumption()
+		self.assertEqual([(1, 'ONE'), (2, 'TWO')], q.getEncodedItems(1, 'k', encode))
+		self.assertEqual(['one', 'two'], calls)
+		self.assertEqual(
+			sizeBefore + totalSizeOf('ONE') + totalSizeOf('TWO'),
+			q.getMaxConsumption())
+
+		self.assertEqual(
+			[(0, 'ZERO'), (1, 'ONE'), (2, 'TWO')], q.getEncodedItems(None, 'k', encode))
+		self.assertEqual(['one', 'two', 'zero'], calls)
+
+		# A different key encodes again
+		self.assertEqual([(2, 'two!')], q.getEncodedItems(2, 'k2', lambda i: i + '!'))
+		self.assertEqual([(0, 'zero'), (1, 'one'), (2, 'two')], list(q.iterItems()))
+
+
+	def test_getEncodedItemsSizeRemovedOnSACK(self):
+		q = Queue()
+		q.extend(['zero', 'one', 'two'])
+		q.getEncodedItems(None, 'k', lambda i: i * 2)
+		q.handleSACK(SACK(0, (2,)))
+		self.assertEqual(
+			totalSizeOf('one') + totalSizeOf('oneone'), q.getMaxConsumption())
+		self.assertEqual([(1, 'oneone')], q.getEncodedItems(None, 'k', None))
+
+
 
 class IncomingTests(unittest.TestCase):
 	"""
@@ -263,6 +357,64 @@ class IncomingTests(unittest.TestCase):
 		self.assertEqual(SACK(1, ()), i.getSACK())
 
 
+	def test_itemGivenTwiceWhileUndeliverable(self):
+		"""
+		If an undeliverable item is given again, it is ignored, and its size
+		is not counted twice.
+		"""
+		i = Incoming()
+		i.give([[2, 'string2']])
+		i.give([[2, 'string2']])
+		self.assertEqual(1, i.getUndeliverableCount())
+		self.assertEqual(totalSizeOf('string2'), i.getMaxConsumption())
+		self.assertEqual(SACK(-1, (2,)), i.getSACK())
+
+
+	def test_rangesMergeAndDeliver(self):
+		"""
+		Runs of undeliverable items are merged as gaps are filled, and the
+		first run is delivered in order once its gap is filled.
+		"""
+		i = Incoming()
+		i.give([[2, 's2'], [3, 's3'], [7, 's7'], [5, 's5']])
+		self.assertEqual(SACK(-1, (2, 3, 5, 7)), i.getSACK())
+		i.give([[6, 's6']])
+		self.assertEqual(SACK(-1, (2, 3, 5, 6, 7)), i.getSACK())
+		i.give([[4, 's4']])
+		self.assertEqual(SACK(-1, (2, 3, 4, 5, 6, 7)), i.getSACK())
+		self.assertEqual((['s0'], False), i.give([[0, 's0']]))
+		self.assertEqual(SACK(0, (2, 3, 4, 5, 6, 7)), i.getSACK())
+		self.assertEqual(
+			(['s1', 's2', 's3', 's4', 's5', 's6', 's7', 's8'], False),
+			i.give([[1, 's1'], [8, 's8']]))
+		self.assertEqual(SACK(8, ()), i.getSACK())
+		self.assertEqual(0, i.getMaxConsumption())
+
+
+	def test_getSACKCached(self):
+		"""
+		L{Incoming.getSACK} returns the same object until C{give} changes
+		which items have been received.
+		"""
+		i = Incoming()
+		i.give([[0, 's0'], [2, 's2']])
+		sack = i.getSACK()
+		self.assertIdentical(sack, i.getSACK())
+		# Already-delivered and already-cached items do not change the SACK
+		i.give([[0, 's0'], [2, 's2']])
+		self.assertIdentical(sack, i.getSACK())
+		i.give([[3, 's3']])
+		self.assertNotIdentical(sack, i.getSACK())
+		self.assertEqual(SACK(0, (2, 3)), i.getSACK())
+
+
+	def test_integralFloatSeqNums(self):
+		i = Incoming()
+		self.assertEqual(([], False), i.give([[1.0, 's1'], [2.0, 's2']]))
+		self.assertEqual((['s0', 's1', 's2'], False), i.give([[0.0, 's0']]))
+		self.assertEqual(SACK(2, ()), i.getSACK())
+
+
 	def test_negativeSequenceNum(self):
 		i = Incoming()
 		self.assertRaises(ValueError, lambda: i.give([[-1, 'string']]))
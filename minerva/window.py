@@ -6,6 +6,7 @@ This entire file is private; you should not need to import it.
 
 import sys
 import operator
+from bisect import bisect_right
 
 from strfrag import StringFragment
 
@@ -55,27 +56,49 @@ class Queue(object):
 	multiple times (if a connection/transport fails).  It keeps track
 	of how much memory the Queue is using, in case you want to
 	do flow control.
+
+	Items are kept in a list indexed by (seqNum - C{_base}), with
+	C{_head} pointing at the first item that has not been ACKed.  Items
+	that were SACKed out of order are replaced by C{None} (a "hole")
+	until the ackNumber passes them.  This makes append, cumulative ACK,
+	and C{iterItems(start)} cost time proportional only to the number of
+	items touched, instead of sorting the entire queue.
+
+	Each slot is an (item, size) tuple, or (item, size, encodings) after
+	L{getEncodedItems} has encoded the item.
 	"""
-	__slots__ = ('_counter', '_items', '_size')
+	__slots__ = ('_counter', '_items', '_base', '_head', '_count', '_size')
+
+	# Compact the list when at least this many dead slots are at its front.
+	_compactThreshold = 256
 
 	def __init__(self):
 		self._counter = -1
-		self._items = {}
+		self._items = []
+		# seqNum of self._items[0]
+		self._base = 0
+		# Index of the first slot that has not been ACKed
+		self._head = 0
+		# Number of non-hole items
+		self._count = 0
 		self._size = 0
 
 
 	def append(self, item):
 		size = totalSizeOf(item)
-		self._items[self._counter + 1] = (item, size)
+		self._items.append((item, size))
 		self._counter += 1
+		self._count += 1
 		self._size += size
 
 
 	def extend(self, items):
+		append = self._items.append
 		for item in items:
 			size = totalSizeOf(item)
-			self._items[self._counter + 1] = (item, size)
+			append((item, size))
 			self._counter += 1
+			self._count += 1
 			self._size += size
 
 
@@ -94,11 +117,65 @@ class Queue(object):
 			if start is not None:
 				assert start >= 0, start
 
-		sortedItems = self._items.items()
-		sortedItems.sort()
-		for seqNum, (item, size) in sortedItems:
-			if start is None or seqNum >= start:
-				yield (seqNum, item)
+		head = self._head
+		if start is not None and start - self._base > head:
+			head = start - self._base
+		seqNum = self._base + head
+		# Iterate over a copy of the slots we need, so that the caller
+		# can modify the queue while iterating.
+		for entry in self._items[head:]:
+			if entry is not None:
+				yield (seqNum, entry[0])
+			seqNum += 1
+
+
+	def getEncodedItems(self, start, key, encode):
+		"""
+		Like L{iterItems}, but return a list of (seqNum, encodedItem), where
+		encodedItem is C{encode(item)}.  The encoded item is kept in the
+		queue (keyed by C{key}) until the item is removed, so getting the
+		same item again with the same C{key} does not call C{encode}.
+		Kept encodings are included in L{getMaxConsumption}.
+		"""
+		if __debug__:
+			if start is not None:
+				assert start >= 0, start
+
+		items = self._items
+		base = self._base
+		idx = self._head
+		if start is not None and start - base > idx:
+			idx = start - base
+		out = []
+		end = len(items)
+		while idx < end:
+			entry = items[idx]
+			if entry is not None:
+				if len(entry) == 3:
+					encodings = entry[2]
+					encoded = encodings.get(key)
+				else:
+					encodings = None
+					encoded = None
+				if encoded is None:
+					encoded = encode(entry[0])
+					if encodings is None:
+						encodings = {}
+					encodings[key] = encoded
+					extra = totalSizeOf(encoded)
+					items[idx] = (entry[0], entry[1] + extra, encodings)
+					self._size += extra
+				out.append((base + idx, encoded))
+			idx += 1
+		return out
+
+
+	def _removeAll(self):
+		self._items = []
+		self._base = self._counter + 1
+		self._head = 0
+		self._count = 0
+		self._size = 0
 
 
 	def handleSACK(self, sack):
@@ -121,35 +198,55 @@ class Queue(object):
 		if ackNum > self._counter:
 			badSACK = True
 
-		sortedKeys = self._items.keys()
-		sortedKeys.sort()
-
-		for k in sortedKeys:
-			if k > ackNum:
-				break
-			size = self._items[k][1]
-			del self._items[k]
-			self._size -= size
-
+		if ackNum >= self._counter:
+			self._removeAll()
+		else:
+			items = self._items
+			end = ackNum + 1 - self._base
+			head = self._head
+			while head < end:
+				entry = items[head]
+				if entry is not None:
+					items[head] = None
+					self._count -= 1
+					self._size -= entry[1]
+				head += 1
+			self._head = head
+
+		items = self._items
+		base = self._base
 		for sackNum in sack.sackList:
 			if sackNum > self._counter:
 				badSACK = True
-			try:
-				size = self._items[sackNum][1]
-				del self._items[sackNum]
-				self._size -= size
-			except KeyError:
-				pass
-
-		# Possibly reduce memory use by killing the old dict
-		if not self._items:
-			self._items = {}
+				continue
+			idx = sackNum - base
+			if idx < self._head:
+				continue
+			entry = items[idx]
+			if entry is not None:
+				items[idx] = None
+				self._count -= 1
+				self._size -= entry[1]
+
+		if not self._count:
+			# Possibly reduce memory use by killing the old list
+			self._removeAll()
+		else:
+			# Skip over any holes that are now at the front.
+			head = self._head
+			while items[head] is None:
+				head += 1
+			self._head = head
+			if head >= self._compactThreshold and head * 2 >= len(items):
+				del items[:head]
+				self._base += head
+				self._head = 0
 
 		return badSACK
 
 
 	def getQueuedCount(self):
-		return len(self._items)
+		return self._count
 
 
 	def getMaxConsumption(self):
@@ -192,8 +289,13 @@ class Incoming(object):
 	This is done because L{StringFragment}s may be referencing a giant
 	C{str}, which we don't want to keep around.  It's also easier to get the
 	size-in-memory of a C{str}.
+
+	The seqNums of the undeliverable items are also kept as sorted,
+	non-adjacent inclusive ranges (in C{_starts} and C{_ends}), updated
+	incrementally as items arrive.  The L{SACK} is computed from these
+	ranges only after C{give} has changed something.
 	"""
-	__slots__ = ('_lastAck', '_cached', '_size')
+	__slots__ = ('_lastAck', '_cached', '_size', '_starts', '_ends', '_sack')
 
 	def __init__(self):
 		self._lastAck = -1
@@ -202,9 +304,39 @@ class Incoming(object):
 		# (because there are gaps).
 		self._cached = {}
 
+		# _starts[i] and _ends[i] are the first and last seqNum of the
+		# i'th run of undeliverable items.
+		self._starts = []
+		self._ends = []
+
+		# The cached result of getSACK(), or None if it needs recomputing.
+		self._sack = None
+
 		self._size = 0
 
 
+	def _addToRanges(self, num):
+		"""
+		Record that undeliverable item C{num} is now in C{_cached}.
+		"""
+		starts = self._starts
+		ends = self._ends
+		i = bisect_right(starts, num)
+		joinsLeft = i > 0 and ends[i - 1] + 1 == num
+		joinsRight = i < len(starts) and starts[i] - 1 == num
+		if joinsLeft and joinsRight:
+			ends[i - 1] = ends[i]
+			del starts[i]
+			del ends[i]
+		elif joinsLeft:
+			ends[i - 1] = num
+		elif joinsRight:
+			starts[i] = num
+		else:
+			starts.insert(i, num)
+			ends.insert(i, num)
+
+
 	def give(self, numAndItemSeq, itemLimit=None, sizeLimit=None):
 		"""
 		Simultaneously give new items, and get deliverable items.
@@ -231,19 +363,24 @@ class Incoming(object):
 				##print "deliverable.append(%r)" % (item,)
 				deliverable.append(item)
 				self._lastAck += 1
-				while True:
-					lastAckP1 = self._lastAck + 1
-					if not lastAckP1 in self._cached:
-						break
-					cachedItem, cachedSize = self._cached[lastAckP1]
-					##print "del self._cached[%r]" % (num,)
-					deliverable.append(
-						StringFragment(cachedItem, 0, len(cachedItem)) if \
-						isinstance(cachedItem, _wasSF) else cachedItem)
-					del self._cached[lastAckP1]
-					self._size -= cachedSize
-					self._lastAck = lastAckP1
-			elif num <= self._lastAck:
+				self._sack = None
+				# If the first run of cached items starts right after the
+				# item we just delivered, deliver the whole run.
+				if self._starts and self._starts[0] == self._lastAck + 1:
+					end = self._ends[0]
+					del self._starts[0]
+					del self._ends[0]
+					# Not xrange, because seqNums may be integral floats.
+					while self._lastAck < end:
+						lastAckP1 = self._lastAck + 1
+						cachedItem, cachedSize = self._cached.pop(lastAckP1)
+						##print "del self._cached[%r]" % (lastAckP1,)
+						deliverable.append(
+							StringFragment(cachedItem, 0, len(cachedItem)) if \
+							isinstance(cachedItem, _wasSF) else cachedItem)
+						self._size -= cachedSize
+						self._lastAck = lastAckP1
+			elif num <= self._lastAck or num in self._cached:
 				pass
 			else:
 				if itemLimit is not None and len(self._cached) >= itemLimit:
@@ -260,6 +397,8 @@ class Incoming(object):
 				##print "self._cached[%r] = %r" % (num, item)
 				self._cached[num] = (item, size)
 				self._size += size
+				self._addToRanges(num)
+				self._sack = None
 
 		# Possibly reduce memory use by killing the old dict
 		if not self._cached:
@@ -273,10 +412,15 @@ class Incoming(object):
 		@rtype: L{SACK}
 		@return: A SACK that represents which items Incoming has received.
 		"""
-		sackNumbers = self._cached.keys()
-		sackNumbers.sort()
-
-		return SACK(self._lastAck, tuple(sackNumbers))
+		sack = self._sack
+		if sack is None:
+			sackNumbers = []
+			for start, end in zip(self._starts, self._ends):
+				while start <= end:
+					sackNumbers.append(start)
+					start += 1
+			sack = self._sack = SACK(self._lastAck, tuple(sackNumbers))
+		return sack
 
 
 	def getUndeliverableCount(self):